@@ -0,0 +1,80 @@
+'''Asynchronous (ASGI) endpoints to interact with server.'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import falcon.asgi # pylint: disable=E0401
+import jsons # pylint: disable=E0401
+
+from backupinator import Server, wire
+from backupinator.job import * # allow all job types
+from backupinator.metrics import METRICS, TRACE_HEADER
+from backupinator.server import RawResponse
+
+# Make an instance of the server to pass to resource objects
+SERVER = Server.from_config()
+
+# Threads that blocking job handling is pushed to
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+async def stream_file(f, chunk_size=CHUNK_SIZE):
+    '''Read a file in executor threads as it's sent.'''
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(EXECUTOR, f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+class AsyncProcessJob:
+    '''Generic handling of Job without blocking the event loop.'''
+
+    async def on_post(self, req, resp):
+        '''Ask the server to process a job.'''
+
+        # Streamed uploads start with the job and carry raw data after
+        # it; everything else is a binary or JSON job
+        stream = None
+        content_type = req.content_type or ''
+        if content_type.startswith('application/octet-stream'):
+            stream = req.stream
+            job = wire.load_job(await read_job_prefix_async(stream))
+        elif content_type.startswith(wire.CONTENT_TYPE):
+            job = wire.load_job(await req.stream.read())
+        else:
+            data = await req.get_media()
+            job = jsons.load(data, globals()[data['job_type']])
+
+        # Send to job handler and get response
+        msg = await SERVER.job_handler_async(
+            job, stream, EXECUTOR, req.get_header(TRACE_HEADER))
+
+        # Send back response in the format the client asked for
+        resp.set_header(wire.WIRE_HEADER, str(wire.VERSION))
+        if isinstance(msg, RawResponse):
+            resp.content_type = 'application/octet-stream'
+            if msg.f is not None:
+                resp.stream = stream_file(msg.f)
+            else:
+                resp.data = msg.data
+        elif wire.CONTENT_TYPE in (req.accept or ''):
+            resp.content_type = wire.CONTENT_TYPE
+            resp.data = wire.dumps(msg)
+        else:
+            resp.media = msg
+
+class AsyncMetrics:
+    '''Server metrics for Prometheus to scrape.'''
+
+    async def on_get(self, _req, resp):
+        '''Render the metrics.'''
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.data = METRICS.render().encode()
+
+APP = falcon.asgi.App()
+APP.add_route('/process_job', AsyncProcessJob())
+APP.add_route('/metrics', AsyncMetrics())
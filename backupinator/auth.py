@@ -1,8 +1,13 @@
 '''Authentication class.'''
 
 class Auth:
-    '''Abstract away details for authentication.'''
+    '''Abstract away details for authentication.
 
-    def __init__(self, message, hex_signature):
+    Without a session_id, hex_signature is an RSA signature of message.
+    With one, it is an HMAC using that session's key.
+    '''
+
+    def __init__(self, message, hex_signature, session_id=None):
         self.message = message
         self.hex_signature = hex_signature
+        self.session_id = session_id
@@ -0,0 +1,69 @@
+'''Small caches for parsed files and imported keys.'''
+
+import os
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    '''Mapping that forgets the least recently used entries.'''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Look up a key and mark it as recently used.'''
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, val):
+        '''Add an entry, evicting the oldest if we're full.'''
+        with self._lock:
+            self._data[key] = val
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        '''Forget an entry if we have it.'''
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        '''Forget everything, returning the values that were held.'''
+        with self._lock:
+            vals = list(self._data.values())
+            self._data.clear()
+        return vals
+
+    def __len__(self):
+        return len(self._data)
+
+class FileCache:
+    '''Results of loading files, reloaded when a file's mtime changes.'''
+
+    def __init__(self, loader, maxsize=128):
+        self.loader = loader
+        self._cache = LRUCache(maxsize)
+
+    def get(self, filename):
+        '''loader(filename), reusing the last result if still fresh.'''
+
+        filename = str(filename)
+        try:
+            mtime_ns = os.stat(filename).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+
+        cached = self._cache.get(filename)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+
+        val = self.loader(filename)
+        self._cache.put(filename, (mtime_ns, val))
+        return val
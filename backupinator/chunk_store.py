@@ -0,0 +1,158 @@
+'''Content-addressed storage of file chunks.'''
+
+import pathlib
+import threading
+import contextlib
+
+from backupinator.chunking import MAX_CHUNK_SIZE, check_chunk
+from backupinator.compression import STATS, probe_codec
+from backupinator.db import open_store
+from backupinator.pack import PackStore, PACK_SIZE
+
+class ChunkStore:
+    '''Chunks stored once each, keyed by their strong hash.
+
+    Chunks are appended to pack files rather than each getting a file
+    of their own.  Index entries are "length:codec:pack:offset:size";
+    chunks stored before packs only have "length[:codec]" and still
+    live in their own files.
+    '''
+
+    def __init__(self, dirname, backend='dbm', codec='none',
+                 pack_size=PACK_SIZE):
+        self.dirname = pathlib.Path(dirname)
+        self.dirname.mkdir(parents=True, exist_ok=True)
+
+        # Index of which chunks we have, how big they are, how they're
+        # compressed and where they are
+        self.index = open_store(self.dirname / 'index', backend)
+        self.packs = PackStore(self.dirname / 'packs', pack_size)
+
+        # Codec new chunks are stored with (if they compress at all)
+        self.codec = codec
+
+        # Chunks written in each thread's current batch, indexed at
+        # its end
+        self._local = threading.local()
+
+    @property
+    def _pending(self):
+        return getattr(self._local, 'pending', None)
+
+    def get_chunk_filename(self, digest):
+        '''Where a chunk stored before packs is, fanned out by prefix.'''
+        return self.dirname / digest[:2] / digest[2:4] / digest
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Group writes, syncing the packs once and then indexing them.
+
+        Chunks are only indexed once they're safely on disk, so a crash
+        leaves at worst some unreferenced bytes at the end of a pack.
+        '''
+
+        if self._pending is not None:
+            yield self
+            return
+
+        self._local.pending = {}
+        try:
+            with self.packs.batch():
+                yield self
+        finally:
+            # Other threads may still be batching, so sync ourselves
+            self.packs.sync()
+            pending, self._local.pending = self._local.pending, None
+            with self.index.batch() as db:
+                for digest, entry in pending.items():
+                    db[digest] = entry
+
+    def _entry(self, digest):
+        '''A chunk's index entry, None if we don't have it.'''
+
+        if self._pending is not None and digest in self._pending:
+            return self._pending[digest]
+        entry = self.index.get(digest)
+        return None if entry is None else entry.decode()
+
+    def missing(self, digests):
+        '''Which of the given chunks we don't have yet.'''
+
+        pending = self._pending or {}
+        with self.index.batch() as db:
+            return [d for d in digests if d not in pending and d not in db]
+
+    def put(self, digest, data):
+        '''Store a chunk, checking that it matches its hash.'''
+
+        if not check_chunk(digest, data):
+            raise ValueError('Chunk data does not match its hash!')
+        if self._entry(digest) is not None:
+            return False
+
+        # Only keep the compressed version if it's worth it
+        codec = probe_codec(data, self.codec)
+        payload = STATS.compress(codec, data) if codec != 'none' else data
+        return self._write(digest, payload, codec, len(data))
+
+    def put_compressed(self, digest, payload, codec, length=MAX_CHUNK_SIZE):
+        '''Store a chunk that is already compressed with codec.
+
+        It must decompress to no more than length bytes.
+        '''
+
+        data = STATS.decompress(codec, payload, length)
+        if not check_chunk(digest, data):
+            raise ValueError('Chunk data does not match its hash!')
+        return self._write(digest, payload, codec, len(data))
+
+    def _write(self, digest, payload, codec, length):
+        '''Append a chunk to a pack and index it.'''
+
+        with self.index.batch():
+            if self._entry(digest) is not None:
+                return False
+
+            pack, offset = self.packs.append(payload)
+            entry = '%d:%s:%d:%d:%d' % (
+                length, codec, pack, offset, len(payload))
+            if self._pending is not None:
+                self._pending[digest] = entry
+            else:
+                self.index[digest] = entry
+        return True
+
+    def get_codec(self, digest):
+        '''How a chunk is compressed on disk.'''
+
+        # Chunks stored before compression only have a length
+        entry = self._entry(digest).split(':')
+        return entry[1] if len(entry) > 1 else 'none'
+
+    def location(self, digest):
+        '''(pack, offset) of a chunk, for reading chunks in disk order.
+
+        Chunks that aren't in a pack sort first.
+        '''
+
+        entry = (self._entry(digest) or '').split(':')
+        if len(entry) == 5:
+            return int(entry[2]), int(entry[3])
+        return 0, 0
+
+    def get(self, digest):
+        '''Read a chunk back, decompressing it.'''
+
+        entry = self._entry(digest)
+        if entry is None:
+            raise KeyError(digest)
+        entry = entry.split(':')
+        codec = entry[1] if len(entry) > 1 else 'none'
+        if len(entry) == 5:
+            payload = self.packs.read(*(int(e) for e in entry[2:]))
+        else:
+            with open(str(self.get_chunk_filename(digest)), 'rb') as f:
+                payload = f.read()
+        if codec == 'none':
+            return payload
+        return STATS.decompress(codec, payload, int(entry[0]))
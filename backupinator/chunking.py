@@ -0,0 +1,209 @@
+'''Content-defined chunking with a gear rolling hash (FastCDC-style).
+
+The rolling hash is computed a whole buffer at a time with numpy if it's
+installed, otherwise byte by byte in Python, which is slow enough that
+callers that don't need boundaries to line up with other copies of the
+data can use fixed-size chunks instead (see make_chunker).
+'''
+
+import hashlib
+
+try:
+    import numpy as np # pylint: disable=E0401
+except ImportError:
+    np = None
+
+from backupinator.hashing import DEFAULT_HASHES, content_hash_for, get_hash
+
+# Chunk sizes used unless told otherwise
+MIN_CHUNK_SIZE = 16*1024
+AVG_CHUNK_SIZE = 64*1024
+MAX_CHUNK_SIZE = 256*1024
+
+_MASK64 = (1 << 64) - 1
+
+def _make_gear_table():
+    '''Fixed pseudo-random 64-bit value for each byte value.
+
+    Every client and target must agree on this table or chunk
+    boundaries won't line up, so it is derived rather than random.
+    '''
+    return [
+        int.from_bytes(hashlib.sha256(bytes([ii])).digest()[:8], 'big')
+        for ii in range(256)]
+
+GEAR = _make_gear_table()
+GEAR_ARRAY = None if np is None else np.array(GEAR, dtype=np.uint64)
+
+def _high_mask(nbits):
+    '''Mask of the top nbits of a 64-bit word.'''
+    return ((1 << nbits) - 1) << (64 - nbits)
+
+def gear_hashes(data, first, lo, hi):
+    '''Rolling hash after each byte of data[lo:hi], starting at first.
+
+    The hash after a byte is the gear values of the 64 bytes up to it,
+    each shifted by how far back it is.  Sums over windows of 1, 2, 4,
+    ... 64 bytes are built by doubling, which takes six passes.
+    '''
+
+    begin = max(first, lo - 63)
+    h = GEAR_ARRAY[np.frombuffer(
+        data, dtype=np.uint8, count=hi - begin, offset=begin)]
+    width = 1
+    while width < 64:
+        h[width:] += h[:-width] << np.uint64(width)
+        width *= 2
+    return h[lo - begin:]
+
+def chunk_hash(data, algorithm=DEFAULT_HASHES['content']):
+    '''Strong hash used to address a chunk.'''
+    return get_hash(algorithm).hexdigest(data)
+
+def check_chunk(digest, data):
+    '''Whether data is what digest addresses, whatever made it.'''
+    return content_hash_for(digest).hexdigest(data) == digest
+
+class Chunker:
+    '''Split byte streams at content-defined boundaries.
+
+    Uses normalized chunking: a harder mask before the average size and
+    an easier one after it, which keeps chunk sizes close to average.
+    Boundaries depend only on nearby content, so an insert or delete
+    only changes the chunks around it.
+    '''
+
+    def __init__(self, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE,
+                 max_size=MAX_CHUNK_SIZE,
+                 content_hash=DEFAULT_HASHES['content']):
+        assert min_size <= avg_size <= max_size, 'Bad chunk sizes!'
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+
+        # Algorithm chunks are addressed with
+        self.content_hash = content_hash
+
+        bits = avg_size.bit_length() - 1
+        self.mask_s = _high_mask(bits + 1)
+        self.mask_l = _high_mask(bits - 1)
+
+    def cut_point(self, data, start=0, final=True):
+        '''Offset of the end of the chunk starting at start.
+
+        If final is False and no boundary is found before the data runs
+        out, None is returned so the caller can read more.
+        '''
+
+        remaining = len(data) - start
+        if remaining <= self.min_size:
+            return len(data) if final else None
+
+        end = start + min(remaining, self.max_size)
+        normal = start + min(remaining, self.avg_size)
+        if np is not None:
+            cut = self._find_cut_arrays(data, start, normal, end)
+        else:
+            cut = self._find_cut(data, start, normal, end)
+        if cut is not None:
+            return cut
+
+        if end - start == self.max_size or final:
+            return end
+        return None
+
+    def _find_cut(self, data, start, normal, end):
+        '''First boundary between the minimum size and end, or None.'''
+
+        gear, mask_s, mask_l = GEAR, self.mask_s, self.mask_l
+
+        # Skip hashing below the minimum size
+        h = 0
+        ii = start + self.min_size
+        while ii < normal:
+            h = ((h << 1) + gear[data[ii]]) & _MASK64
+            ii += 1
+            if not h & mask_s:
+                return ii
+        while ii < end:
+            h = ((h << 1) + gear[data[ii]]) & _MASK64
+            ii += 1
+            if not h & mask_l:
+                return ii
+        return None
+
+    def _find_cut_arrays(self, data, start, normal, end):
+        '''_find_cut() with numpy, hashing a stretch of bytes at once.
+
+        Stretches are avg_size long, so a boundary near the average
+        size doesn't cost hashing up to the maximum.
+        '''
+
+        first = start + self.min_size
+        for lo, hi, mask in (
+                (first, normal, self.mask_s), (normal, end, self.mask_l)):
+            mask = np.uint64(mask)
+            while lo < hi:
+                step = min(hi, lo + self.avg_size)
+                hits = np.flatnonzero(
+                    (gear_hashes(data, first, lo, step) & mask) == 0)
+                if len(hits):
+                    return lo + int(hits[0]) + 1
+                lo = step
+        return None
+
+    def iter_chunks(self, f, readsize=4*MAX_CHUNK_SIZE):
+        '''Yield chunks (as bytes) read from a binary file object.'''
+
+        buf = b''
+        eof = False
+        while True:
+            if not eof and len(buf) <= self.max_size:
+                block = f.read(max(readsize, self.max_size))
+                eof = not block
+                buf += block
+            if not buf:
+                return
+
+            start = 0
+            while start < len(buf):
+                cut = self.cut_point(buf, start, final=eof)
+                if cut is None:
+                    break
+                yield buf[start:cut]
+                start = cut
+            buf = buf[start:]
+
+    def chunk_file(self, filename):
+        '''Yield (chunk_hash, offset, length) for each chunk of a file.'''
+
+        offset = 0
+        with open(filename, 'rb') as f:
+            for chunk in self.iter_chunks(f):
+                yield chunk_hash(chunk, self.content_hash), offset, len(chunk)
+                offset += len(chunk)
+
+class FixedChunker(Chunker):
+    '''Split byte streams into avg_size chunks.
+
+    Much cheaper than finding boundaries by content, but an insert or
+    delete changes every chunk after it.
+    '''
+
+    def cut_point(self, data, start=0, final=True):
+        '''Offset of the end of the chunk starting at start.'''
+        if len(data) - start >= self.avg_size:
+            return start + self.avg_size
+        return len(data) if final else None
+
+CHUNKERS = {
+    'cdc': Chunker,
+    'fixed': FixedChunker,
+    'auto': Chunker if np is not None else FixedChunker,
+}
+
+def make_chunker(kind='auto', **kwargs):
+    '''Chunker of a kind: cdc, fixed, or auto (cdc if numpy is here).'''
+    if kind not in CHUNKERS:
+        raise ValueError('Unknown chunking: %s' % kind)
+    return CHUNKERS[kind](**kwargs)
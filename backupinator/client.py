@@ -1,19 +1,34 @@
 '''Client to send jobs to server.'''
 
+import os
 import pathlib
 import json
 import logging
+import threading
+from time import time
 
-from Cryptodome.PublicKey import RSA # pylint: disable=E0401
+import jsons # pylint: disable=E0401
 from Cryptodome.Signature import pkcs1_15 # pylint: disable=E0401
 from Cryptodome.Hash import SHA256 # pylint: disable=E0401
+from Cryptodome.Cipher import PKCS1_OAEP # pylint: disable=E0401
 
 from backupinator import Auth, ClientDB
+from backupinator.chunking import Chunker
+from backupinator.compression import STATS, choose_codec
+from backupinator.job_queue import JobQueue
+from backupinator.delta import pick_block_size, signatures
+from backupinator.merkle import diff
+from backupinator.metrics import METRICS, enable_tracing
+from backupinator.scheduler import UploadScheduler
+from backupinator.watcher import ChangeQueue, make_watcher
+from backupinator.session import Session
+from backupinator.transport import Transport
+from backupinator.wire import load_response
 from backupinator.job import *
 from backupinator.utils import (
     get_generic_config_val, random_string, make_rsa_keys,
-    client_rsa_key_filename, load_client_rsa_key,
-    get_client_config_filename)
+    client_rsa_key_filename, load_client_rsa_key, import_client_rsa_key,
+    get_client_config_filename, get_mtime)
 
 class Client:
     '''Produce jobs to send to server.'''
@@ -31,9 +46,30 @@ class Client:
         # Get server address from config file
         self.server_address = self.get_config_val('server_address')
 
-        # Job queues
-        self.jobs = {} # for connected targets
-        self.defered_jobs = {} # if we lose connection, keep backlog
+        # All jobs go through one pool of keep-alive connections
+        self.transport = Transport(
+            pool_size=self.get_config_val(
+                'pool_size', valtype='int', fallback=10),
+            retries=self.get_config_val(
+                'retries', valtype='int', fallback=3),
+            backoff=self.get_config_val(
+                'retry_backoff', valtype='float', fallback=0.5),
+            connect_timeout=self.get_config_val(
+                'connect_timeout', valtype='float', fallback=5.0),
+            read_timeout=self.get_config_val(
+                'read_timeout', valtype='float', fallback=60.0),
+            http2=self.get_config_val(
+                'http2', valtype='bool', fallback=False),
+            binary=self.get_config_val(
+                'binary_wire', valtype='bool', fallback=True))
+
+        # Jobs for each target wait on disk until they're sent, so
+        # they survive restarts
+        self.jobs = JobQueue('client_data/%s/jobs.db' % self.client_name)
+
+        # Log spans of each upload if asked to
+        if self.get_config_val('trace', valtype='bool', fallback=False):
+            enable_tracing()
 
         # Get targets
         self.targets = self.get_config_val('targets').split(',')
@@ -41,10 +77,10 @@ class Client:
         # All targets should be synced from the start
         self.unsynced_targets = self.targets.copy()
 
-        # Initialize job queues
-        for target in self.targets:
-            self.jobs[target] = []
-            self.defered_jobs[target] = []
+        # Jobs for targets that aren't online, or whose spool on the
+        # server is full, are held back
+        self.offline_targets = set()
+        self.paused_targets = set()
 
         # Set up a local backup if user wants it
         self.local_target = self.get_config_val('local_target')
@@ -60,18 +96,53 @@ class Client:
         make_rsa_keys(
             public_filename, private_filename, key_size=2048)
 
+        # Codec to compress uploads with, where it helps
+        self.compression = self.get_config_val(
+            'compression', fallback='none')
+
+        # Only send chunks targets don't already have if asked to
+        self.dedup = self.get_config_val(
+            'dedup', valtype='bool', fallback=False)
+
+        # Otherwise send only what changed in files the server has seen
+        self.delta = self.get_config_val(
+            'delta', valtype='bool', fallback=False)
+
         # Read signature length from the config file
         self.auto_signature_len = self.get_config_val(
             'auto_signature_len', valtype='int')
 
-        # Sync up the database with the filesystem
+        # Use RSA only to open HMAC sessions if the server lets us
+        self.use_sessions = self.get_config_val(
+            'use_sessions', valtype='bool', fallback=True)
+        self.session = None
+        self._session_lock = threading.Lock()
+
+        # Sync up the database with the filesystem and queue up
+        # anything that changed since we last ran
         self.client_db = ClientDB(
             self.client_name, self.get_config_val)
-        self.client_db.sync()
 
-    def get_config_val(self, key, valtype='str'):
+        # Chunks are addressed with the content hash on record
+        self.chunker = Chunker(content_hash=self.client_db.hashes['content'])
+        self.client_db.sync(self.queue_changes)
+
+        # Queued jobs go out to all targets at once
+        self.scheduler = UploadScheduler(self)
+
+    def get_config_val(self, key, valtype='str', fallback=None):
         '''Lookup value in client config file.'''
-        return get_generic_config_val(self.configfile, key, valtype)
+        return get_generic_config_val(
+            self.configfile, key, valtype, fallback)
+
+    def file_info(self, filename):
+        '''What jobs sending a file tell the target about it.'''
+        return {
+            'tree_value': self.client_db.get_tree_value(filename),
+            'mtime': get_mtime(filename),
+            'filename_hash': self.client_db.filename_hash(filename),
+            'hashes': self.client_db.hashes,
+        }
 
     def sign_with_priv_key(self, message=None):
         '''Sign message with private key.'''
@@ -80,14 +151,63 @@ class Client:
         if message is None:
             message = random_string(self.auto_signature_len)
 
-        # Load the private key
-        priv_key = load_client_rsa_key(self.client_name, public=False)
+        # Load the private key (imported once and cached)
+        key = import_client_rsa_key(self.client_name, public=False)
 
         hashed = SHA256.new(message.encode())
-        key = RSA.import_key(priv_key)
         signature = pkcs1_15.new(key).sign(hashed)
         return Auth(message, signature.hex())
 
+    def open_session(self):
+        '''Trade an RSA signature for a session key.'''
+
+        self.session = None
+        job = OpenSessionJob(
+            self.server_address, self.client_name, self.sign_with_priv_key())
+        json_data = load_response(job.submit(self.transport))
+        if not json_data['success']:
+            logging.info('Could not open session: %s', json_data['msg'])
+            return False
+
+        # Session key is encrypted with our public key
+        priv_key = import_client_rsa_key(self.client_name, public=False)
+        key = PKCS1_OAEP.new(priv_key).decrypt(
+            bytes.fromhex(json_data['encrypted_key']))
+        self.session = Session(
+            json_data['session_id'], key, time() + json_data['lifetime'])
+        return True
+
+    def get_auth(self):
+        '''Authenticate a request, with a session MAC if we can.'''
+
+        if not self.use_sessions:
+            return self.sign_with_priv_key()
+
+        # Start a new session a little before the old one runs out
+        # (once, even if several uploads are running)
+        with self._session_lock:
+            if self.session is None or self.session.expired(margin=60):
+                self.open_session()
+            session = self.session
+        if session is None:
+            return self.sign_with_priv_key()
+        return session.sign()
+
+    def submit(self, job):
+        '''Authenticate a job right before sending it (and each retry).
+
+        If the server no longer knows our session (e.g., it restarted)
+        a new session is opened and the job is sent once more.
+        '''
+
+        resp = job.submit(self.transport, sign=self.get_auth)
+        if self.session is not None and job.auth.session_id is not None:
+            json_data = load_response(resp)
+            if isinstance(json_data, dict) and json_data.get('auth_failed'):
+                self.session = None
+                resp = job.submit(self.transport, sign=self.get_auth)
+        return resp
+
     def register(self):
         '''Register with the server.'''
 
@@ -100,31 +220,24 @@ class Client:
             self.server_address, self.client_name, pub_key, auth)
 
         # Submit the job
-        _resp = job.submit()
-
-        print(_resp)
+        json_data = load_response(job.submit(self.transport))
+        logging.info('Registered %s: %s', self.client_name, json_data)
 
     def checkin(self):
         '''Tell the server that we are active.'''
 
         # Create a checkin job
-        auth = self.sign_with_priv_key()
         job = CheckinClientJob(
-            self.server_address, self.client_name, self.targets, auth)
+            self.server_address, self.client_name, self.targets, None)
 
         # Submit the job
-        resp = job.submit()
-        json_data = json.loads(resp.text)
-
-        # Defer jobs for targets who aren't online
-        for target in json_data['offline_targets']:
-            self.defered_jobs[target] += self.jobs[target].copy()
-            self.jobs[target] = []
+        resp = self.submit(job)
+        json_data = load_response(resp)
 
-        # Add back jobs for any targets came back online
-        for target in json_data['online_targets']:
-            self.jobs[target] += self.defered_jobs[target].copy()
-            self.defered_jobs[target] = []
+        # Defer jobs for targets who aren't online; they stay queued
+        # until the target comes back
+        self.offline_targets = set(json_data['offline_targets'])
+        self.paused_targets = set(json_data.get('paused_targets', []))
 
     def send_file(self, filename, target_name):
         '''Send a file to Server to a specified target to backup.'''
@@ -132,38 +245,252 @@ class Client:
         # Sanity check
         assert target_name in self.targets, 'target_name not a valid target!'
 
-        auth = self.sign_with_priv_key()
+        if self.dedup:
+            return self.send_file_chunks(filename, target_name)
+        if self.delta and self.send_file_delta(filename, target_name):
+            return
+
         job = SendFileJob(
             self.server_address, self.client_name, target_name,
-            filename, auth)
+            filename, None, codec=choose_codec(filename, self.compression),
+            **self.file_info(filename))
+
+        resp = self.submit(job)
+        logging.info('Compression so far: %s', STATS.report())
+        json_data = load_response(resp)
+        logging.info('Sent %s to %s: %s', filename, target_name, json_data)
+
+    def file_chunks(self, filename):
+        '''[hash, offset, length] of each content-defined chunk of a file.'''
+        return [list(c) for c in self.chunker.chunk_file(filename)]
+
+    def file_signatures(self, filename):
+        '''Size, block size and block signatures of a file's contents.'''
+        size = os.path.getsize(filename)
+        block_size = pick_block_size(size)
+        with open(filename, 'rb') as f:
+            return size, block_size, signatures(f, block_size)
+
+    def send_file_chunks(self, filename, target_name, chunks=None,
+                         throttle=None):
+        '''Send only the chunks of a file that the target is missing.
+
+        chunks are from file_chunks() if they're already known; throttle
+        is called with the size of each piece of the body as it's sent.
+        '''
+
+        # Split the file at content-defined boundaries
+        if chunks is None:
+            chunks = self.file_chunks(filename)
+
+        # Ask which ones the target needs
+        job = QueryChunksJob(
+            self.server_address, self.client_name, target_name,
+            sorted({c[0] for c in chunks}), None)
+        json_data = load_response(self.submit(job))
+        if not json_data['success']:
+            logging.warning('Could not query chunks of %s: %s', filename,
+                            json_data.get('msg'))
+            return False
+
+        # Send those in file order along with the full manifest
+        wanted = set(json_data['missing'])
+        missing = []
+        for digest, _offset, _length in chunks:
+            if digest in wanted:
+                wanted.remove(digest)
+                missing.append(digest)
+
+        job = SendChunksJob(
+            self.server_address, self.client_name, target_name,
+            filename, chunks, missing, None,
+            codec=choose_codec(filename, self.compression),
+            **self.file_info(filename))
+        job._throttle = throttle
+        json_data = load_response(self.submit(job))
+        logging.info('Compression so far: %s', STATS.report())
+        logging.info('Sent chunks of %s to %s: %s', filename, target_name,
+                     json_data)
+        return json_data['success']
+
+    def file_bases(self, target_name, filenames):
+        '''Signatures the server has of files, by filename hash.
+
+        Files it has never seen aren't in the result; None if it
+        couldn't be asked.
+        '''
 
-        resp = job.submit()
-        json_data = json.loads(resp.text)
-        print(json_data)
+        job = GetTreeJob(
+            self.server_address, self.client_name, target_name, None,
+            filename_hashes=sorted({
+                self.client_db.filename_hash(f) for f in filenames}))
+        json_data = load_response(self.submit(job))
+        if not json_data['success']:
+            return None
+        return json_data['signatures']
+
+    def send_file_delta(self, filename, target_name, file_signatures=None,
+                        source=None, throttle=None, bases=None):
+        '''Send only the blocks of a file that changed since last time.
+
+        Returns False if there's no earlier copy to diff against and the
+        whole file should be sent instead.  file_signatures(filename)
+        stands in for self.file_signatures() and is only called once
+        there's a copy to diff against, source makes a file object to
+        read the file from, and throttle is as for send_file_chunks().
+        bases is file_bases() if it's already been asked for.
+        '''
+
+        # Signatures of the copy the server last saw
+        if bases is None:
+            bases = self.file_bases(target_name, [filename])
+            if bases is None:
+                return False
+        base = bases.get(self.client_db.filename_hash(filename))
+        if base is None:
+            return False
+
+        # Signatures of this version, for the next delta
+        if file_signatures is None:
+            file_signatures = self.file_signatures
+        size, block_size, sigs = file_signatures(filename)
+
+        job = SendDeltaJob(
+            self.server_address, self.client_name, target_name, filename,
+            base['block_size'], base['signatures'], size, block_size, sigs,
+            None, **self.file_info(filename))
+        job._open = source
+        job._throttle = throttle
+        json_data = load_response(self.submit(job))
+        logging.info('Sent delta of %s to %s: %s', filename, target_name,
+                     json_data)
+        return json_data['success']
+
+    def queue_changes(self, changes):
+        '''Queue up SendFileJobs for files in a ChangeSet.
+
+        Jobs are authenticated by submit() when they are sent.
+        '''
 
-    def sync_target(self, target_name):
-        '''Ask server for target's tree so we know what to send.'''
+        for target in self.targets:
+            for filename in changes.changed():
+                self.jobs.put(target, SendFileJob(
+                    self.server_address, self.client_name, target,
+                    filename, None,
+                    codec=choose_codec(filename, self.compression),
+                    **self.file_info(filename)))
 
-        auth = self.sign_with_priv_key()
-        job = GetTreeJob(
-            self.server_address, self.client_name, target_name, auth)
+    def sync_target(self, target_name):
+        '''Ask server for target's tree so we know what to send.
+
+        Merkle hashes are compared from the root down, so only the
+        parts of the tree that differ are fetched.  Files the target is
+        missing or has an old version of are queued and returned.
+        '''
+
+        def fetch(prefixes):
+            job = GetTreeJob(
+                self.server_address, self.client_name, target_name, None,
+                prefixes=prefixes)
+            json_data = load_response(self.submit(job))
+            if not json_data['success']:
+                raise RuntimeError(json_data['msg'])
+            return json_data['nodes']
+
+        changed, _extra = diff(self.client_db.tree, fetch)
+        filenames = self.client_db.find_filenames(changed)
+        for filename in filenames:
+            self.jobs.put(target_name, SendFileJob(
+                self.server_address, self.client_name, target_name,
+                filename, None,
+                codec=choose_codec(filename, self.compression),
+                **self.file_info(filename)))
+
+        if target_name in self.unsynced_targets:
+            self.unsynced_targets.remove(target_name)
+        return filenames
+
+    def send_queued_jobs(self):
+        '''Send the jobs queued for online targets.
+
+        Jobs are only taken off the queue once the server has them; the
+        first failure for a target leaves the rest of its queue for
+        later.  See UploadScheduler for how targets share the work.
+        '''
+        return self.scheduler.run()
+
+    def watch(self):
+        '''Back up changes as they happen, until interrupted.
+
+        Filesystem events are debounced into a queue of paths, which
+        are checked and sent as they settle.  A full (incremental) scan
+        is only done at startup or if the watcher loses track.
+        '''
+
+        tracked_dirs = self.get_config_val('tracked_dirs').split(',')
+        watcher = make_watcher(
+            tracked_dirs, self.get_config_val('watcher', fallback='auto'),
+            self.get_config_val(
+                'poll_interval', valtype='float', fallback=60.0))
+        pending = ChangeQueue(
+            self.get_config_val(
+                'watch_debounce', valtype='float', fallback=2.0),
+            self.get_config_val(
+                'watch_max_delay', valtype='float', fallback=30.0))
+        logging.info('Watching with %s', type(watcher).__name__)
+
+        # Catch anything that changed before the watches were set up
+        self.client_db.sync(self.queue_changes)
+
+        # Check in now and then to learn which targets can take jobs
+        checkin_interval = self.get_config_val(
+            'checkin_interval', valtype='float', fallback=60.0)
+        last_checkin = 0
+
+        try:
+            while True:
+                if time() - last_checkin > checkin_interval:
+                    try:
+                        self.checkin()
+                    except OSError as e:
+                        logging.info('Could not check in: %s', e)
+                    last_checkin = time()
+                    METRICS.write(
+                        'client_data/%s/metrics.prom' % self.client_name)
+                paths, rescan = watcher.poll(timeout=pending.debounce)
+                if rescan:
+                    self.client_db.sync(self.queue_changes)
+                pending.add(paths)
+                ready = pending.pop_ready()
+                if ready:
+                    self.client_db.apply_events(ready, self.queue_changes)
+                self.send_queued_jobs()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
 
     def list_jobs(self):
         '''Print out a list of all jobs this client has.'''
-        print('Jobs: ', json.dumps(self.jobs, indent=2))
-        print('Defered: ', json.dumps(self.defered_jobs, indent=2))
+        for target in self.targets:
+            jobs = [job for _seq, job in self.jobs.iter_jobs(target)]
+            status = 'Defered' if target in self.offline_targets else 'Jobs'
+            print('%s for %s: ' % (status, target), json.dumps(
+                jsons.dump(jobs, strip_privates=True), indent=2))
+        print('Queues: ', json.dumps(
+            self.jobs.stats(self.targets), indent=2))
 
     def dummy_jobs(self, num=10):
         '''Add dummy test jobs.'''
 
-        job = BatchJob(self.server_address)
+        # The whole batch is authenticated once
+        job = BatchJob(self.server_address, self.client_name)
         for _ii in range(num):
-            auth = self.sign_with_priv_key()
             job.addjob(CheckinClientJob(
-                self.server_address, self.client_name, self.targets, auth))
-        resp = job.submit()
+                self.server_address, self.client_name, self.targets, None))
+        resp = self.submit(job)
 
-        json_data = json.loads(resp.text)
+        json_data = load_response(resp)
         print(json_data)
 
 
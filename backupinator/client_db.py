@@ -1,9 +1,36 @@
 '''Key-value database for use with Client.'''
 
-import dbm
+import os
+import json
+import stat
+import logging
 import pathlib
+import contextlib
+from collections import deque
 
-from backupinator.utils import make_tree
+from backupinator.db import open_store
+from backupinator.hashing import DEFAULT_HASHES, check_hashes, get_hash
+from backupinator.merkle import MerkleTree
+from backupinator.metrics import METRICS
+from backupinator.scanner import Scanner, ChangeSet, StatCache, stat_key
+from backupinator.utils import tree_item
+from backupinator.walker import hash_file, hash_files
+
+SCAN_SECONDS = METRICS.histogram(
+    'backupinator_client_scan_seconds', 'Time to scan for changes.',
+    ('kind',))
+SCAN_CHANGES = METRICS.counter(
+    'backupinator_client_scan_changes_total', 'Changed files found.',
+    ('change',))
+
+# dbm can't roll back, so this is left in the stat cache by a sync
+# whose changes may not have been queued
+UNFINISHED = 'unfinished'
+
+def _count_changes(changes):
+    for change in ('added', 'modified', 'removed'):
+        SCAN_CHANGES.inc(len(getattr(changes, change)), change=change)
+    return changes
 
 class ClientDB:
     '''For simple file tracking for client.'''
@@ -11,35 +38,323 @@ class ClientDB:
     def __init__(self, client_name, get_config_val):
         self.client_name = client_name
         self.filename = 'client_data/%s/tree.db' % self.client_name
+        self.stat_filename = 'client_data/%s/stat.db' % self.client_name
+        self.merkle_filename = 'client_data/%s/merkle.db' % self.client_name
+        self.names_filename = 'client_data/%s/names.db' % self.client_name
+        self.hashes_filename = 'client_data/%s/hashes.json' % self.client_name
         pathlib.Path(self.filename).parents[0].mkdir(parents=True, exist_ok=True)
 
         # use client config function
         self.get_config_val = get_config_val
 
-    def sync(self):
-        '''Sync the database with the file system.'''
+        # Keep the stores open for the life of the client
+        backend = self.get_config_val('db_backend', fallback='dbm')
+        self.transactional = backend != 'dbm'
+        self.db = open_store(self.filename, backend)
+        self.stat_db = open_store(self.stat_filename, backend)
+
+        # Hash algorithms the databases were made with
+        self.hashes = self.load_hashes()
+
+        # Merkle summary of the tree, keyed by filename hash so it can
+        # be compared with what targets have
+        self.hash_filenames = self.get_config_val(
+            'hash_filenames', valtype='bool')
+        self.tree = MerkleTree(open_store(self.merkle_filename, backend))
+        if len(self.db) and self.tree.root() is None:
+            self.tree.rebuild(
+                (self.merkle_key(k.decode()), v) for k, v in self.db.items())
+
+        # Filenames by their hash, so files a target is missing can be
+        # found without hashing every tracked path
+        self.names = open_store(self.names_filename, backend)
+        if len(self.stat_db) and not len(self.names):
+            self.rebuild_names()
+
+    def rebuild_names(self):
+        '''Fill in filenames by hash from the stat cache.'''
+        with self.names.batch() as names:
+            for key, _val in self.stat_db.items():
+                key = key.decode()
+                if key.startswith('f:'):
+                    names[self.filename_hash(key[2:])] = key[2:]
+
+    def load_hashes(self):
+        '''Hash algorithms to use, as recorded or configured.
+
+        Databases from before algorithms were recorded used the
+        defaults.  The filename hash is never switched since targets
+        know files by it.  Switching the change hash starts the tree
+        over, so every file is sent again once.
+        '''
+
+        configured = check_hashes({
+            role: self.get_config_val(role + '_hash', fallback=default)
+            for role, default in DEFAULT_HASHES.items()})
+        try:
+            with open(self.hashes_filename) as f:
+                recorded = json.load(f)
+        except FileNotFoundError:
+            recorded = dict(DEFAULT_HASHES) if (
+                len(self.db) or len(self.stat_db)) else None
+
+        hashes = dict(configured)
+        if recorded is not None:
+            if recorded['name'] != configured['name']:
+                logging.info(
+                    'Keeping %s for filename hashes, targets know files '
+                    'by them', recorded['name'])
+                hashes['name'] = recorded['name']
+            if recorded['change'] != configured['change']:
+                logging.info(
+                    'Change hash is now %s, rescanning and sending every '
+                    'file again', configured['change'])
+                self.stat_db.clear()
+
+        if hashes != recorded:
+            with open(self.hashes_filename, 'w') as f:
+                json.dump(hashes, f)
+        return hashes
+
+    def filename_hash(self, filename):
+        '''Hash that identifies a file to the server and targets.'''
+        return get_hash(self.hashes['name']).hexdigest(str(filename).encode())
+
+    def merkle_key(self, key):
+        '''Tree key as the filename hash used by jobs.'''
+        if self.hash_filenames:
+            return key
+        return self.filename_hash(key)
+
+    def tree_key(self, filename):
+        '''Key a file is stored under in the tree.'''
+        if self.hash_filenames:
+            return self.filename_hash(filename)
+        return str(filename)
+
+    def tree_item(self, filename, mtime, hash_filenames, hash_times):
+        '''Key and value for a file, with our hash algorithms.'''
+        return tree_item(
+            filename, mtime, hash_filenames, hash_times,
+            self.hashes['name'], self.hashes['change'])
+
+    def get_tree_value(self, filename):
+        '''Value recorded for a file in the tree, None if untracked.'''
+        val = self.db.get(self.tree_key(filename))
+        return None if val is None else val.decode()
+
+    def sync(self, on_changes=None):
+        '''Sync the database with the file system.
+
+        Only files that changed since the last sync are written, and
+        the ChangeSet describing them is returned.  on_changes is
+        called with it before anything is committed, so changes that
+        never got queued are found again by the next sync.
+        '''
+
+        if UNFINISHED in self.stat_db:
+            logging.info('Last sync did not finish, rescanning everything')
+            self.stat_db.clear()
+
+        # Without a stat cache every file will show up as added, so
+        # start the tree over to drop anything stale
+        if not len(self.stat_db):
+            self.db.clear()
+            self.tree.clear()
+            self.names.clear()
+
+        with self.stat_db.batch(), self.db.batch(), self.tree.batch(), \
+                self.names.batch(), self.unfinished():
+            with SCAN_SECONDS.time(kind='sync'):
+                changes = _count_changes(self._sync())
+            if on_changes is not None:
+                on_changes(changes)
+        return changes
+
+    @contextlib.contextmanager
+    def unfinished(self):
+        '''Mark the stat cache while changes might not be queued yet.'''
+        if self.transactional:
+            yield
+            return
+        self.stat_db[UNFINISHED] = '1'
+        yield
+        del self.stat_db[UNFINISHED]
+
+    def _sync(self):
+
+        hash_filenames = self.get_config_val('hash_filenames', valtype='bool')
+        hash_times = self.get_config_val('hash_times', valtype='bool')
+        hash_contents = self.get_config_val(
+            'hash_contents', valtype='bool', fallback=False)
+        hash_workers = self.get_config_val(
+            'hash_workers', valtype='int', fallback=4)
+        scan_workers = self.get_config_val(
+            'scan_workers', valtype='int', fallback=8)
+        tracked_dirs = self.get_config_val('tracked_dirs').split(',')
+        scanner = Scanner(self.stat_db, tracked_dirs, scan_workers)
+
+        # All changes go in as a single transaction
+        changes = ChangeSet()
+        cache = StatCache(self.stat_db)
+        with self.db.batch() as db, self.tree.batch() as tree, \
+                self.names.batch() as names:
+
+            # Removals are applied as they stream by; everything else
+            # is passed along (possibly to be hashed)
+            pending = deque()
+            def changed_files():
+                for kind, filename, st in scanner.iter_changes():
+                    key, val = self.tree_item(
+                        filename, st.st_mtime if st else 0,
+                        hash_filenames, hash_times)
+                    if kind == 'removed':
+                        try:
+                            del db[key]
+                        except KeyError:
+                            pass
+                        tree.remove(self.merkle_key(key))
+                        try:
+                            del names[self.merkle_key(key)]
+                        except KeyError:
+                            pass
+                        changes.removed.append(filename)
+                        continue
+                    if kind == 'added':
+                        names[self.merkle_key(key)] = filename
+                    pending.append((kind, key, val))
+                    yield filename
+
+            if not hash_contents:
+                for filename in changed_files():
+                    kind, key, val = pending.popleft()
+                    db[key] = val
+                    tree.update(self.merkle_key(key), val)
+                    getattr(changes, kind).append(filename)
+                return changes
+
+            # Use content digests as values so files that were only
+            # touched aren't sent again
+            for filename, digest in hash_files(
+                    changed_files(), self.hashes['change'],
+                    workers=hash_workers):
+                kind, key, _val = pending.popleft()
+
+                # Forget files that couldn't be read so they're tried
+                # again next time
+                if digest is None:
+                    cache.del_file(filename)
+                    continue
+                if kind == 'modified' and db.get(key) == digest.encode():
+                    continue
+                db[key] = digest
+                tree.update(self.merkle_key(key), digest)
+                getattr(changes, kind).append(filename)
+
+        return changes
+
+    def apply_events(self, paths, on_changes=None):
+        '''Update the database for paths a watcher saw change.
+
+        Only the given paths are stat'ed; directories that went away
+        take what we knew of their contents with them.  The stat cache
+        is kept in step so the next sync() doesn't report these again,
+        and like sync(), on_changes is called before it's committed.
+        '''
 
         hash_filenames = self.get_config_val('hash_filenames', valtype='bool')
         hash_times = self.get_config_val('hash_times', valtype='bool')
-        tree = make_tree(self.client_name, hash_filenames, hash_times)
+        hash_contents = self.get_config_val(
+            'hash_contents', valtype='bool', fallback=False)
+        scanner = Scanner(
+            self.stat_db, self.get_config_val('tracked_dirs').split(','))
+
+        changes = ChangeSet()
+        with self.stat_db.batch() as sdb, self.db.batch() as db, \
+                self.tree.batch() as tree, self.names.batch() as names, \
+                self.unfinished():
+            cache = StatCache(sdb)
+
+            def remove(path):
+                key, _val = self.tree_item(
+                    path, 0, hash_filenames, hash_times)
+                try:
+                    del db[key]
+                except KeyError:
+                    pass
+                try:
+                    del names[self.merkle_key(key)]
+                except KeyError:
+                    pass
+                tree.remove(self.merkle_key(key))
+                changes.removed.append(path)
+
+            for path in paths:
+                path = os.path.normpath(path)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    st = None
+
+                # New directories have their files reported separately
+                if st is not None and stat.S_ISDIR(st.st_mode):
+                    continue
+
+                old = cache.get_file(path)
+                if st is None or not stat.S_ISREG(st.st_mode):
+                    for _kind, removed, _st in scanner.remove_subtree(
+                            cache, path):
+                        remove(removed)
+                    if old is not None:
+                        cache.del_file(path)
+                        remove(path)
+                    continue
 
-        # Easiest way to sync is to recreate database:
-        with dbm.open(self.filename, 'n') as db:
-            for key, val in tree.items():
+                if old == stat_key(st):
+                    continue
+                cache.set_file(path, st)
+                key, val = self.tree_item(
+                    path, st.st_mtime, hash_filenames, hash_times)
+                names[self.merkle_key(key)] = path
+                if hash_contents:
+                    try:
+                        val = hash_file(path, self.hashes['change'])
+                    except OSError:
+                        cache.del_file(path)
+                        continue
+                    if old is not None and db.get(key) == val.encode():
+                        continue
                 db[key] = val
+                tree.update(self.merkle_key(key), val)
+                if old is None:
+                    changes.added.append(path)
+                else:
+                    changes.modified.append(path)
 
+            if on_changes is not None:
+                on_changes(changes)
+
+        return changes
+
+    def find_filenames(self, keys):
+        '''Tracked filenames whose Merkle keys are among keys.'''
+
+        found = []
+        for key in set(keys):
+            filename = self.names.get(key)
+            if filename is not None:
+                found.append(filename.decode())
+        return found
 
     def update(self, key, val):
         '''Update an entry in the database.'''
-
-        with dbm.open(self.filename, 'c') as db:
-            db[key] = val
+        self.db[key] = val
+        self.tree.update(self.merkle_key(key), val)
 
     def remove(self, key):
         '''Remove an entry from database.'''
-
-        with dbm.open(self.filename, 'c') as db:
-            try:
-                del db[key]
-            except KeyError:
-                pass
+        try:
+            del self.db[key]
+        except KeyError:
+            pass
+        self.tree.remove(self.merkle_key(key))
@@ -0,0 +1,206 @@
+'''Optional compression of file data.'''
+
+import io
+import os
+import zlib
+import struct
+import logging
+import threading
+from time import perf_counter
+
+try:
+    import zstandard # pylint: disable=E0401
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame # pylint: disable=E0401
+except ImportError:
+    lz4 = None
+
+# Files with these extensions are already compressed
+COMPRESSED_EXTENSIONS = {
+    '.gz', '.tgz', '.bz2', '.xz', '.lz4', '.zst', '.zip', '.7z', '.rar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.aac',
+    '.ogg', '.flac', '.mp4', '.m4a', '.m4v', '.mkv', '.mov', '.avi',
+    '.webm', '.pdf', '.docx', '.xlsx', '.pptx', '.jar', '.apk',
+}
+
+# How much of a file to try compressing when deciding
+PROBE_SIZE = 64*1024
+
+# Don't bother unless the probe shrinks by at least this much
+MIN_SAVINGS = 0.1
+
+# Compressed chunks are sent as length-prefixed frames
+_FRAME = struct.Struct('>I')
+
+# Largest frame accepted; chunks are at most a MiB before compression,
+# and incompressible data is sent uncompressed
+MAX_FRAME_SIZE = 4*1024*1024
+
+def available_codecs():
+    '''Codecs that can be used here.'''
+    codecs = ['none', 'zlib']
+    if zstandard is not None:
+        codecs.append('zstd')
+    if lz4 is not None:
+        codecs.append('lz4')
+    return codecs
+
+def compress(codec, data, level=None):
+    '''Compress data with a codec.'''
+
+    if codec == 'none':
+        return data
+    if codec == 'zlib':
+        return zlib.compress(data, 6 if level is None else level)
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(
+            level=3 if level is None else level).compress(data)
+    if codec == 'lz4' and lz4 is not None:
+        return lz4.frame.compress(
+            data, compression_level=0 if level is None else level)
+    raise ValueError('Codec %s not available!' % codec)
+
+def decompress(codec, data, max_length=None):
+    '''Undo compress().
+
+    If max_length is given, data that decompresses to more than that
+    raises ValueError without being decompressed any further.
+    '''
+
+    if codec == 'none':
+        out = data
+    elif max_length is None:
+        out = _decompress(codec, data)
+    elif codec == 'zlib':
+        out = zlib.decompressobj().decompress(data, max_length + 1)
+    elif codec == 'zstd' and zstandard is not None:
+        with zstandard.ZstdDecompressor().stream_reader(
+                io.BytesIO(data)) as reader:
+            out = reader.read(max_length + 1)
+    elif codec == 'lz4' and lz4 is not None:
+        out = lz4.frame.LZ4FrameDecompressor().decompress(
+            data, max_length=max_length + 1)
+    else:
+        raise ValueError('Codec %s not available!' % codec)
+    if max_length is not None and len(out) > max_length:
+        raise ValueError('Decompressed data is over %d bytes!' % max_length)
+    return out
+
+def _decompress(codec, data):
+    '''decompress() with no limit.'''
+
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'lz4' and lz4 is not None:
+        return lz4.frame.decompress(data)
+    raise ValueError('Codec %s not available!' % codec)
+
+def frame(payload):
+    '''Length-prefix a compressed chunk.'''
+    return _FRAME.pack(len(payload)) + payload
+
+def read_frame(stream, max_size=MAX_FRAME_SIZE):
+    '''Read one length-prefixed chunk, or None at the end.'''
+    header = stream.read(_FRAME.size)
+    if not header:
+        return None
+    if len(header) != _FRAME.size:
+        raise ValueError('Frame ended early!')
+    nbytes = _FRAME.unpack(header)[0]
+    if nbytes > max_size:
+        raise ValueError('Frame of %d bytes is too big!' % nbytes)
+    payload = stream.read(nbytes)
+    if len(payload) != nbytes:
+        raise ValueError('Frame ended early!')
+    return payload
+
+def probe_codec(block, preferred='zstd'):
+    '''preferred if a block compresses reasonably well, else 'none'.'''
+
+    if preferred == 'none' or not block:
+        return 'none'
+    if preferred not in available_codecs():
+        logging.info('%s not available, using zlib', preferred)
+        preferred = 'zlib'
+
+    # A fast zlib level is a good enough stand-in for any codec
+    if len(zlib.compress(block, 1)) > (1 - MIN_SAVINGS)*len(block):
+        return 'none'
+    return preferred
+
+def choose_codec(filename, preferred='zstd'):
+    '''Pick a codec for a file by its extension and a quick probe.
+
+    Already-compressed formats are skipped outright; anything else is
+    only compressed if its first block compresses reasonably well.
+    '''
+
+    if preferred == 'none':
+        return 'none'
+    if os.path.splitext(str(filename))[1].lower() in COMPRESSED_EXTENSIONS:
+        return 'none'
+
+    try:
+        with open(str(filename), 'rb') as f:
+            return probe_codec(f.read(PROBE_SIZE), preferred)
+    except OSError:
+        return 'none'
+
+class CompressionStats:
+    '''Running totals of how well compression is doing.
+
+    Shared by every thread compressing or decompressing, so the totals
+    are only touched under a lock.
+    '''
+
+    def __init__(self):
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, raw_bytes, compressed_bytes, seconds):
+        '''Count some more data.'''
+        with self._lock:
+            self.raw_bytes += raw_bytes
+            self.compressed_bytes += compressed_bytes
+            self.seconds += seconds
+
+    @property
+    def ratio(self):
+        '''Compressed size over raw size.'''
+        if not self.raw_bytes:
+            return 1.0
+        return self.compressed_bytes/self.raw_bytes
+
+    def compress(self, codec, data, level=None):
+        '''compress(), keeping track of sizes and time.'''
+        t0 = perf_counter()
+        out = compress(codec, data, level)
+        self.add(len(data), len(out), perf_counter() - t0)
+        return out
+
+    def decompress(self, codec, data, max_length=None):
+        '''decompress(), keeping track of sizes and time.'''
+        t0 = perf_counter()
+        out = decompress(codec, data, max_length)
+        self.add(len(out), len(data), perf_counter() - t0)
+        return out
+
+    def report(self):
+        '''Summary suitable for logging or a response.'''
+        with self._lock:
+            return {
+                'raw_bytes': self.raw_bytes,
+                'compressed_bytes': self.compressed_bytes,
+                'ratio': self.ratio,
+                'seconds': self.seconds,
+            }
+
+# Totals for everything compressed or decompressed in this process
+STATS = CompressionStats()
@@ -2,71 +2,419 @@
 
 import dbm
 import pathlib
+import sqlite3
+import argparse
+import threading
+import contextlib
+
+try:
+    # Load CFFI variant
+    # import os
+    # os.environ['LMDB_FORCE_CFFI'] = '1'
+    import lmdb # pylint: disable=E0401
+except ImportError:
+    lmdb = None
+
+from backupinator.metrics import METRICS
+
+DB_SECONDS = METRICS.histogram(
+    'backupinator_db_batch_seconds',
+    'Time stores are held open (dbm) or in a transaction.', ('backend',))
+
+def _encode(val):
+    '''Keys and values are stored as bytes.'''
+    if isinstance(val, bytes):
+        return val
+    return str(val).encode()
+
+class DBMStore:
+    '''Key/val store on dbm, opened once per operation or batch.
+
+    dbm files can't have more than one writer, so the handle is only
+    kept open for the length of a batch.  Reads outside a batch open
+    the file read-only, so they don't wait on each other.
+    '''
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self._lock = threading.RLock()
+        self._db = None
+
+        # Thread holding the file open in a batch
+        self._owner = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Group operations under a single open of the file.'''
+
+        with self._lock:
+            if self._db is not None:
+                yield self
+                return
+            with DB_SECONDS.time(backend='dbm'), dbm.open(
+                    self.filename, 'c') as db:
+                self._db = db
+                self._owner = threading.get_ident()
+                try:
+                    yield self
+                finally:
+                    self._db = None
+                    self._owner = None
+
+    @contextlib.contextmanager
+    def _reading(self):
+        '''The open file in a batch, else a read-only handle.'''
+
+        if self._owner == threading.get_ident():
+            yield self._db
+            return
+        try:
+            db = dbm.open(self.filename, 'r')
+        except dbm.error:
+            db = None
+
+        # Nothing written yet, or a writer has the file locked
+        if db is None:
+            if dbm.whichdb(self.filename) is None:
+                yield {}
+                return
+            with self.batch():
+                yield self._db
+            return
+        with db:
+            yield db
+
+    def get(self, key, default=None):
+        '''Look up a key, returning default if it isn't there.'''
+        with self._reading() as db:
+            return db.get(_encode(key), default)
+
+    def __getitem__(self, key):
+        with self._reading() as db:
+            return db[_encode(key)]
+
+    def __setitem__(self, key, val):
+        with self.batch():
+            self._db[_encode(key)] = _encode(val)
+
+    def __delitem__(self, key):
+        with self.batch():
+            del self._db[_encode(key)]
+
+    def __contains__(self, key):
+        with self._reading() as db:
+            return _encode(key) in db
+
+    def __len__(self):
+        with self._reading() as db:
+            return len(db)
+
+    def items(self):
+        '''All (key, val) pairs.'''
+        with self._reading() as db:
+            return [(k, db[k]) for k in db.keys()]
+
+    def clear(self):
+        '''Remove everything.'''
+        with self._lock:
+            dbm.open(self.filename, 'n').close()
+
+    def close(self):
+        '''Nothing is held open between batches.'''
+
+class SQLiteStore:
+    '''Key/val store on SQLite in WAL mode with persistent connections.
+
+    Each thread gets its own connection, so readers run concurrently
+    with a writer.  Writes outside a batch are committed right away.
+    '''
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self._local = threading.local()
+
+        # Make sure the table is there before anyone reads
+        with self.batch() as db:
+            db.conn.execute(
+                'CREATE TABLE IF NOT EXISTS kv '
+                '(key BLOB PRIMARY KEY, val BLOB) WITHOUT ROWID')
+
+    @property
+    def conn(self):
+        '''This thread's connection.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Group writes into a single transaction.'''
+
+        conn = self.conn
+        self._local.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._local.depth -= 1
+            if not self._local.depth:
+                conn.rollback()
+            raise
+        self._local.depth -= 1
+        if not self._local.depth:
+            with DB_SECONDS.time(backend='sqlite'):
+                conn.commit()
+
+    def _write(self, sql, args):
+        self.conn.execute(sql, args)
+        if not self._local.depth:
+            self.conn.commit()
+
+    def get(self, key, default=None):
+        '''Look up a key, returning default if it isn't there.'''
+        row = self.conn.execute(
+            'SELECT val FROM kv WHERE key = ?', (_encode(key),)).fetchone()
+        if row is None:
+            return default
+        return bytes(row[0])
+
+    def __getitem__(self, key):
+        val = self.get(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, val):
+        self._write(
+            'INSERT OR REPLACE INTO kv (key, val) VALUES (?, ?)',
+            (_encode(key), _encode(val)))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._write('DELETE FROM kv WHERE key = ?', (_encode(key),))
+
+    def __contains__(self, key):
+        return self.conn.execute(
+            'SELECT 1 FROM kv WHERE key = ?',
+            (_encode(key),)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM kv').fetchone()[0]
+
+    def items(self):
+        '''All (key, val) pairs.'''
+        return [(bytes(k), bytes(v)) for k, v in self.conn.execute(
+            'SELECT key, val FROM kv ORDER BY key')]
+
+    def clear(self):
+        '''Remove everything.'''
+        self._write('DELETE FROM kv', ())
+
+    def close(self):
+        '''Close this thread's connection.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+class LMDBStore:
+    '''Key/val store on LMDB with one long-lived environment.
+
+    Readers never block and never block the writer; a batch is a
+    single write transaction.
+    '''
+
+    def __init__(self, filename, map_size=2**30):
+        if lmdb is None:
+            raise ImportError('lmdb backend requires the lmdb package!')
+
+        dirpath = pathlib.Path(str(filename) + '.lmdb')
+        dirpath.mkdir(parents=True, exist_ok=True)
+        self._env = lmdb.Environment(
+            path=str(dirpath),
+            map_size=map_size,
+            subdir=True,
+            readonly=False,
+            metasync=True,
+            sync=True,
+            map_async=False,
+            mode=493,
+            create=True,
+            readahead=True,
+            writemap=False,
+            meminit=True,
+            max_readers=126,
+            max_dbs=0,
+            max_spare_txns=1,
+            lock=True)
+        self._local = threading.local()
+
+    def _grow(self):
+        '''Double the map size after it fills up.'''
+        self._env.set_mapsize(2*self._env.info()['map_size'])
+
+    @contextlib.contextmanager
+    def _txn(self, write=False):
+        '''Current batch's transaction, or a new one.'''
+        txn = getattr(self._local, 'txn', None)
+        if txn is not None:
+            yield txn
+            return
+        with self._env.begin(write=write) as txn:
+            yield txn
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Group writes into a single transaction.'''
+
+        if getattr(self._local, 'txn', None) is not None:
+            yield self
+            return
+        try:
+            with DB_SECONDS.time(backend='lmdb'), self._env.begin(
+                    write=True) as txn:
+                self._local.txn = txn
+                try:
+                    yield self
+                finally:
+                    self._local.txn = None
+        except lmdb.MapFullError:
+            # Transaction is lost, but the next one will fit
+            self._grow()
+            raise
+
+    def get(self, key, default=None):
+        '''Look up a key, returning default if it isn't there.'''
+        with self._txn() as txn:
+            return txn.get(_encode(key), default=default)
+
+    def __getitem__(self, key):
+        val = self.get(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, val):
+        if getattr(self._local, 'txn', None) is not None:
+            self._local.txn.put(_encode(key), _encode(val), dupdata=False)
+            return
+        try:
+            with self._txn(write=True) as txn:
+                txn.put(_encode(key), _encode(val), dupdata=False)
+        except lmdb.MapFullError:
+            self._grow()
+            with self._txn(write=True) as txn:
+                txn.put(_encode(key), _encode(val), dupdata=False)
+
+    def __delitem__(self, key):
+        with self._txn(write=True) as txn:
+            if not txn.delete(_encode(key)):
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        with self._txn() as txn:
+            return txn.stat()['entries']
+
+    def items(self):
+        '''All (key, val) pairs.'''
+        with self._txn() as txn:
+            return list(txn.cursor().iternext(keys=True, values=True))
+
+    def clear(self):
+        '''Remove everything.'''
+        with self._txn(write=True) as txn:
+            txn.drop(self._env.open_db(), delete=False)
+
+    def close(self):
+        '''Close the environment.'''
+        self._env.close()
+
+BACKENDS = {
+    'dbm': DBMStore,
+    'sqlite': lambda filename: SQLiteStore(str(filename) + '.sqlite'),
+    'lmdb': LMDBStore,
+}
+
+# What other backends add to the base name
+SUFFIXES = {'sqlite': '.sqlite', 'lmdb': '.lmdb'}
+
+def open_store(filename, backend='dbm'):
+    '''Open a key/val store using the given backend.
+
+    filename is the base name; backends other than dbm add their own
+    extension so a store can be migrated next to the old dbm file.  The
+    first time one is opened where there's a dbm file, what the dbm
+    file has is imported.
+    '''
+
+    if backend not in BACKENDS:
+        raise ValueError('Unknown db backend: %s' % backend)
+    pathlib.Path(filename).parents[0].mkdir(parents=True, exist_ok=True)
+    fresh = backend != 'dbm' and not pathlib.Path(
+        str(filename) + SUFFIXES[backend]).exists()
+    store = BACKENDS[backend](filename)
+    if fresh and dbm.whichdb(str(filename)):
+        _import_dbm(filename, store)
+    return store
+
+def _import_dbm(filename, store):
+    '''Copy everything in a dbm file into store.'''
+
+    nkeys = 0
+    with dbm.open(str(filename), 'r') as old, store.batch() as new:
+        for key in old.keys():
+            new[key] = old[key]
+            nkeys += 1
+    return nkeys
+
+def migrate_dbm(filename, backend):
+    '''Copy everything in an existing dbm file into a new store.'''
+    return _import_dbm(filename, BACKENDS[backend](filename))
 
 class DB:
     '''Wrapper for simple key/val database.'''
 
-    def __init__(self, name, dirname='db'):
+    def __init__(self, name, dirname='db', backend='dbm'):
 
         filepath = pathlib.Path(dirname) / name
         filepath.mkdir(parents=True, exist_ok=True)
         self.filename = str(filepath / 'data.dbm')
+        self.store = open_store(self.filename, backend)
+
+    def batch(self):
+        '''Group several operations into one transaction.'''
+        return self.store.batch()
 
     def add(self, key, val):
         '''Add entry to database.'''
-
-        with dbm.open(self.filename, 'c') as db:
-            db[key] = val
+        self.store[key] = val
 
     def get(self, key):
         '''Look up an entry in the database.'''
+        return self.store[key]
+
+    def remove(self, key):
+        '''Remove an entry from the database.'''
+        try:
+            del self.store[key]
+        except KeyError:
+            pass
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Import existing dbm files into another backend.')
+    parser.add_argument('backend', choices=sorted(set(BACKENDS) - {'dbm'}))
+    parser.add_argument('filenames', nargs='+', help='dbm files to import')
+    args = parser.parse_args()
 
-        with dbm.open(self.filename, 'r') as db:
-            return db[key]
-
-# import pathlib
-
-# # Load CFFI variant
-# # import os
-# # os.environ['LMDB_FORCE_CFFI'] = '1'
-# import lmdb # pylint: disable=E0401,C0413
-#
-# class DB:
-#     '''Wrapper for database.'''
-#
-#     def __init__(self, name, dirname='db'):
-#
-#         # The actual database stuffs:
-#         dirpath = pathlib.Path(dirname) / name
-#         dirpath.mkdir(parents=True, exist_ok=True)
-#         self._env = lmdb.Environment(
-#             path=str(dirpath),
-#             map_size=10485760,
-#             subdir=True,
-#             readonly=False,
-#             metasync=True,
-#             sync=True,
-#             map_async=False,
-#             mode=493,
-#             create=True,
-#             readahead=True,
-#             writemap=False,
-#             meminit=True,
-#             max_readers=126,
-#             max_dbs=0,
-#             max_spare_txns=1,
-#             lock=True)
-#
-#
-#     def add(self, key, val):
-#         '''Add an entry to the database.'''
-#
-#         with self._env.begin(write=True) as txn:
-#             txn.put(key.encode(), val.encode(), dupdata=False)
-#
-#
-#     def get(self, key):
-#         '''Look up an entry in the database.'''
-#
-#         with self._env.begin(write=False) as txn:
-#             return txn.get(key.encode(), default=None)
+    for fname in args.filenames:
+        print('%s: imported %d keys' % (fname, migrate_dbm(fname, args.backend)))
@@ -0,0 +1,208 @@
+'''rsync-style block signatures, deltas and patching.'''
+
+import struct
+import hashlib
+from itertools import accumulate
+
+try:
+    import numpy as np # pylint: disable=E0401
+except ImportError:
+    np = None
+
+# Smallest and largest block sizes picked for a file
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 128*1024
+
+# How much of the new file to keep in memory while diffing
+READ_SIZE = 1024*1024
+
+# Longest run of literal data in a single op
+MAX_LITERAL = 256*1024
+
+# Windows whose weak checksums are worked out at once, with numpy
+SCAN_WINDOWS = 64*1024
+
+_COPY = struct.Struct('>cII')
+_DATA = struct.Struct('>cI')
+
+def pick_block_size(filesize):
+    '''About sqrt(filesize), like rsync, rounded to a multiple of 1K.'''
+    block_size = int(filesize**0.5) // 1024 * 1024
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+def weak_checksum(block):
+    '''rsync's rolling checksum as its two 16-bit halves.'''
+    return sum(block) & 0xffff, sum(accumulate(block)) & 0xffff
+
+def weak_checksums(data, block_size):
+    '''weak_checksum() of every block_size window of data, packed like sigs.
+
+    Window k's halves are differences of prefix sums: a is the sum of
+    its bytes and b weighs each byte by how far it is from the end.
+    '''
+
+    x = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+    sums = np.concatenate(([0], np.cumsum(x)))
+    moments = np.concatenate(([0], np.cumsum(x*np.arange(len(x)))))
+    k = np.arange(len(x) - block_size + 1)
+    a = sums[k + block_size] - sums[k]
+    b = (k + block_size)*a - (moments[k + block_size] - moments[k])
+    return (a & 0xffff) | (b & 0xffff) << 16
+
+def strong_checksum(block):
+    '''Collision-resistant hash to confirm a weak match.'''
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+def signatures(f, block_size):
+    '''[weak, strong] for each block of a binary file object.'''
+
+    sigs = []
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return sigs
+        a, b = weak_checksum(block)
+        sigs.append([a | b << 16, strong_checksum(block)])
+
+def iter_delta(f, sigs, block_size):
+    '''Ops that turn the signed file into the contents of f.
+
+    Ops are ('copy', block_index) or ('data', bytes).  Blocks that line
+    up with the old file are matched without rolling, so unchanged and
+    appended-to files are cheap; only changed regions roll byte by byte.
+    With numpy, changed regions skip straight to windows whose weak
+    checksum is in the table instead.
+    '''
+
+    table = {}
+    for ii, (weak, strong) in enumerate(sigs):
+        table.setdefault(weak, {}).setdefault(strong, ii)
+    keys = None
+    if np is not None and table:
+        keys = np.array(sorted(table), dtype=np.int64)
+
+    buf = b''
+    eof = False
+    pos = lit = 0
+    a = b = None
+
+    # First window position scanned with numpy, their weak checksums,
+    # and the positions of those in the table
+    scan = None
+    while True:
+
+        # Keep a full window plus the next byte in the buffer
+        if not eof and len(buf) - pos <= block_size:
+            more = f.read(READ_SIZE)
+            eof = not more
+            buf = buf[lit:] + more
+            pos -= lit
+            lit = 0
+            scan = None
+            continue
+
+        n = min(block_size, len(buf) - pos)
+        if n == 0:
+            break
+        if a is None:
+            a, b = weak_checksum(buf[pos:pos+n])
+
+        candidates = table.get(a | b << 16)
+        if candidates:
+            match = candidates.get(strong_checksum(buf[pos:pos+n]))
+            if match is not None:
+                if lit < pos:
+                    yield 'data', buf[lit:pos]
+                yield 'copy', match
+                pos += n
+                lit = pos
+                a = None
+                continue
+
+        # Don't let literal runs grow without bound
+        if pos - lit >= MAX_LITERAL:
+            yield 'data', buf[lit:pos]
+            lit = pos
+
+        # Skip to the next window that might match, stopping where the
+        # literal run has to be cut or the buffer runs low
+        if keys is not None and n == block_size and pos + n < len(buf):
+            last = len(buf) - block_size
+            if scan is None or not scan[0] <= pos + 1 < scan[0] + len(
+                    scan[1]):
+                start = pos + 1
+                end = min(last + 1, start + SCAN_WINDOWS)
+                weaks = weak_checksums(
+                    buf[start:end + block_size - 1], block_size)
+                found = np.searchsorted(keys, weaks)
+                found = keys[np.minimum(found, len(keys) - 1)] == weaks
+                scan = start, weaks, np.flatnonzero(found) + start
+            start, weaks, hits = scan
+            ii = np.searchsorted(hits, pos + 1)
+            pos = min(
+                int(hits[ii]) if ii < len(hits) else start + len(weaks),
+                last, lit + MAX_LITERAL)
+            if pos < start + len(weaks):
+                weak = int(weaks[pos - start])
+                a, b = weak & 0xffff, weak >> 16
+            else:
+                a = None
+            continue
+
+        # Roll the window forward a byte (or shrink it at the end)
+        out = buf[pos]
+        if n == block_size and pos + n < len(buf):
+            a = (a - out + buf[pos + n]) & 0xffff
+            b = (b - n*out + a) & 0xffff
+        else:
+            a = (a - out) & 0xffff
+            b = (b - n*out) & 0xffff
+        pos += 1
+
+    if lit < pos:
+        yield 'data', buf[lit:pos]
+
+def encode_delta(ops):
+    '''Serialize ops, merging runs of consecutive block copies.'''
+
+    run = None
+    for op, val in ops:
+        if op == 'copy':
+            if run is not None and run[0] + run[1] == val:
+                run[1] += 1
+                continue
+            if run is not None:
+                yield _COPY.pack(b'C', *run)
+            run = [val, 1]
+            continue
+        if run is not None:
+            yield _COPY.pack(b'C', *run)
+            run = None
+        yield _DATA.pack(b'D', len(val)) + val
+    if run is not None:
+        yield _COPY.pack(b'C', *run)
+
+def apply_delta(base, stream, block_size, out):
+    '''Rebuild a file from its old version and a serialized delta.
+
+    Returns the number of bytes written to out.
+    '''
+
+    nbytes = 0
+    while True:
+        tag = stream.read(1)
+        if not tag:
+            return nbytes
+        if tag == b'C':
+            start, count = struct.unpack('>II', stream.read(8))
+            base.seek(start*block_size)
+            data = base.read(count*block_size)
+        elif tag == b'D':
+            length = struct.unpack('>I', stream.read(4))[0]
+            data = stream.read(length)
+            if len(data) != length:
+                raise ValueError('Delta ended early!')
+        else:
+            raise ValueError('Bad delta op %r' % tag)
+        out.write(data)
+        nbytes += len(data)
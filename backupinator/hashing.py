@@ -0,0 +1,115 @@
+'''Hash algorithms that can be chosen by name.
+
+Hashes have three jobs, each configured separately in client.ini:
+
+    name_hash     filename hashes, which identify files on targets
+    change_hash   tree values, used to notice that a file changed
+    content_hash  chunk addresses, shared by every client of a target
+
+Change detection doesn't need a cryptographic hash, so xxh3 is fine
+(and much faster) there.  Content addresses do, and are told apart by
+their length so any algorithm's chunks can be checked without knowing
+which client sent them.  The defaults are what was always used, so
+existing databases and backups stay readable.
+'''
+
+import hashlib
+
+try:
+    import xxhash # pylint: disable=E0401
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3 # pylint: disable=E0401
+except ImportError:
+    blake3 = None
+
+# What was used before algorithms could be chosen
+DEFAULT_HASHES = {
+    'name': 'sha224',
+    'change': 'sha224',
+    'content': 'sha256',
+}
+
+# Length of BLAKE3 content addresses; unlike SHA-256's
+BLAKE3_SIZE = 48
+
+# Digest sizes of every algorithm that can be configured, installed or not
+DIGEST_SIZES = frozenset((28, 32, 64, BLAKE3_SIZE, 8, 16))
+
+class HashProvider:
+    '''A named hash algorithm.'''
+
+    def __init__(self, name, new, digest_size, cryptographic):
+        self.name = name
+        self._new = new
+        self.digest_size = digest_size
+        self.cryptographic = cryptographic
+
+    def new(self):
+        '''A fresh hash object with update() and hexdigest().'''
+        return self._new()
+
+    def hexdigest(self, data):
+        '''Hex digest of some bytes.'''
+        return self._new(data).hexdigest()
+
+class _Blake3:
+    '''BLAKE3 giving BLAKE3_SIZE bytes of output.'''
+
+    def __init__(self, data=b''):
+        self._h = blake3.blake3(data)
+
+    def update(self, data):
+        self._h.update(data)
+
+    def hexdigest(self):
+        return self._h.hexdigest(length=BLAKE3_SIZE)
+
+def _providers():
+    '''Every algorithm that can be used here.'''
+
+    providers = [
+        HashProvider('sha224', hashlib.sha224, 28, True),
+        HashProvider('sha256', hashlib.sha256, 32, True),
+        HashProvider('blake2b', hashlib.blake2b, 64, True),
+    ]
+    if blake3 is not None:
+        providers.append(HashProvider('blake3', _Blake3, BLAKE3_SIZE, True))
+    if xxhash is not None:
+        providers.append(HashProvider('xxh3', xxhash.xxh3_64, 8, False))
+        providers.append(HashProvider('xxh128', xxhash.xxh3_128, 16, False))
+    return {p.name: p for p in providers}
+
+PROVIDERS = _providers()
+
+# Content addresses are recognized by their length
+_CONTENT_BY_SIZE = {
+    p.digest_size: p for p in PROVIDERS.values() if p.cryptographic}
+
+def get_hash(name):
+    '''Provider of an algorithm by name.'''
+    try:
+        return PROVIDERS[name]
+    except KeyError:
+        raise ValueError('Hash %s is unknown or not installed!' % name)
+
+def content_hash_for(digest):
+    '''Provider that made a content address.'''
+    try:
+        return _CONTENT_BY_SIZE[len(digest)//2]
+    except KeyError:
+        raise ValueError('No content hash makes %d digits!' % len(digest))
+
+def check_hashes(hashes):
+    '''Fill in defaults and make sure the algorithms will do.'''
+
+    hashes = dict(DEFAULT_HASHES, **{
+        k: v for k, v in (hashes or {}).items() if v})
+    for role, name in hashes.items():
+        provider = get_hash(name)
+        if role == 'content' and (
+                _CONTENT_BY_SIZE.get(provider.digest_size) is not provider):
+            raise ValueError('%s cannot be used for content!' % name)
+    return hashes
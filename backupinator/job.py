@@ -1,15 +1,34 @@
 '''Encapuslation of a job.'''
 
+import abc
+import json
 import uuid
-import hashlib
-import base64
-
+import struct
 import requests
 import jsons # pylint: disable=E0401
 
+from backupinator.compression import STATS, frame
+from backupinator.delta import encode_delta, iter_delta
+from backupinator.hashing import DEFAULT_HASHES, get_hash
+
 __all__ = [
-    'Job', 'BatchJob', 'RegisterClientJob', 'CheckinClientJob',
-    'GetTreeJob', 'SendFileJob']
+    'Job', 'BatchJob', 'RegisterClientJob', 'OpenSessionJob',
+    'CheckinClientJob',
+    'StreamingJob', 'GetTreeJob', 'SendFileJob', 'QueryChunksJob',
+    'SendChunksJob', 'SendDeltaJob', 'PullJob', 'FetchJob', 'AckJob',
+    'RegisterTargetJob',
+    'read_job_prefix', 'read_job_prefix_async',
+    'CHUNK_SIZE']
+
+# Streamed bodies start with the job metadata, length-prefixed
+_PREFIX = struct.Struct('>I')
+
+# Size of each binary chunk when streaming file uploads
+CHUNK_SIZE = 1024*1024
+
+def _filename_hash(filename):
+    '''Filename hash with the default algorithm.'''
+    return get_hash(DEFAULT_HASHES['name']).hexdigest(filename.encode())
 
 class Job:
     '''A task to be done by client or target.'''
@@ -27,25 +46,86 @@ class Job:
         # for our purposes)
         self.uuid = uuid.uuid4()
 
-    def submit(self):
-        '''Send the job to the server and return response.'''
-
-        # Make sure to send files if we have any
-        post_opts = {
-            'json': jsons.dump(self)
+    def post_opts(self):
+        '''Keyword arguments used to POST this job.'''
+        return {
+            'json': jsons.dump(self, strip_privates=True)
         }
-        # if hasattr(self, 'files'):
-        #     post_opts['files']: getattr(self, 'files')
-        #     delattr(self, 'files') # so it's not serialized...
+
+    def submit(self, transport=None, sign=None):
+        '''Send the job to the server and return response.
+
+        sign is called for the job's auth before each attempt.
+        '''
+
+        # Reuse pooled connections if we have them
+        if transport is not None:
+            return transport.submit(self, sign=sign)
+        if sign is not None:
+            self.auth = sign()
 
         # Send a POST with this job
-        return requests.post(self.server_address, **post_opts)
+        return requests.post(self.server_address, **self.post_opts())
+
+class StreamingJob(Job, abc.ABC):
+    '''A job whose bulk data is streamed as raw bytes after its metadata.'''
+
+    @abc.abstractmethod
+    def iter_chunks(self):
+        '''Yield the raw data to send after the job metadata.'''
+
+    def iter_body(self, meta=None):
+        '''Length-prefixed job metadata followed by the raw data.'''
+        if meta is None:
+            meta = json.dumps(jsons.dump(self, strip_privates=True)).encode()
+        yield _PREFIX.pack(len(meta)) + meta
+
+        # A scheduler may hold the upload to a bandwidth limit
+        throttle = getattr(self, '_throttle', None)
+        for chunk in self.iter_chunks():
+            if throttle is not None:
+                throttle(len(chunk))
+            yield chunk
+
+    def post_opts(self):
+        '''Stream the body instead of sending JSON.'''
+        return {
+            'data': self.iter_body(),
+            'headers': {'Content-Type': 'application/octet-stream'},
+        }
+
+def read_job_prefix(stream):
+    '''Read the raw job metadata from the front of a streamed body.'''
+
+    nbytes = _PREFIX.unpack(stream.read(_PREFIX.size))[0]
+    return stream.read(nbytes)
+
+async def read_job_prefix_async(stream):
+    '''Read the raw job metadata from the front of an async streamed body.'''
+
+    async def read_exactly(nbytes):
+        buf = b''
+        while len(buf) < nbytes:
+            chunk = await stream.read(nbytes - len(buf))
+            if not chunk:
+                raise ValueError('Body ended early!')
+            buf += chunk
+        return buf
+
+    nbytes = _PREFIX.unpack(await read_exactly(_PREFIX.size))[0]
+    return await read_exactly(nbytes)
 
 class BatchJob(Job):
-    '''A group of job objects to be sent to the server all at once.'''
+    '''A group of job objects to be sent to the server all at once.
 
-    def __init__(self, server_address):
+    If client_name and auth are given, the batch is authenticated once
+    and vouches for all of that client's jobs in it.
+    '''
+
+    def __init__(self, server_address, client_name=None, auth=None):
         self.jobs = []
+        self.client_name = client_name
+        self.auth = auth
 
         # Call parent's init
         super(BatchJob, self).__init__(server_address)
@@ -66,6 +146,29 @@ class RegisterClientJob(Job):
         # Call parent's init
         super(RegisterClientJob, self).__init__(server_address)
 
+class RegisterTargetJob(Job):
+    '''Register a target's key'''
+
+    def __init__(self, server_address, target_name, rsa_pub_key, auth):
+
+        self.target_name = target_name
+        self.rsa_pub_key = rsa_pub_key
+        self.auth = auth
+
+        # Call parent's init
+        super(RegisterTargetJob, self).__init__(server_address)
+
+class OpenSessionJob(Job):
+    '''Trade an RSA signature for a short-lived session key.'''
+
+    def __init__(self, server_address, client_name, auth):
+
+        self.client_name = client_name
+        self.auth = auth
+
+        # Call parent's init
+        super(OpenSessionJob, self).__init__(server_address)
+
 class CheckinClientJob(Job):
     '''Check client in.'''
 
@@ -79,21 +182,32 @@ class CheckinClientJob(Job):
         super(CheckinClientJob, self).__init__(server_address)
 
 class GetTreeJob(Job):
-    '''Get the target's tree to send to client.'''
+    '''Get the target's tree to send to client.
+
+    The tree comes back as the Merkle nodes at the given prefixes (just
+    the root by default).  If filename_hashes is given, the block
+    signatures of those files are asked for instead (see SendDeltaJob).
+    '''
 
-    def __init__(self, server_address, client_name, target_name, auth):
+    def __init__(self, server_address, client_name, target_name, auth,
+                 filename_hashes=None, prefixes=None):
 
         self.client_name = client_name
         self.target_name = target_name
         self.auth = auth
+        self.filename_hashes = filename_hashes
+        self.prefixes = prefixes
 
         # Call parent's init
         super(GetTreeJob, self).__init__(server_address)
 
-class SendFileJob(Job):
+class SendFileJob(StreamingJob):
     '''Get file from client and send to server for a target.'''
 
-    def __init__(self, server_address, client_name, target_name, filename, auth):
+    def __init__(
+            self, server_address, client_name, target_name, filename, auth,
+            chunk_size=CHUNK_SIZE, codec='none', tree_value=None,
+            mtime=None, filename_hash=None, hashes=None):
 
         self.client_name = client_name
         self.target_name = target_name
@@ -101,10 +215,192 @@ class SendFileJob(Job):
 
         # Calculate hash of filename
         self.filename = filename
-        self.filename_hash = hashlib.sha224(self.filename.encode()).hexdigest()
+        self.filename_hash = filename_hash or _filename_hash(filename)
+
+        # File data is streamed at submit time, not held in the job
+        self.chunk_size = chunk_size
+
+        # Chunks are compressed and framed unless codec is 'none'
+        self.codec = codec
+
+        # Value of the file in the client's tree, for the Merkle summary
+        self.tree_value = tree_value
+
+        # Modification time to give the file back when it's restored
+        self.mtime = mtime
 
-        # Get the file data and encode as base64
-        with open(filename, 'rb') as f:
-            self.data = base64.b64encode(f.read()).decode()
+        # Hash algorithms the client uses, by role (None for defaults)
+        self.hashes = hashes
 
         super(SendFileJob, self).__init__(server_address)
+
+    def iter_chunks(self):
+        '''Read the file as fixed-size binary chunks.'''
+
+        # Chunks already read for another target (only used once, so a
+        # retry reads the file itself)
+        source = getattr(self, '_source', None)
+        if source is not None:
+            self._source = None
+            yield from source
+            return
+
+        with open(self.filename, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                if self.codec != 'none':
+                    chunk = frame(STATS.compress(self.codec, chunk))
+                yield chunk
+
+class QueryChunksJob(Job):
+    '''Ask which chunks a target is missing.'''
+
+    def __init__(self, server_address, client_name, target_name,
+                 chunk_hashes, auth):
+
+        self.client_name = client_name
+        self.target_name = target_name
+        self.chunk_hashes = chunk_hashes
+        self.auth = auth
+
+        super(QueryChunksJob, self).__init__(server_address)
+
+class SendChunksJob(StreamingJob):
+    '''Send a file's chunk manifest and the chunks a target is missing.'''
+
+    def __init__(self, server_address, client_name, target_name, filename,
+                 chunks, missing, auth, codec='none', tree_value=None,
+                 mtime=None, filename_hash=None, hashes=None):
+
+        self.client_name = client_name
+        self.target_name = target_name
+        self.auth = auth
+
+        self.filename = filename
+        self.filename_hash = filename_hash or _filename_hash(filename)
+
+        # Every chunk of the file in order as [hash, offset, length]
+        self.chunks = chunks
+
+        # Hashes of the chunks included in the body, in body order
+        self.missing = missing
+
+        # Chunks are compressed and framed unless codec is 'none'
+        self.codec = codec
+
+        # Value of the file in the client's tree, for the Merkle summary
+        self.tree_value = tree_value
+
+        # Modification time to give the file back when it's restored
+        self.mtime = mtime
+
+        # Hash algorithms the client uses, by role (None for defaults)
+        self.hashes = hashes
+
+        super(SendChunksJob, self).__init__(server_address)
+
+    def iter_chunks(self):
+        '''Read only the missing chunks from the file.'''
+
+        missing = set(self.missing)
+        with open(self.filename, 'rb') as f:
+            for digest, offset, length in self.chunks:
+                if digest in missing:
+                    missing.remove(digest)
+                    f.seek(offset)
+                    chunk = f.read(length)
+                    if self.codec != 'none':
+                        chunk = frame(STATS.compress(self.codec, chunk))
+                    yield chunk
+
+class SendDeltaJob(StreamingJob):
+    '''Send only the differences between a file and its last backup.
+
+    The body is a delta (see backupinator.delta) against the copy the
+    base signatures describe; signatures of the new version are sent
+    along so the next delta can be made against it.
+    '''
+
+    def __init__(self, server_address, client_name, target_name, filename,
+                 block_size, base_signatures, size, signature_block_size,
+                 signatures, auth, tree_value=None, mtime=None,
+                 filename_hash=None, hashes=None):
+
+        self.client_name = client_name
+        self.target_name = target_name
+        self.auth = auth
+
+        self.filename = filename
+        self.filename_hash = filename_hash or _filename_hash(filename)
+
+        # Block size of the old copy, which the delta refers to
+        self.block_size = block_size
+
+        # Only needed here to make the delta, so not sent
+        self._base_signatures = base_signatures
+
+        # Size and block signatures of the new version
+        self.size = size
+        self.signature_block_size = signature_block_size
+        self.signatures = signatures
+
+        # Value of the file in the client's tree, for the Merkle summary
+        self.tree_value = tree_value
+
+        # Modification time to give the file back when it's restored
+        self.mtime = mtime
+
+        # Hash algorithms the client uses, by role (None for defaults)
+        self.hashes = hashes
+
+        super(SendDeltaJob, self).__init__(server_address)
+
+    def iter_chunks(self):
+        '''Diff the file against the base signatures as it's sent.'''
+
+        # A scheduler may hand us a reader shared with other uploads
+        source = getattr(self, '_open', None)
+        with (source() if source is not None else open(
+                self.filename, 'rb')) as f:
+            yield from encode_delta(iter_delta(
+                f, self._base_signatures, self.block_size))
+
+class PullJob(Job):
+    '''Target asks for uploads waiting for it, waiting if there are none.'''
+
+    def __init__(self, server_address, target_name, auth, limit=64, wait=0):
+
+        self.target_name = target_name
+        self.auth = auth
+
+        # At most limit uploads, long-polling up to wait seconds
+        self.limit = limit
+        self.wait = wait
+
+        super(PullJob, self).__init__(server_address)
+
+class FetchJob(Job):
+    '''Target downloads a spooled upload (by seq) or chunks.'''
+
+    def __init__(self, server_address, target_name, auth, seq=None,
+                 chunk_hashes=None):
+
+        self.target_name = target_name
+        self.auth = auth
+        self.seq = seq
+        self.chunk_hashes = chunk_hashes
+
+        super(FetchJob, self).__init__(server_address)
+
+class AckJob(Job):
+    '''Target says uploads are stored so the server can drop them.'''
+
+    def __init__(self, server_address, target_name, seqs, auth):
+
+        self.target_name = target_name
+        self.seqs = seqs
+        self.auth = auth
+
+        super(AckJob, self).__init__(server_address)
@@ -0,0 +1,120 @@
+'''Disk-backed queues of jobs waiting to go to each target.'''
+
+import json
+import pathlib
+import sqlite3
+import threading
+from time import time
+
+import jsons # pylint: disable=E0401
+
+from backupinator import wire
+
+def dump_job(job):
+    '''Job as bytes for storage, binary if it has a wire schema.'''
+    if wire.has_schema(job):
+        return wire.dump_job(job)
+    return json.dumps(jsons.dump(job, strip_privates=True)).encode()
+
+class JobQueue:
+    '''Per-target FIFO queues of jobs on SQLite in WAL mode.
+
+    Jobs for a file are keyed by its path so only the newest one is
+    kept.  Jobs stay on disk until acked, so nothing is lost if the
+    client dies mid-send, and they're read back a batch at a time.
+    '''
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        pathlib.Path(self.filename).parents[0].mkdir(
+            parents=True, exist_ok=True)
+        self._local = threading.local()
+
+        with self.conn as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'target TEXT NOT NULL, key TEXT NOT NULL, '
+                'enqueued REAL NOT NULL, job BLOB NOT NULL, '
+                'UNIQUE (target, key))')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_by_target '
+                'ON jobs (target, seq)')
+
+    @property
+    def conn(self):
+        '''This thread's connection.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def put(self, target, job):
+        '''Queue a job, replacing any older one for the same file.'''
+
+        key = getattr(job, 'filename', None) or str(job.uuid)
+        with self.conn as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO jobs (target, key, enqueued, job) '
+                'VALUES (?, ?, ?, ?)', (target, key, time(), dump_job(job)))
+
+    def peek(self, target, limit=100):
+        '''Up to limit of the oldest (seq, job) for a target.'''
+
+        rows = self.conn.execute(
+            'SELECT seq, job FROM jobs WHERE target = ? ORDER BY seq LIMIT ?',
+            (target, limit)).fetchall()
+        return [(seq, wire.load_job(bytes(data))) for seq, data in rows]
+
+    def ack(self, seq):
+        '''Done with a job (a newer one for its file has a new seq).'''
+        with self.conn as conn:
+            conn.execute('DELETE FROM jobs WHERE seq = ?', (seq,))
+
+    def iter_jobs(self, target, batch=100):
+        '''Every queued job for a target, oldest first.'''
+
+        last = -1
+        while True:
+            rows = self.conn.execute(
+                'SELECT seq, job FROM jobs WHERE target = ? AND seq > ? '
+                'ORDER BY seq LIMIT ?', (target, last, batch)).fetchall()
+            if not rows:
+                return
+            for seq, data in rows:
+                yield seq, wire.load_job(bytes(data))
+            last = rows[-1][0]
+
+    def depth(self, target):
+        '''Number of jobs waiting for a target.'''
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM jobs WHERE target = ?',
+            (target,)).fetchone()[0]
+
+    def age(self, target):
+        '''Seconds the oldest job for a target has been waiting.'''
+        row = self.conn.execute(
+            'SELECT enqueued FROM jobs WHERE target = ? ORDER BY seq LIMIT 1',
+            (target,)).fetchone()
+        return 0.0 if row is None else time() - row[0]
+
+    def stats(self, targets):
+        '''Depth and age of each target's queue.'''
+        return {
+            target: {'depth': self.depth(target), 'age': self.age(target)}
+            for target in targets}
+
+    def clear(self, target):
+        '''Drop everything queued for a target.'''
+        with self.conn as conn:
+            conn.execute('DELETE FROM jobs WHERE target = ?', (target,))
+
+    def close(self):
+        '''Close this thread's connection.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,203 @@
+'''Merkle summaries of trees for cheap comparison.'''
+
+import json
+import hashlib
+import contextlib
+
+# Keys are spread over 16**DEPTH buckets
+DEPTH = 4
+
+_NIBBLES = '0123456789abcdef'
+
+def _digest(lines):
+    '''Hash of a node from the sorted lines describing it.'''
+    return hashlib.sha256('\n'.join(lines).encode()).hexdigest()
+
+def _str(val):
+    '''Store values come back as bytes.'''
+    if isinstance(val, bytes):
+        return val.decode()
+    return val
+
+class MerkleTree:
+    '''Hash tree over a flat {key: val} map with hex-digest keys.
+
+    Keys are grouped into buckets by their first depth hex digits.  A
+    bucket is hashed from its entries and every node above it from its
+    children's hashes, so two trees are compared from the root down,
+    only descending where the hashes differ.
+    '''
+
+    def __init__(self, store, depth=DEPTH):
+        self.store = store
+        self.depth = depth
+
+        # Buckets changed in the current batch
+        self._buckets = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Group updates, rehashing each changed node once at the end.'''
+
+        if self._buckets is not None:
+            yield self
+            return
+
+        self._buckets = {}
+        try:
+            with self.store.batch():
+                yield self
+                self._flush()
+        finally:
+            self._buckets = None
+
+    def _bucket(self, prefix):
+        '''Entries of a bucket, cached for the rest of a batch.'''
+
+        if self._buckets is not None and prefix in self._buckets:
+            return self._buckets[prefix]
+        val = self.store.get('b:' + prefix)
+        entries = {} if val is None else json.loads(val)
+        if self._buckets is not None:
+            self._buckets[prefix] = entries
+        return entries
+
+    def _set_hash(self, prefix, lines):
+        '''Store a node's hash, or drop the node if it's empty.'''
+
+        key = 'n:' + prefix
+        if lines:
+            self.store[key] = _digest(lines)
+        elif key in self.store:
+            del self.store[key]
+
+    def _flush(self):
+        '''Write changed buckets and rehash the nodes above them.'''
+
+        dirty = set()
+        for prefix, entries in self._buckets.items():
+            if entries:
+                self.store['b:' + prefix] = json.dumps(entries)
+            elif 'b:' + prefix in self.store:
+                del self.store['b:' + prefix]
+            self._set_hash(prefix, [
+                '%s=%s' % item for item in sorted(entries.items())])
+            dirty.add(prefix)
+
+        for _level in range(self.depth):
+            dirty = {prefix[:-1] for prefix in dirty}
+            for prefix in dirty:
+                self._set_hash(prefix, [
+                    '%s=%s' % item
+                    for item in sorted(self.children(prefix).items())])
+
+    def update(self, key, val):
+        '''Set a key's value, or remove the key if val is None.'''
+
+        with self.batch():
+            entries = self._bucket(key[:self.depth])
+            if val is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = _str(val)
+
+    def remove(self, key):
+        '''Remove a key if it's there.'''
+        self.update(key, None)
+
+    def rebuild(self, items):
+        '''Start over from (key, val) pairs.'''
+
+        self.store.clear()
+        with self.batch():
+            for key, val in items:
+                self.update(_str(key), val)
+
+    def clear(self):
+        '''Remove everything.'''
+        self.store.clear()
+
+    def get_hash(self, prefix):
+        '''Hash of the node at prefix, None if it's empty.'''
+        return _str(self.store.get('n:' + prefix))
+
+    def root(self):
+        '''Hash of the whole tree.'''
+        return self.get_hash('')
+
+    def children(self, prefix):
+        '''{nibble: hash} of a node's non-empty children.'''
+
+        children = {}
+        for nibble in _NIBBLES:
+            val = self.get_hash(prefix + nibble)
+            if val is not None:
+                children[nibble] = val
+        return children
+
+    def node(self, prefix):
+        '''A node's hash with its children's, or a bucket's entries.'''
+
+        val = self.get_hash(prefix)
+        if val is None:
+            return None
+        if len(prefix) >= self.depth:
+            return {'hash': val, 'entries': self._bucket(prefix)}
+        return {'hash': val, 'children': self.children(prefix)}
+
+    def nodes(self, prefixes):
+        '''{prefix: node} for a level of a comparison.'''
+        return {prefix: self.node(prefix) for prefix in prefixes}
+
+    def keys(self, prefix=''):
+        '''Every key under a node.'''
+
+        if len(prefix) >= self.depth:
+            return list(self._bucket(prefix))
+        keys = []
+        for nibble in self.children(prefix):
+            keys += self.keys(prefix + nibble)
+        return keys
+
+def diff(tree, fetch):
+    '''Compare a tree against a remote one, a level at a time.
+
+    fetch(prefixes) returns the remote {prefix: node} as given by
+    MerkleTree.nodes.  Returns the keys whose values differ or that the
+    remote doesn't have, and the keys only the remote has.
+    '''
+
+    changed = []
+    extra = []
+    prefixes = ['']
+    while prefixes:
+        remote = fetch(prefixes)
+        next_prefixes = []
+        for prefix in prefixes:
+            mine = tree.node(prefix)
+            theirs = remote.get(prefix)
+            if mine is not None and theirs is not None and (
+                    mine['hash'] == theirs['hash']):
+                continue
+
+            # Nothing on the other side, no need to ask about it
+            if theirs is None:
+                if mine is not None:
+                    changed += tree.keys(prefix)
+                continue
+
+            if 'entries' in theirs:
+                entries = {} if mine is None else mine['entries']
+                changed += [
+                    k for k, v in entries.items()
+                    if theirs['entries'].get(k) != v]
+                extra += [k for k in theirs['entries'] if k not in entries]
+                continue
+
+            children = {} if mine is None else mine['children']
+            for nibble in sorted(set(children) | set(theirs['children'])):
+                if children.get(nibble) != theirs['children'].get(nibble):
+                    next_prefixes.append(prefix + nibble)
+        prefixes = next_prefixes
+
+    return changed, extra
@@ -0,0 +1,233 @@
+'''Counters, gauges and histograms, and optional request tracing.
+
+Metrics are kept in memory, cheaply enough to update on every job, and
+rendered in the Prometheus text format: the server serves them at
+/metrics, clients and targets write them to a file now and then.
+
+Tracing is off unless BACKUPINATOR_TRACE=1 (or enable_tracing() is
+called).  A trace id then follows a file from the client through the
+server to the target, and each span is logged to backupinator.trace.
+Request/response dumps are only logged if BACKUPINATOR_DUMP_PAYLOADS=1.
+'''
+
+import os
+import abc
+import uuid
+import logging
+import pathlib
+import threading
+import contextlib
+from time import perf_counter
+
+# Upper bounds of histogram buckets
+TIME_BUCKETS = (
+    .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = tuple(1024*4**ii for ii in range(11))
+
+# Header the trace id is sent in
+TRACE_HEADER = 'X-Backupinator-Trace'
+
+TRACING = os.environ.get('BACKUPINATOR_TRACE', '0') not in ('', '0')
+DUMP_PAYLOADS = os.environ.get(
+    'BACKUPINATOR_DUMP_PAYLOADS', '0') not in ('', '0')
+
+TRACE_LOG = logging.getLogger('backupinator.trace')
+
+def _escape(val):
+    return str(val).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+class Metric(abc.ABC):
+    '''A named family of values, one per combination of labels.'''
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(l, '')) for l in self.labels)
+
+    def _label_str(self, key, extra=None):
+        pairs = ['%s="%s"' % (l, _escape(v)) for l, v in zip(self.labels, key)]
+        if extra is not None:
+            pairs.append('%s="%s"' % extra)
+        return '{%s}' % ','.join(pairs) if pairs else ''
+
+    @abc.abstractmethod
+    def samples(self):
+        '''(suffix, labels, value) of everything recorded.'''
+
+    def render(self):
+        '''Lines in the Prometheus text format.'''
+        lines = [
+            '# HELP %s %s' % (self.name, self.description),
+            '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, labels, val in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels, repr(val)))
+        return lines
+
+class Counter(Metric):
+    '''A count that only goes up.'''
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        '''Add to the count.'''
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        '''Current count.'''
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [('', self._label_str(key), val) for key, val in items]
+
+class Gauge(Counter):
+    '''A value that can go up and down.'''
+
+    kind = 'gauge'
+
+    def set(self, val, **labels):
+        '''Set the value.'''
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = val
+
+class Histogram(Metric):
+    '''Counts of observations in buckets, with their count and sum.'''
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=TIME_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, val, **labels):
+        '''Record one observation.'''
+
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0]*len(self.buckets) + [0, 0.0]
+            for ii, bound in enumerate(self.buckets):
+                if val <= bound:
+                    counts[ii] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += val
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        '''Observe how long the block takes.'''
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - t0, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        samples = []
+        for key, counts in items:
+
+            # Buckets are cumulative in the output
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                samples.append(('_bucket', self._label_str(
+                    key, ('le', bound)), total))
+            labels = self._label_str(key)
+            samples.append(('_count', labels, counts[-2]))
+            samples.append(('_sum', labels, counts[-1]))
+        return samples
+
+class Registry:
+    '''All the metrics of a process, by name.'''
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, description, labels=()):
+        '''Get or make a counter.'''
+        return self._get(Counter, name, description, labels)
+
+    def gauge(self, name, description, labels=()):
+        '''Get or make a gauge.'''
+        return self._get(Gauge, name, description, labels)
+
+    def histogram(self, name, description, labels=(), buckets=TIME_BUCKETS):
+        '''Get or make a histogram.'''
+        return self._get(Histogram, name, description, labels, buckets)
+
+    def render(self):
+        '''Every metric in the Prometheus text format.'''
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for _name, metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        '''Save the metrics for a textfile collector to pick up.'''
+        filename = pathlib.Path(filename)
+        partial = filename.with_name(filename.name + '.part')
+        with open(str(partial), 'w') as f:
+            f.write(self.render())
+        os.replace(str(partial), str(filename))
+
+# The process-wide registry
+METRICS = Registry()
+
+_trace = threading.local()
+
+def enable_tracing(enabled=True):
+    '''Turn span tracing on or off.'''
+    global TRACING # pylint: disable=W0603
+    TRACING = enabled
+
+def current_trace():
+    '''Id of the trace being recorded on this thread, if any.'''
+    return getattr(_trace, 'trace_id', None)
+
+@contextlib.contextmanager
+def span(name, trace_id=None, **attrs):
+    '''Log how long the block takes as part of a trace.
+
+    The span joins trace_id if given, else the trace already running
+    on this thread, else starts a new trace.  Yields the trace id (None
+    if tracing is off).
+    '''
+
+    if not TRACING:
+        yield None
+        return
+
+    parent = current_trace()
+    _trace.trace_id = trace_id or parent or uuid.uuid4().hex[:16]
+    t0 = perf_counter()
+    try:
+        yield _trace.trace_id
+    finally:
+        TRACE_LOG.info(
+            'trace=%s span=%s ms=%.3f %s', _trace.trace_id, name,
+            1e3*(perf_counter() - t0), attrs)
+        _trace.trace_id = parent
@@ -0,0 +1,151 @@
+'''Append-only pack files holding many small objects each.'''
+
+import os
+import mmap
+import pathlib
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windows; only one process may write to a pack directory there
+    fcntl = None
+
+# Start a new pack once the current one is this big
+PACK_SIZE = 256*1024*1024
+
+@contextlib.contextmanager
+def _locked(f):
+    '''Hold an exclusive lock on an open file, where that's possible.'''
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class PackStore:
+    '''Objects appended to a few large files instead of one file each.
+
+    An object is found again by (pack, offset, length), which callers
+    keep in their own index.  Writes in a batch share a single fsync
+    per pack at the end, so callers should only index what they wrote
+    once the batch is over.  Reads go through mmap.  Several processes
+    can append to the same packs: each append holds a lock on the pack
+    and goes wherever its end is by then.
+    '''
+
+    def __init__(self, dirname, pack_size=PACK_SIZE):
+        self.dirname = pathlib.Path(dirname)
+        self.dirname.mkdir(parents=True, exist_ok=True)
+        self.pack_size = pack_size
+        self._lock = threading.RLock()
+
+        # Pack being appended to
+        self._pack = max(self.packs(), default=0)
+        self._f = None
+
+        # Packs written to since the last sync
+        self._dirty = {}
+        self._depth = 0
+
+        # pack -> mmap of it
+        self._maps = {}
+
+    def pack_filename(self, pack):
+        '''Where a pack lives.'''
+        return self.dirname / ('%06d.pack' % pack)
+
+    def packs(self):
+        '''Numbers of the packs there are.'''
+        return sorted(int(p.stem) for p in self.dirname.glob('*.pack'))
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Group appends, syncing them once at the end.'''
+
+        with self._lock:
+            self._depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._depth -= 1
+                if not self._depth:
+                    self.sync()
+
+    def _current(self, nbytes):
+        '''Pack to append nbytes to, starting a new one if it's full.'''
+
+        size = 0
+        if self._f is not None:
+            size = os.fstat(self._f.fileno()).st_size
+        if size and size + nbytes > self.pack_size:
+            self.sync()
+            self._f.close()
+            self._f = None
+            self._pack += 1
+        if self._f is None:
+            self._pack = max(self._pack, 1)
+            self._f = open(str(self.pack_filename(self._pack)), 'ab')
+        return self._f
+
+    def append(self, data):
+        '''Add an object, returning (pack, offset) of where it went.'''
+
+        with self._lock:
+            f = self._current(len(data))
+            with _locked(f):
+                offset = os.fstat(f.fileno()).st_size
+                f.write(data)
+                f.flush()
+            self._dirty[self._pack] = f
+            if not self._depth:
+                self.sync()
+            return self._pack, offset
+
+    def sync(self):
+        '''Make everything appended so far durable.'''
+
+        with self._lock:
+            for f in self._dirty.values():
+                f.flush()
+                os.fsync(f.fileno())
+            self._dirty = {}
+
+    def read(self, pack, offset, length):
+        '''An object's bytes.'''
+
+        if not length:
+            return b''
+        with self._lock:
+            # Appends may still be buffered
+            if pack in self._dirty:
+                self._dirty[pack].flush()
+
+            # Map again if the pack has grown since it was mapped
+            m = self._maps.get(pack)
+            if m is None or len(m) < offset + length:
+                if m is not None:
+                    m.close()
+                with open(str(self.pack_filename(pack)), 'rb') as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[pack] = m
+            if len(m) < offset + length:
+                raise ValueError('Pack %d is too short!' % pack)
+            return m[offset:offset + length]
+
+    def close(self):
+        '''Sync and let go of open files and maps.'''
+
+        with self._lock:
+            self.sync()
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+            for m in self._maps.values():
+                m.close()
+            self._maps = {}
@@ -0,0 +1,167 @@
+'''Restoring backed-up files from a target's store.'''
+
+import os
+import logging
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from backupinator.chunking import check_chunk
+
+def dest_path(dest, filename):
+    '''Where a file goes under dest, refusing to put it anywhere else.'''
+
+    _drive, rel = os.path.splitdrive(os.path.normpath(filename))
+    path = os.path.normpath(os.path.join(dest, rel.lstrip('\\/')))
+    if os.path.commonpath([dest, path]) != dest:
+        raise ValueError('%s is outside of %s' % (filename, dest))
+    return path
+
+def parse_time(val):
+    '''Seconds since the epoch or an ISO date, as seconds.'''
+    try:
+        return float(val)
+    except ValueError:
+        return datetime.fromisoformat(val).timestamp()
+
+class Restorer:
+    '''Write a client's files back out of a target's chunk store.
+
+    Files are written by a pool of workers, a chunk at a time so memory
+    stays bounded, and in the order their data sits in the packs so
+    reads stay mostly sequential.  Files already there with the same
+    contents are left alone.
+    '''
+
+    def __init__(self, target_db, chunk_store, workers=8):
+        self.target_db = target_db
+        self.chunk_store = chunk_store
+        self.workers = workers
+
+    def plan(self, client_name, prefix='', at=None):
+        '''Files to restore as {filename, mtime, chunks}, in disk order.'''
+
+        entries = []
+        nameless = 0
+        for filename_hash, info in self.target_db.iter_files(client_name):
+            filename = info.get('filename')
+            if filename is None:
+                nameless += 1
+                continue
+            if not filename.startswith(prefix):
+                continue
+            version = self.target_db.get_version(
+                client_name, filename_hash, at)
+            if version is None:
+                continue
+            _time, mtime, chunks = version
+            entries.append({
+                'filename': filename,
+                'mtime': mtime,
+                'chunks': chunks,
+            })
+        if nameless:
+            logging.info('%d files were backed up without names', nameless)
+
+        entries.sort(key=lambda e: self.chunk_store.location(
+            e['chunks'][0][0]) if e['chunks'] else (0, 0))
+        return entries
+
+    @staticmethod
+    def is_identical(path, entry):
+        '''Whether the file at path already has the entry's contents.'''
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_size != sum(length for _digest, length in entry['chunks']):
+            return False
+        if entry['mtime'] is not None and st.st_mtime == entry['mtime']:
+            return True
+
+        # Same size but a different time: check chunk by chunk
+        with open(path, 'rb') as f:
+            for digest, length in entry['chunks']:
+                if not check_chunk(digest, f.read(length)):
+                    return False
+        return True
+
+    def restore_file(self, entry, dest):
+        '''Write out one file, returning bytes written (None if skipped).'''
+
+        path = dest_path(dest, entry['filename'])
+        mtime = entry['mtime']
+        if self.is_identical(path, entry):
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+            return None
+
+        # Write next to the file and move it into place when it's done
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + '.restore'
+        nbytes = 0
+        try:
+            with open(partial, 'wb') as f:
+                for digest, _length in entry['chunks']:
+                    nbytes += f.write(self.chunk_store.get(digest))
+            if mtime is not None:
+                os.utime(partial, (mtime, mtime))
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        return nbytes
+
+    def restore(self, client_name, dest, prefix='', at=None):
+        '''Restore a client's files under prefix, as of time at, to dest.
+
+        Returns counts of files restored, skipped and failed and the
+        number of bytes written.
+        '''
+
+        dest = os.path.abspath(str(dest))
+        entries = self.plan(client_name, prefix, at)
+        stats = {'restored': 0, 'skipped': 0, 'failed': 0, 'nbytes': 0}
+
+        def restore_one(entry):
+            try:
+                return self.restore_file(entry, dest), None
+            except (KeyError, OSError, ValueError) as e:
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for entry, (nbytes, error) in zip(
+                    entries, pool.map(restore_one, entries)):
+                if error is not None:
+                    logging.info(
+                        'Could not restore %s: %s', entry['filename'], error)
+                    stats['failed'] += 1
+                elif nbytes is None:
+                    stats['skipped'] += 1
+                else:
+                    stats['restored'] += 1
+                    stats['nbytes'] += nbytes
+        return stats
+
+if __name__ == '__main__':
+
+    # Target reads its config and opens its stores for us
+    from backupinator.target import Target
+
+    parser = argparse.ArgumentParser(
+        description="Restore a client's files from a target.")
+    parser.add_argument('target_name')
+    parser.add_argument('client_name')
+    parser.add_argument('dest', help='directory to restore into')
+    parser.add_argument(
+        '--prefix', default='', help='only restore paths starting with this')
+    parser.add_argument(
+        '--at', type=parse_time, default=None,
+        help='restore as of this time (epoch seconds or ISO date)')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    target = Target(args.target_name)
+    print(target.restore(
+        args.client_name, args.dest, args.prefix, args.at, args.workers))
@@ -0,0 +1,183 @@
+'''Incremental scanning of tracked directories.'''
+
+import os
+import json
+import logging
+from time import time, time_ns
+
+from backupinator.walker import parallel_walk
+
+# Directories modified this close to the scan (in ns) are not trusted
+# to stay unchanged: a later change could land in the same mtime tick
+RACY_WINDOW_NS = 2*10**9
+
+class ChangeSet:
+    '''Files added, modified and removed since the last scan.'''
+
+    def __init__(self):
+        self.added = []
+        self.modified = []
+        self.removed = []
+
+    def __len__(self):
+        return len(self.added) + len(self.modified) + len(self.removed)
+
+    def changed(self):
+        '''Files that need to be sent to targets.'''
+        return self.added + self.modified
+
+class StatCache:
+    '''Persistent (size, mtime_ns, inode) records for files and dirs.'''
+
+    def __init__(self, db):
+        self.db = db
+
+    def get_file(self, path):
+        '''Cached stat tuple of a file, or None.'''
+        try:
+            return tuple(int(v) for v in self.db['f:' + path].split(b':'))
+        except KeyError:
+            return None
+
+    def set_file(self, path, st):
+        '''Record the stat of a file.'''
+        self.db['f:' + path] = '%d:%d:%d' % (
+            st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def del_file(self, path):
+        '''Forget a file.'''
+        try:
+            del self.db['f:' + path]
+        except KeyError:
+            pass
+
+    def get_dir(self, path):
+        '''Cached (mtime_ns, files, dirs) of a directory, or None.'''
+        try:
+            entry = json.loads(self.db['d:' + path])
+        except KeyError:
+            return None
+        return entry['mtime_ns'], entry['files'], entry['dirs']
+
+    def set_dir(self, path, mtime_ns, files, dirs):
+        '''Record the listing of a directory.'''
+        self.db['d:' + path] = json.dumps({
+            'mtime_ns': mtime_ns,
+            'files': files,
+            'dirs': dirs,
+        })
+
+    def del_dir(self, path):
+        '''Forget a directory.'''
+        try:
+            del self.db['d:' + path]
+        except KeyError:
+            pass
+
+def stat_key(st):
+    '''The parts of a stat result used for change detection.'''
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+class Scanner:
+    '''Find changed files, skipping listings of unchanged directories.
+
+    A directory's mtime only changes when entries are added, removed
+    or renamed, so for unchanged directories the cached listing is
+    reused and only the files in it are stat'ed.
+    '''
+
+    def __init__(self, store, tracked_dirs, workers=8):
+        self.store = store
+        self.tracked_dirs = [os.path.normpath(d) for d in tracked_dirs]
+        self.workers = workers
+
+    def scan(self):
+        '''Scan all tracked directories and return a ChangeSet.'''
+
+        changes = ChangeSet()
+        for kind, path, _st in self.iter_changes():
+            getattr(changes, kind).append(path)
+        return changes
+
+    def iter_changes(self):
+        '''Scan all tracked directories, yielding each change.
+
+        Changes are (kind, path, st) where kind is 'added', 'modified'
+        or 'removed' (st is None for removals).
+        '''
+
+        t0 = time()
+        scan_start_ns = time_ns()
+        ndirs, nskipped, nchanges = 0, 0, 0
+
+        with self.store.batch() as db:
+            cache = StatCache(db)
+
+            # Directories are listed in worker threads, but the cache
+            # is only ever touched from this one
+            for listing in parallel_walk(
+                    self.tracked_dirs, cache.get_dir, self.workers):
+                ndirs += 1
+                nskipped += listing.skipped
+                for change in self.apply_listing(
+                        cache, listing, scan_start_ns):
+                    nchanges += 1
+                    yield change
+
+        logging.info(
+            'Took %g sec to scan %d dirs, %d unchanged, %d changes',
+            (time() - t0), ndirs, nskipped, nchanges)
+
+    def apply_listing(self, cache, listing, scan_start_ns):
+        '''Compare a directory listing against the cache.'''
+
+        dirpath, cached = listing.dirpath, listing.cached
+
+        # Directory is gone
+        if listing.mtime_ns is None:
+            yield from self.remove_subtree(cache, dirpath)
+            return
+
+        # Compare files against the cache
+        for name, st in listing.stats.items():
+            path = os.path.join(dirpath, name)
+            old = cache.get_file(path)
+            if old == stat_key(st):
+                continue
+            cache.set_file(path, st)
+            yield ('added' if old is None else 'modified'), path, st
+
+        # Anything we knew about that isn't here anymore was removed
+        if cached is not None:
+            for name in cached[1]:
+                if name not in listing.stats:
+                    path = os.path.join(dirpath, name)
+                    cache.del_file(path)
+                    yield 'removed', path, None
+            for name in cached[2]:
+                if name not in listing.dirs:
+                    yield from self.remove_subtree(
+                        cache, os.path.join(dirpath, name))
+
+        # Don't trust an mtime that is still racing with the scan
+        mtime_ns = listing.mtime_ns
+        if mtime_ns > scan_start_ns - RACY_WINDOW_NS:
+            mtime_ns = 0
+        files = sorted(listing.stats)
+        if (not listing.skipped or mtime_ns != cached[0]
+                or files != cached[1]):
+            cache.set_dir(dirpath, mtime_ns, files, listing.dirs)
+
+    def remove_subtree(self, cache, dirpath):
+        '''Forget a directory and everything below it.'''
+
+        cached = cache.get_dir(dirpath)
+        if cached is None:
+            return
+        for name in cached[1]:
+            path = os.path.join(dirpath, name)
+            cache.del_file(path)
+            yield 'removed', path, None
+        for name in cached[2]:
+            yield from self.remove_subtree(cache, os.path.join(dirpath, name))
+        cache.del_dir(dirpath)
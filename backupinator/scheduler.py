@@ -0,0 +1,452 @@
+'''Scheduling uploads of queued jobs to several targets at once.'''
+
+import os
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from time import localtime, monotonic, sleep
+
+from backupinator.cache import LRUCache
+from backupinator.compression import STATS, frame
+from backupinator.job import SendFileJob, CHUNK_SIZE
+from backupinator.metrics import METRICS, span
+from backupinator.wire import load_response
+
+SEND_SECONDS = METRICS.histogram(
+    'backupinator_client_send_seconds', 'Time to upload a queued job.',
+    ('target',))
+SENT = METRICS.counter(
+    'backupinator_client_sent_total', 'Queued jobs uploaded.',
+    ('target', 'result'))
+QUEUE_DEPTH = METRICS.gauge(
+    'backupinator_client_queue_depth', 'Jobs waiting to be uploaded.',
+    ('target',))
+
+class TokenBucket:
+    '''Limit to rate bytes per second on average (0 for no limit).'''
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, CHUNK_SIZE)
+        self.tokens = self.burst
+        self.stamp = monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        '''Wait until nbytes may be sent.'''
+
+        if not self.rate:
+            return
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.stamp)*self.rate)
+            self.stamp = now
+
+            # Go into debt and sleep it off outside the lock
+            self.tokens -= nbytes
+            wait = -self.tokens/self.rate
+        if wait > 0:
+            sleep(wait)
+
+def parse_windows(spec):
+    '''"22:00-06:00,12:00-13:00" as [(start, end)] in minutes.'''
+
+    windows = []
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, end = part.split('-')
+        windows.append(tuple(
+            int(h)*60 + int(m) for h, m in (
+                start.split(':'), end.split(':'))))
+    return windows
+
+def in_windows(windows, now=None):
+    '''Whether local time is in any window (always, if there are none).'''
+
+    if not windows:
+        return True
+    now = localtime(now)
+    minute = now.tm_hour*60 + now.tm_min
+    for start, end in windows:
+        if start <= end and start <= minute < end:
+            return True
+        if start > end and (minute >= start or minute < end):
+            return True
+    return False
+
+class FanOut:
+    '''Read a file once for several uploads of it.
+
+    The last window chunks read are kept, so uploads running at about
+    the same pace share them.  An upload that falls further behind
+    than that reads the rest of the file itself, so it never holds up
+    the others.  transform (e.g., compression) is done once per chunk.
+    The file is only open while it's being read.
+    '''
+
+    def __init__(self, filename, transform=None, chunk_size=CHUNK_SIZE,
+                 window=4):
+        self.filename = filename
+        self.transform = transform
+        self.chunk_size = chunk_size
+        self.window = deque(maxlen=window)
+        self.base = 0
+        self.eof = False
+        self.closed = False
+        self._f = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''Stop reading; uploads still going read the rest themselves.'''
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+            self.window.clear()
+            self.closed = True
+
+    def _read(self, f):
+        chunk = f.read(self.chunk_size)
+        if chunk and self.transform is not None:
+            chunk = self.transform(chunk)
+        return chunk
+
+    def _get(self, index):
+        '''Chunk index, b'' at the end, or None if it's been dropped.'''
+
+        with self._lock:
+            if self.closed:
+                return None
+            while self.base + len(self.window) <= index and not self.eof:
+                if self._f is None:
+                    self._f = open(self.filename, 'rb')
+                chunk = self._read(self._f)
+                if not chunk:
+                    self.eof = True
+                    self._f.close()
+                    self._f = None
+                    break
+                if len(self.window) == self.window.maxlen:
+                    self.base += 1
+                self.window.append(chunk)
+            if index < self.base:
+                return None
+            if index >= self.base + len(self.window):
+                return b''
+            return self.window[index - self.base]
+
+    def iter_chunks(self):
+        '''The file's (transformed) chunks for one upload.'''
+
+        index = 0
+        while True:
+            chunk = self._get(index)
+            if chunk is None:
+                break
+            if not chunk:
+                return
+            yield chunk
+            index += 1
+
+        # Fell behind: carry on from here on our own
+        with open(self.filename, 'rb') as f:
+            f.seek(index*self.chunk_size)
+            yield from iter(lambda: self._read(f), b'')
+
+    def open(self):
+        '''File-like reader of the file for one upload.'''
+        return ChunkReader(self.iter_chunks())
+
+class ChunkReader:
+    '''Minimal binary file object over an iterator of chunks.'''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buf = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, size=-1):
+        '''Up to size bytes, all that's left if size is negative.'''
+        while size < 0 or len(self.buf) < size:
+            chunk = next(self.chunks, b'')
+            if not chunk:
+                break
+            self.buf += chunk
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def close(self):
+        '''Let go of the chunks.'''
+        self.chunks.close()
+
+class UploadScheduler:
+    '''Send a client's queued jobs to all of its targets at once.
+
+    Each file is sent to all the targets that want it at the same time,
+    so the uploads share one read of it, and a target that can't keep
+    up reads the file itself rather than slowing the others down.
+    Small and recently changed files go first; bandwidth is limited per target and overall, and targets
+    can be limited to time-of-day windows.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        get = client.get_config_val
+
+        self.batch = get('schedule_batch', valtype='int', fallback=100)
+        self.target_workers = get('target_workers', valtype='int', fallback=2)
+        self.small_file_size = get(
+            'small_file_size', valtype='int', fallback=1024*1024)
+
+        # Limits in bytes/second, 0 for none
+        self.bucket = TokenBucket(
+            get('max_upload_rate', valtype='int', fallback=0))
+        self.buckets = {
+            target: TokenBucket(get(
+                'max_upload_rate_' + target, valtype='int', fallback=0))
+            for target in client.targets}
+
+        # When uploads may happen, overall and per target
+        self.windows = parse_windows(get('upload_window', fallback=''))
+        self.target_windows = {
+            target: parse_windows(get(
+                'upload_window_' + target, fallback=''))
+            for target in client.targets}
+
+        # Readers and chunk lists or signatures of files, shared by
+        # uploads of them to different targets
+        self._fanouts = LRUCache(4*self.target_workers*len(client.targets))
+        self._plans = LRUCache(4*self.target_workers*len(client.targets))
+        self._lock = threading.Lock()
+
+    def ready_targets(self):
+        '''Targets that can take uploads right now.'''
+
+        if not in_windows(self.windows):
+            return []
+        return [
+            target for target in self.client.targets
+            if target not in self.client.offline_targets and
+            target not in self.client.paused_targets and
+            in_windows(self.target_windows[target])]
+
+    def priority(self, job):
+        '''Sort key: small files, then the most recently changed.'''
+
+        try:
+            st = os.stat(job.filename)
+        except (AttributeError, OSError):
+            return (False, 0, 0)
+        return (st.st_size > self.small_file_size, -st.st_mtime, st.st_size)
+
+    def fanout(self, job, codec=None):
+        '''Shared reader of a file, for uploads of it to any target.'''
+
+        codec = job.codec if codec is None else codec
+        st = os.stat(job.filename)
+        key = (job.filename, st.st_mtime_ns, st.st_size, codec)
+        with self._lock:
+            fanout = self._fanouts.get(key)
+            if fanout is None:
+                transform = None
+                if codec != 'none':
+                    transform = lambda chunk: frame(
+                        STATS.compress(codec, chunk))
+                fanout = FanOut(job.filename, transform, job.chunk_size)
+                self._fanouts.put(key, fanout)
+            return fanout
+
+    def plan(self, job, kind, make):
+        '''make(filename), worked out once for uploads to every target.'''
+
+        st = os.stat(job.filename)
+        key = (job.filename, st.st_mtime_ns, st.st_size, kind)
+        with self._lock:
+            event = self._plans.get(key)
+            owner = event is None
+            if owner:
+                event = [threading.Event(), None]
+                self._plans.put(key, event)
+        if owner:
+            try:
+                event[1] = make(job.filename)
+            finally:
+                event[0].set()
+        event[0].wait()
+        if event[1] is None:
+            # Whoever was making it failed; try for ourselves
+            return make(job.filename)
+        return event[1]
+
+    def throttle(self, target):
+        '''Callback that holds an upload to the target's limits.'''
+        def throttle(nbytes):
+            self.bucket.consume(nbytes)
+            self.buckets[target].consume(nbytes)
+        return throttle
+
+    def upload(self, target, job, bases=None):
+        '''Send one job to a target, returning the response.
+
+        bases is what the client's file_bases() gave for the target.
+        '''
+
+        client = self.client
+        if not isinstance(job, SendFileJob):
+            return load_response(client.submit(job))
+
+        # Chunk lists and signatures are the same for every target, and
+        # all uploads are held to the bandwidth limits
+        throttle = self.throttle(target)
+        if client.dedup:
+            return {'success': client.send_file_chunks(
+                job.filename, target,
+                self.plan(job, 'chunks', client.file_chunks), throttle)}
+        signatures = lambda filename: self.plan(
+            job, 'signatures', client.file_signatures)
+        if client.delta and client.send_file_delta(
+                job.filename, target, signatures,
+                self.fanout(job, 'none').open, throttle, bases):
+            return {'success': True}
+
+        job._source = self.fanout(job).iter_chunks()
+        job._throttle = throttle
+        return load_response(client.submit(job))
+
+    def send(self, target, seq, job, bases=None):
+        '''Upload a queued job and take it off the queue if it went.'''
+
+        # File may have gone away since it was queued
+        if isinstance(job, SendFileJob) and not os.path.exists(job.filename):
+            self.client.jobs.ack(seq)
+            return True
+
+        try:
+            with span('client.send', target=target, job=job.job_type), \
+                    SEND_SECONDS.time(target=target):
+                json_data = self.upload(target, job, bases)
+        except OSError as e:
+            logging.info('Could not send %s to %s: %s', job.job_type, target, e)
+            SENT.inc(target=target, result='error')
+            return False
+        if not json_data.get('success', False):
+            if json_data.get('backpressure'):
+                self.client.paused_targets.add(target)
+                SENT.inc(target=target, result='backpressure')
+            else:
+                SENT.inc(target=target, result='failed')
+            return False
+        self.client.jobs.ack(seq)
+        SENT.inc(target=target, result='ok')
+        return True
+
+    def next_files(self, targets):
+        '''Queued jobs of the targets, grouped by file, in the order to send.
+
+        Each group is [(target, seq, job)] for one file (or one job that
+        isn't a file upload).
+        '''
+
+        groups = OrderedDict()
+        for target in targets:
+            for seq, job in self.client.jobs.peek(target, self.batch):
+                key = job.filename if isinstance(job, SendFileJob) else (
+                    target, seq)
+                groups.setdefault(key, []).append((target, seq, job))
+        return sorted(
+            groups.values(), key=lambda group: self.priority(group[0][2]))
+
+    def file_bases(self, groups):
+        '''What client.file_bases() gives for each target's files in groups.
+
+        One request per target covers a whole round of deltas, rather
+        than one per file.
+        '''
+
+        bases = {}
+        if not self.client.delta or self.client.dedup:
+            return bases
+        filenames = {}
+        for group in groups:
+            for target, _seq, job in group:
+                if isinstance(job, SendFileJob):
+                    filenames.setdefault(target, []).append(job.filename)
+        for target, names in filenames.items():
+            try:
+                bases[target] = self.client.file_bases(target, names)
+            except OSError as e:
+                logging.info('Could not get bases from %s: %s', target, e)
+        return bases
+
+    def fan_out(self, targets):
+        '''Send queued files to every target that wants them at once.
+
+        Each file's uploads are handed to all of its targets' workers
+        together, so they read it through one FanOut; a target that
+        falls behind reads the rest itself.  Targets are dropped once
+        an upload to them fails or their window closes.
+        '''
+
+        counts = dict.fromkeys(targets, 0)
+        pools = {
+            target: ThreadPoolExecutor(max_workers=self.target_workers)
+            for target in targets}
+        try:
+            while True:
+                targets = [
+                    target for target in targets
+                    if in_windows(self.target_windows[target])]
+                groups = self.next_files(targets)
+                if not groups:
+                    break
+                bases = self.file_bases(groups)
+                futures = [
+                    (target, pools[target].submit(
+                        self.send, target, seq, job, bases.get(target)))
+                    for group in groups for target, seq, job in group]
+                failed = set()
+                for target, future in futures:
+                    if future.result():
+                        counts[target] += 1
+                    else:
+                        failed.add(target)
+                targets = [t for t in targets if t not in failed]
+        finally:
+            for pool in pools.values():
+                pool.shutdown()
+        return counts
+
+    def run(self):
+        '''Send the queues of every target that can take uploads now.'''
+
+        targets = self.ready_targets()
+        if targets:
+            try:
+                counts = self.fan_out(targets)
+            finally:
+                for fanout in self._fanouts.clear():
+                    fanout.close()
+                self._plans.clear()
+            logging.info('Sent %s', counts)
+        else:
+            counts = {}
+        for target in self.client.targets:
+            QUEUE_DEPTH.set(self.client.jobs.depth(target), target=target)
+        return counts
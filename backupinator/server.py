@@ -1,92 +1,597 @@
 '''Server handles passing of jobs between clients and targets.'''
 
-from time import time
+import asyncio
+import functools
+import pathlib
 import logging
 import base64
+import json
+import io
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import jsons # pylint: disable=E0401
 from Cryptodome.PublicKey import RSA # pylint: disable=E0401
+from Cryptodome.Cipher import PKCS1_OAEP # pylint: disable=E0401
 from Cryptodome.Signature import pkcs1_15 # pylint: disable=E0401
 from Cryptodome.Hash import SHA256 # pylint: disable=E0401
 
 from backupinator import DB
 from backupinator.auth import Auth
+from backupinator.cache import LRUCache
+from backupinator.chunk_store import ChunkStore
+from backupinator.compression import MAX_FRAME_SIZE, STATS, read_frame
+from backupinator.db import open_store
+from backupinator.delta import apply_delta, pick_block_size, signatures
 from backupinator.job import *
+from backupinator.merkle import MerkleTree
+from backupinator.metrics import (
+    METRICS, SIZE_BUCKETS, DUMP_PAYLOADS, current_trace, span)
+from backupinator.server_state import ServerState, SharedSessionTable
+from backupinator.spool import Spool, check_digest, check_name
+from backupinator.utils import (
+    get_server_config_filename, get_generic_config_val, spool_stream)
+
+# Stands in for the auth of jobs inside an authenticated BatchJob
+BATCH_AUTHENTICATED = object()
+
+# Jobs in a batch that the rest of their client's (or target's) jobs
+# have to be ordered around
+BATCH_BARRIERS = frozenset((
+    'BatchJob', 'RegisterClientJob', 'RegisterTargetJob', 'OpenSessionJob',
+    'CheckinClientJob', 'AckJob'))
+
+# Targets' keys are kept with clients', under this prefix
+TARGET_PREFIX = 'target:'
+
+# Bytes that can wait for any one target before uploads are turned away
+SPOOL_QUOTA = 10*1024**3
+
+JOBS = METRICS.counter(
+    'backupinator_server_jobs_total', 'Jobs handled.', ('job',))
+JOB_ERRORS = METRICS.counter(
+    'backupinator_server_job_errors_total', 'Jobs that failed.', ('job',))
+JOB_SECONDS = METRICS.histogram(
+    'backupinator_server_job_seconds', 'Time to handle a job.', ('job',))
+AUTH_SECONDS = METRICS.histogram(
+    'backupinator_server_auth_seconds', 'Time to authenticate.', ('method',))
+AUTH_FAILURES = METRICS.counter(
+    'backupinator_server_auth_failures_total', 'Failed authentications.',
+    ('method',))
+BYTES_IN = METRICS.counter(
+    'backupinator_server_bytes_in_total', 'Streamed bytes received.',
+    ('job',))
+BYTES_OUT = METRICS.counter(
+    'backupinator_server_bytes_out_total', 'Raw bytes sent.', ('job',))
+UPLOAD_BYTES = METRICS.histogram(
+    'backupinator_server_upload_bytes', 'Size of streamed uploads.',
+    ('job',), SIZE_BUCKETS)
+SPOOL_BYTES = METRICS.gauge(
+    'backupinator_server_spool_bytes', 'Bytes waiting for a target.',
+    ('target',))
+
+class SyncStream:
+    '''Blocking file-like view of an async stream, for worker threads.'''
+
+    def __init__(self, stream, loop):
+        self.stream = stream
+        self.loop = loop
+
+    def read(self, size=-1):
+        '''Read from the stream on the event loop and wait for it.'''
+        return asyncio.run_coroutine_threadsafe(
+            self.stream.read(size), self.loop).result()
+
+def target_key(target_name):
+    '''Name a target's key is registered under.'''
+    return TARGET_PREFIX + target_name
+
+class RawResponse:
+    '''A response of raw bytes, from memory or an open file.'''
+
+    def __init__(self, data=None, f=None):
+        self.data = data
+        self.f = f
+
+    def size(self):
+        '''Number of bytes to send.'''
+        if self.f is not None:
+            return os.fstat(self.f.fileno()).st_size
+        return len(self.data)
+
+class CountingStream:
+    '''Request body stream that counts the bytes read from it.'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.nbytes = 0
+
+    def read(self, size=-1):
+        '''Read from the stream.'''
+        data = self.stream.read(size)
+        self.nbytes += len(data)
+        return data
 
 class Server:
     '''Coordinating server to handle jobs.'''
 
-    def __init__(self, client_db_name='client_db'):
+    def __init__(self, client_db_name='client_db', spool_dir='spool',
+                 db_backend='sqlite', session_lifetime=3600,
+                 key_cache_size=1024, batch_workers=8, batch_concurrency=4,
+                 spool_quota=SPOOL_QUOTA, target_timeout=120, max_pull_wait=30,
+                 client_timeout=7*24*3600, state_file=None,
+                 signature_workers=2):
 
         # Set debug level
         log_format = "%(levelname)s:[%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s"
         logging.basicConfig(format=log_format, level=logging.DEBUG)
 
         # Hook up to the client database
-        self.client_db = DB(client_db_name)
+        self.db_backend = db_backend
+        self.client_db = DB(client_db_name, backend=db_backend)
+
+        # Imported RSA public keys of recently seen clients, with the
+        # version of each in the shared state
+        self.key_cache = LRUCache(key_cache_size)
+        self.chunk_stores = {}
+        self.signature_stores = {}
+        self.trees = {}
+        self._lock = threading.Lock()
+
+        # Batch jobs are spread over a shared pool, but any one batch
+        # only gets batch_concurrency of its workers at a time
+        self.batch_pool = ThreadPoolExecutor(max_workers=batch_workers)
+        self.batch_concurrency = batch_concurrency
+        self._local = threading.local()
+
+        # Signatures of whole uploads are worked out off the request path
+        self.signature_pool = ThreadPoolExecutor(
+            max_workers=signature_workers)
+
+        # Uploads are written here until targets pick them up, and
+        # uploads are turned away once a target has spool_quota bytes
+        # waiting
+        self.spool_dir = pathlib.Path(spool_dir)
+        self.spool = Spool(self.spool_dir, spool_quota)
+
+        # Targets are online if they've pulled in the last
+        # target_timeout seconds; pulls wait at most max_pull_wait.
+        # Clients not heard from in client_timeout seconds are forgotten
+        self.target_timeout = target_timeout
+        self.max_pull_wait = max_pull_wait
+        self.client_timeout = client_timeout
+
+        # Clients, targets and HMAC sessions are shared by every worker
+        # process, kept next to the spool by default
+        if state_file is None:
+            state_file = self.spool_dir / 'state.db'
+        self.state = ServerState(state_file)
+        self.sessions = SharedSessionTable(self.state, session_lifetime)
 
-        # Keep a running list of clients and targets
-        self.clients = {}
-        self.targets = {}
+    @classmethod
+    def from_config(cls, configfile=None):
+        '''Server set up from server.ini, or the defaults.'''
+
+        if configfile is None:
+            configfile = get_server_config_filename()
+        def get_config_val(key, valtype='str', fallback=None):
+            return get_generic_config_val(configfile, key, valtype, fallback)
+
+        return cls(
+            client_db_name=get_config_val(
+                'client_db_name', fallback='client_db'),
+            spool_dir=get_config_val('spool_dir', fallback='spool'),
+            db_backend=get_config_val('db_backend', fallback='sqlite'),
+            session_lifetime=get_config_val(
+                'session_lifetime', valtype='int', fallback=3600),
+            key_cache_size=get_config_val(
+                'key_cache_size', valtype='int', fallback=1024),
+            batch_workers=get_config_val(
+                'batch_workers', valtype='int', fallback=8),
+            batch_concurrency=get_config_val(
+                'batch_concurrency', valtype='int', fallback=4),
+            spool_quota=get_config_val(
+                'spool_quota', valtype='int', fallback=SPOOL_QUOTA),
+            target_timeout=get_config_val(
+                'target_timeout', valtype='float', fallback=120),
+            max_pull_wait=get_config_val(
+                'max_pull_wait', valtype='float', fallback=30),
+            client_timeout=get_config_val(
+                'client_timeout', valtype='float', fallback=7*24*3600),
+            state_file=get_config_val('state_file', fallback='') or None,
+            signature_workers=get_config_val(
+                'signature_workers', valtype='int', fallback=2))
 
     def authenticate_client(
-            self, client_name, auth, rsa_pub_key=None):
+            self, client_name, auth, rsa_pub_key=None, allow_session=True):
         '''Make sure client's signature is correct.'''
 
-        if rsa_pub_key is None:
-            logging.debug('Looking up RSA key in client database...')
-            rsa_pub_key = self.client_db.get(client_name)
-            logging.debug('Was RSA key found? %s', rsa_pub_key is not None)
+        # Already checked as part of a batch
+        if auth is BATCH_AUTHENTICATED:
+            return allow_session
 
-        # auth ends up as a dictionary after deserialization...
-        auth = jsons.load(auth, Auth)
-        hashed = SHA256.new(auth.message.encode())
-        key = RSA.import_key(rsa_pub_key)
-        try:
-            # decode hex signature
-            signature = bytes.fromhex(auth.hex_signature)
-            pkcs1_15.new(key).verify(hashed, signature)
-            logging.debug('Authentication successful!')
-            return True
-        except (ValueError, TypeError):
-            logging.debug('Unable to authenticate client: %s', client_name)
+        # auth ends up as a dictionary after JSON deserialization...
+        if not isinstance(auth, Auth):
+            auth = jsons.load(auth, Auth)
+
+        # Session MACs are cheap to check
+        if auth.session_id is not None:
+            with AUTH_SECONDS.time(method='session'):
+                session = self.sessions.get(auth.session_id)
+                success = (
+                    allow_session and session is not None and
+                    session.client_name == client_name and
+                    session.verify(auth))
+            if not success:
+                AUTH_FAILURES.inc(method='session')
+            return success
+
+        signature = None
+        with AUTH_SECONDS.time(method='rsa'):
+            if rsa_pub_key is None:
+                key = self.get_client_key(client_name)
+            else:
+                key = RSA.import_key(rsa_pub_key)
+
+            hashed = SHA256.new(auth.message.encode())
+            try:
+                # decode hex signature
+                signature = bytes.fromhex(auth.hex_signature)
+                pkcs1_15.new(key).verify(hashed, signature)
+                return True
+            except (ValueError, TypeError):
+                pass
+
+        AUTH_FAILURES.inc(method='rsa')
+        logging.info('Unable to authenticate client: %s', client_name)
+        if DUMP_PAYLOADS:
             logging.debug(
                 'Data dump: %s', {
                     'client_name': client_name,
                     'auth': auth,
-                    'rsa_pub_key': rsa_pub_key,
+                    'rsa_pub_key': key.export_key(),
                     'signature': signature,
                     'hashed': hashed})
-            return False
+        return False
+
+    def get_client_key(self, client_name):
+        '''Client's imported RSA public key, cached.
+
+        The key may have been replaced through another worker, so the
+        cached one is only used if its version is still current.
+        '''
+
+        version = self.state.key_version(client_name)
+        cached = self.key_cache.get(client_name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        key = RSA.import_key(self.client_db.get(client_name))
+        self.key_cache.put(client_name, (version, key))
+        return key
+
+    @staticmethod
+    def bad_names(job):
+        '''Response for a job with names unfit for paths, else None.'''
+        try:
+            if not isinstance(job, BatchJob):
+                for attr in ('client_name', 'target_name'):
+                    if getattr(job, attr, None) is not None:
+                        check_name(getattr(job, attr))
+            if hasattr(job, 'filename_hash'):
+                check_digest(job.filename_hash)
+        except ValueError as e:
+            return {
+                'success': False,
+                'msg': str(e),
+                'job_uuid': job.uuid,
+            }
+        return None
+
+    def refuse_upload(self, job):
+        '''Response if an upload can't be taken now, else None.'''
+
+        # Only to targets the client checked in with
+        info = self.state.info('client', job.client_name) or {}
+        if job.target_name not in info.get('targets', ()):
+            return {
+                'success': False,
+                'msg': '%s has not checked in with target %s' % (
+                    job.client_name, job.target_name),
+                'job_uuid': job.uuid,
+            }
+        if self.spool.full(job.target_name):
+            return self.spool_full(job)
+        return None
+
+    def auth_failed(self, job):
+        '''Response for a job whose client could not be authenticated.'''
+        res = {
+            'success': False,
+            'msg': 'Could not authenticate client!',
+            'auth_failed': True,
+            'job_uuid': job.uuid,
+        }
+        if DUMP_PAYLOADS:
+            logging.debug('Returning: %s', res)
+        return res
 
-    def job_handler(self, job):
-        '''Given a job, decide what to do about it.'''
+    def job_handler(self, job, stream=None, trace_id=None):
+        '''Given a job, decide what to do about it.
+
+        trace_id continues a trace the sender started, if tracing.
+        '''
 
         # Sanity check
-        logging.debug('Incoming job is a %s', type(job))
         assert isinstance(job, Job), 'Must use a Job object!'
 
+        job_type = job.job_type
+        JOBS.inc(job=job_type)
+        if stream is not None:
+            stream = CountingStream(stream)
+        with JOB_SECONDS.time(job=job_type), span(
+                'server.' + job_type, trace_id,
+                client=getattr(job, 'client_name', None)):
+            res = self.dispatch(job, stream)
+
+        if stream is not None:
+            BYTES_IN.inc(stream.nbytes, job=job_type)
+            UPLOAD_BYTES.observe(stream.nbytes, job=job_type)
+        if isinstance(res, RawResponse):
+            BYTES_OUT.inc(res.size(), job=job_type)
+        elif isinstance(res, dict) and not res.get('success', True):
+            JOB_ERRORS.inc(job=job_type)
+        return res
+
+    def dispatch(self, job, stream=None):
+        '''Run the handler for a job's type.'''
+
+        # Names and hashes end up in paths on disk
+        bad = self.bad_names(job)
+        if bad is not None:
+            return bad
+
         # If it's a batch job, call job_handler on each
         if isinstance(job, BatchJob):
             logging.info('Batch job: processing each and returning '
                          'results as a list.')
-            return [self.job_handler(jsons.load(j, globals()[j['job_type']])) for j in job.jobs]
+            return self.batch_handler(job)
+
+        # File uploads may come with a raw body stream
+        if isinstance(job, StreamingJob):
+            return {
+                SendFileJob: self.get_file_from_client,
+                SendChunksJob: self.get_chunks_from_client,
+                SendDeltaJob: self.get_delta_from_client,
+            }[type(job)](job, stream)
 
         # Do the right thing based on job type
         return {
             RegisterClientJob: self.register_client,
+            RegisterTargetJob: self.register_target,
+            OpenSessionJob: self.open_session,
             CheckinClientJob: self.checkin_client,
             GetTreeJob: self.get_tree,
-            SendFileJob: self.get_file_from_client,
+            QueryChunksJob: self.query_chunks,
+            PullJob: self.pull_for_target,
+            FetchJob: self.fetch_for_target,
+            AckJob: self.ack_from_target,
         }[type(job)](job)
 
+    async def job_handler_async(self, job, stream=None, executor=None,
+                                trace_id=None):
+        '''Handle a job without blocking the event loop.
+
+        Database, crypto and disk work run in executor threads; an async
+        body stream is read on the loop and handed to them chunk by chunk.
+        '''
+
+        loop = asyncio.get_running_loop()
+        if stream is not None:
+            stream = SyncStream(stream, loop)
+        return await loop.run_in_executor(
+            executor, functools.partial(
+                self.job_handler, job, stream, trace_id))
+
+    def batch_handler(self, job):
+        '''Run the jobs in a batch concurrently, keeping their order.
+
+        Jobs that change what a client or target's later jobs see
+        (registering, opening a session, checking in, acking) wait for
+        that party's earlier jobs and hold back its later ones; the
+        rest run at the same time.  A job that fails gets an error in
+        its place instead of failing the batch.
+        '''
+
+        # An authenticated batch vouches for its client's jobs
+        if job.auth is not None:
+            if not self.authenticate_client(job.client_name, job.auth):
+                return self.auth_failed(job)
+
+        # Sub-jobs are still dicts if the batch came in as JSON
+        def field(data, name):
+            if isinstance(data, dict):
+                return data.get(name)
+            return getattr(data, name, None)
+
+        def party_of(data):
+            if field(data, 'client_name') is not None:
+                return 'client', field(data, 'client_name')
+            return 'target', field(data, 'target_name')
+
+        def is_barrier(data):
+            job_type = (data.get('job_type') if isinstance(data, dict)
+                        else type(data).__name__)
+            return job_type in BATCH_BARRIERS
+
+        def run(data):
+            try:
+                sub_job = data
+                if isinstance(data, dict):
+                    sub_job = jsons.load(data, globals()[data['job_type']])
+
+                # Uploads need a body stream of their own; a batch has none
+                if isinstance(sub_job, StreamingJob):
+                    return {
+                        'success': False,
+                        'msg': '%s cannot be sent in a batch!' % (
+                            sub_job.job_type),
+                        'job_uuid': sub_job.uuid,
+                    }
+                if (job.auth is not None and getattr(
+                        sub_job, 'client_name', None) == job.client_name):
+                    sub_job.auth = BATCH_AUTHENTICATED
+                return self.job_handler(sub_job)
+            except Exception as e: # pylint: disable=W0703
+                logging.exception('Job in batch failed')
+                return {
+                    'success': False,
+                    'msg': 'Job failed: %s' % e,
+                    'job_uuid': field(data, 'uuid'),
+                }
+
+        # Work out what each job has to wait for: a barrier waits for
+        # everything its party sent before it, anything else only for
+        # the party's last barrier
+        waits_for = [0]*len(job.jobs)
+        unblocks = [[] for _data in job.jobs]
+        since_barrier = {}
+        for ii, data in enumerate(job.jobs):
+            earlier = since_barrier.setdefault(party_of(data), [])
+            if is_barrier(data):
+                deps = list(earlier)
+                earlier[:] = [ii]
+            else:
+                deps = earlier[:1] if earlier and is_barrier(
+                    job.jobs[earlier[0]]) else []
+                earlier.append(ii)
+            waits_for[ii] = len(deps)
+            for dep in deps:
+                unblocks[dep].append(ii)
+
+        ready = deque(ii for ii, nn in enumerate(waits_for) if nn == 0)
+        results = [None]*len(job.jobs)
+        remaining = [len(job.jobs)]
+        cond = threading.Condition()
+
+        def worker():
+            self._local.in_batch = True
+            try:
+                while True:
+                    with cond:
+                        while not ready and remaining[0]:
+                            cond.wait()
+                        if not ready:
+                            return
+                        ii = ready.popleft()
+                    results[ii] = run(job.jobs[ii])
+                    with cond:
+                        remaining[0] -= 1
+                        for later in unblocks[ii]:
+                            waits_for[later] -= 1
+                            if not waits_for[later]:
+                                ready.append(later)
+                        cond.notify_all()
+            finally:
+                self._local.in_batch = False
+
+        # Nested batches run inline so they can't starve the pool
+        nworkers = min(self.batch_concurrency, len(job.jobs))
+        if nworkers <= 1 or getattr(self._local, 'in_batch', False):
+            in_batch = getattr(self._local, 'in_batch', False)
+            worker()
+            self._local.in_batch = in_batch
+            return results
+
+        # This thread does its share of the work too
+        futures = [
+            self.batch_pool.submit(worker) for _ii in range(nworkers - 1)]
+        worker()
+        for future in futures:
+            future.result()
+        return results
+
+    def may_register(self, name, rsa_pub_key, auth):
+        '''Whether a key can be registered under a name.
+
+        A new name takes any key whose private half signed the job; a
+        key that's already registered can only be replaced by a job
+        signed with it.
+        '''
+        if auth is None:
+            return False
+        if name in self.client_db.store:
+            rsa_pub_key = None
+        try:
+            return self.authenticate_client(
+                name, auth, rsa_pub_key, allow_session=False)
+        except (ValueError, TypeError):
+            # Not a key we can import
+            return False
+
+    def add_key(self, name, rsa_pub_key):
+        '''Register a key, ending sessions opened with the old one.'''
+        self.client_db.add(name, rsa_pub_key)
+        self.state.bump_key_version(name)
+        self.key_cache.pop(name)
+        self.sessions.drop_client(name)
+
     def register_client(self, job):
         '''Add a client to the database.'''
 
-        # Need to do something to make sure that client is allowed
-        # to register?
-        self.client_db.add(job.client_name, job.rsa_pub_key)
+        # Targets' keys are only set by register_target
+        if job.client_name.startswith(TARGET_PREFIX):
+            return {
+                'success': False,
+                'msg': 'Client names cannot start with %s' % TARGET_PREFIX,
+                'job_uuid': job.uuid,
+            }
+        if not self.may_register(job.client_name, job.rsa_pub_key, job.auth):
+            return self.auth_failed(job)
+
+        self.add_key(job.client_name, job.rsa_pub_key)
         logging.info('Added %s to client database', job.client_name)
+        return {
+            'success': True,
+            'job_uuid': job.uuid,
+        }
+
+    def register_target(self, job):
+        '''Add a target's key to the database.'''
+
+        name = target_key(job.target_name)
+        if not self.may_register(name, job.rsa_pub_key, job.auth):
+            return self.auth_failed(job)
+
+        self.add_key(name, job.rsa_pub_key)
+        logging.info('Added target %s to client database', job.target_name)
+        return {
+            'success': True,
+            'job_uuid': job.uuid,
+        }
+
+    def open_session(self, job):
+        '''Give an RSA-authenticated client a session key.'''
+
+        # Sessions can only be opened with the client's RSA key
+        if not self.authenticate_client(
+                job.client_name, job.auth, allow_session=False):
+            return self.auth_failed(job)
+
+        # Only the holder of the private key can read the session key
+        session = self.sessions.create(job.client_name)
+        key = self.get_client_key(job.client_name)
+        encrypted_key = PKCS1_OAEP.new(key).encrypt(session.key)
+
+        return {
+            'success': True,
+            'session_id': session.session_id,
+            'encrypted_key': encrypted_key.hex(),
+            'lifetime': self.sessions.lifetime,
+            'job_uuid': job.uuid,
+        }
 
 
     def checkin_client(self, job):
@@ -94,65 +599,520 @@ class Server:
 
         # Authenticate client
         if not self.authenticate_client(job.client_name, job.auth):
-            res = {
-                'success': False,
-                'msg': 'Could not authenticate client!',
-                'job_uuid': job.uuid,
-            }
-            logging.info('Returning: %s', res)
-            return res
+            return self.auth_failed(job)
 
         # Only point to targets that are online.
-        offline_targets = [t for t in job.target_list if t not in self.targets]
-        online_targets = [t for t in job.target_list if t in self.targets]
-        self.clients[job.client_name] = {
-            'last_checkin': time(),
+        offline_targets = [
+            t for t in job.target_list if not self.target_online(t)]
+        online_targets = [t for t in job.target_list if self.target_online(t)]
+        self.state.touch('client', job.client_name, {
             'target_list': online_targets,
-        }
+            'targets': job.target_list,
+        })
+        self.state.evict('client', self.client_timeout)
+
+        # Uploads still spool for offline targets, but not for targets
+        # whose spool is full
+        paused_targets = [t for t in job.target_list if self.spool.full(t)]
 
         # Tell client which targets are online, offline
         res = {
             'success': True,
             'online_targets': online_targets,
             'offline_targets': offline_targets,
+            'paused_targets': paused_targets,
+            'spool_bytes': {t: self.spool.used(t) for t in job.target_list},
+            'spool_quota': self.spool.quota,
             'job_uuid': job.uuid
         }
-        logging.info('Returning: %s', res)
+        for target, nbytes in res['spool_bytes'].items():
+            SPOOL_BYTES.set(nbytes, target=target)
+        if DUMP_PAYLOADS:
+            logging.debug('Returning: %s', res)
         return res
 
 
     def get_tree(self, job):
-        '''Get the directory tree as recorded on the target.'''
+        '''Get the directory tree as sent to the target, a level at a time.'''
 
         # Authenticate client
         if not self.authenticate_client(job.client_name, job.auth):
+            return self.auth_failed(job)
+
+        # Block signatures of particular files are kept here, so the
+        # target doesn't need to be online for those
+        filename_hashes = getattr(job, 'filename_hashes', None)
+        if filename_hashes is not None:
+            return {
+                'success': True,
+                'signatures': self.get_tree_signatures(
+                    job.target_name, job.client_name, filename_hashes),
+                'job_uuid': job.uuid,
+            }
+
+        # The tree is what we've passed along to the target, so it can
+        # be compared while the target is offline
+        tree = self.get_tree_mirror(job.target_name, job.client_name)
+        return {
+            'success': True,
+            'nodes': tree.nodes(getattr(job, 'prefixes', None) or ['']),
+            'job_uuid': job.uuid,
+        }
+
+    def get_tree_mirror(self, target_name, client_name):
+        '''Merkle summary of a client's files sent to a target.'''
+        with self._lock:
+            key = (target_name, client_name)
+            if key not in self.trees:
+                dirname = self.spool_dir / target_name / 'trees'
+                dirname.mkdir(parents=True, exist_ok=True)
+                self.trees[key] = MerkleTree(
+                    open_store(dirname / client_name, self.db_backend))
+            return self.trees[key]
+
+    @staticmethod
+    def upload_meta(job, **meta):
+        '''What a target needs to know about an upload besides its data.'''
+        meta.update({
+            'tree_value': getattr(job, 'tree_value', None),
+            'filename': job.filename,
+            'mtime': getattr(job, 'mtime', None),
+            'hashes': getattr(job, 'hashes', None),
+        })
+
+        # Let the target carry on the client's trace
+        trace_id = current_trace()
+        if trace_id is not None:
+            meta['trace_id'] = trace_id
+        return meta
+
+    def record_upload(self, job):
+        '''Note the client's tree value for a file sent to a target.'''
+        tree_value = getattr(job, 'tree_value', None)
+        if tree_value is not None:
+            self.get_tree_mirror(job.target_name, job.client_name).update(
+                job.filename_hash, tree_value)
+
+    def open_spooled(self, filename, codec='none', chunk_size=CHUNK_SIZE):
+        '''A spooled upload as a plain, decompressed file object.'''
+        return self.decompressed(open(str(filename), 'rb'), codec, chunk_size)
+
+    @staticmethod
+    def decompressed(f, codec='none', chunk_size=CHUNK_SIZE):
+        '''Plain file object for an open spooled upload; closes f.
+
+        Each frame must decompress to no more than chunk_size bytes.
+        '''
+
+        if codec == 'none':
+            return f
+
+        out = tempfile.TemporaryFile()
+        with f:
+            for payload in iter(lambda: read_frame(f), None):
+                out.write(STATS.decompress(codec, payload, chunk_size))
+        out.seek(0)
+        return out
+
+    def spool_full(self, job):
+        '''Response for an upload to a target that is over its quota.'''
+        return {
+            'success': False,
+            'msg': 'Spool for %s is full, try again later.' % job.target_name,
+            'backpressure': True,
+            'job_uuid': job.uuid,
+        }
+
+    def get_signature_store(self, target_name):
+        '''Block signatures of the last copy of each file sent to a target.'''
+        with self._lock:
+            if target_name not in self.signature_stores:
+                dirname = self.spool_dir / target_name
+                dirname.mkdir(parents=True, exist_ok=True)
+                self.signature_stores[target_name] = open_store(
+                    dirname / 'signatures', self.db_backend)
+            return self.signature_stores[target_name]
+
+    def put_signatures(
+            self, target_name, client_name, filename_hash, block_size, sigs):
+        '''Remember a file's block signatures, or forget them if None.'''
+
+        store = self.get_signature_store(target_name)
+        key = '%s:%s' % (client_name, filename_hash)
+        if sigs is None:
+            if key in store:
+                del store[key]
+            return
+        store[key] = json.dumps([block_size, sigs])
+
+    def get_tree_signatures(self, target_name, client_name, filename_hashes):
+        '''Signatures of files that a delta can be made against.'''
+
+        store = self.get_signature_store(target_name)
+        res = {}
+        for filename_hash in filename_hashes:
+            val = store.get('%s:%s' % (client_name, filename_hash))
+            if val is None:
+                continue
+
+            # Still being worked out
+            val = json.loads(val)
+            if isinstance(val, dict):
+                continue
+
+            # A second delta can't be stacked on one the target hasn't
+            # applied yet
+            if self.spool.get(
+                    target_name, client_name, filename_hash, 'delta'):
+                continue
+
+            block_size, sigs = val
+            res[filename_hash] = {
+                'block_size': block_size,
+                'signatures': sigs,
+            }
+        return res
+
+    def get_file_from_client(self, job, stream=None):
+        '''Get file from client and store until target gets it.'''
+
+        # Authenticate client
+        if not self.authenticate_client(job.client_name, job.auth):
+            return self.auth_failed(job)
+        refused = self.refuse_upload(job)
+        if refused is not None:
+            return refused
+
+        # Compressed chunks are decompressed whole, so they can't be big
+        codec = getattr(job, 'codec', 'none')
+        if codec != 'none' and job.chunk_size > MAX_FRAME_SIZE:
+            return {
+                'success': False,
+                'msg': 'chunk_size is over %d bytes!' % MAX_FRAME_SIZE,
+                'job_uuid': job.uuid,
+            }
+
+        # Older clients send the whole file base64 encoded in the job
+        if stream is None:
+            stream = io.BytesIO(base64.b64decode(job.data))
+
+        # Spool to disk incrementally, never holding the full payload
+        upload = self.spool.upload_path(
+            job.target_name, job.client_name, job.filename_hash, 'file',
+            job.uuid)
+        nbytes = spool_stream(stream, upload, job.chunk_size)
+
+        # Signatures of the older copy are no good anymore; the new ones
+        # are worked out in the background from a handle opened now, so
+        # it doesn't matter if the target takes the upload first
+        pending = {'pending': str(job.uuid)}
+        self.get_signature_store(job.target_name)['%s:%s' % (
+            job.client_name, job.filename_hash)] = json.dumps(pending)
+        f = open(str(upload), 'rb')
+
+        # Data stays compressed; the target needs to know how.  A full
+        # copy supersedes any delta still waiting for the target.
+        self.spool.commit(
+            job.target_name, job.client_name, job.filename_hash, 'file',
+            upload, nbytes, self.upload_meta(
+                job, codec=codec, chunk_size=job.chunk_size))
+        self.spool.discard(
+            job.target_name, job.client_name, job.filename_hash, 'delta')
+        self.signature_pool.submit(
+            self.sign_upload, job.target_name, job.client_name,
+            job.filename_hash, f, codec, job.chunk_size, pending)
+        logging.info('Spooled %d bytes for %s', nbytes, job.target_name)
+        self.record_upload(job)
+
+        return {
+            'success': True,
+            'nbytes': nbytes,
+            'job_uuid': job.uuid,
+        }
+
+    def sign_upload(self, target_name, client_name, filename_hash, f, codec,
+                    chunk_size, pending):
+        '''Keep signatures of an upload so the next one can be a delta.'''
+
+        try:
+            with self.decompressed(f, codec, chunk_size) as f:
+                block_size = pick_block_size(f.seek(0, 2))
+                f.seek(0)
+                sigs = signatures(f, block_size)
+        except Exception: # pylint: disable=W0703
+            logging.exception('Could not sign upload of %s', filename_hash)
+            block_size = sigs = None
+
+        # Unless a newer copy came in while we were at it
+        store = self.get_signature_store(target_name)
+        key = '%s:%s' % (client_name, filename_hash)
+        val = store.get(key)
+        if val is None or json.loads(val) != pending:
+            return
+        self.put_signatures(
+            target_name, client_name, filename_hash, block_size, sigs)
+
+    def get_chunk_store(self, target_name):
+        '''Chunks we hold (or have held) for a target.'''
+        with self._lock:
+            if target_name not in self.chunk_stores:
+                self.chunk_stores[target_name] = ChunkStore(
+                    self.spool_dir / target_name / 'chunks', self.db_backend)
+            return self.chunk_stores[target_name]
+
+    def query_chunks(self, job):
+        '''Tell client which chunks the target doesn't have yet.'''
+
+        # Authenticate client
+        if not self.authenticate_client(job.client_name, job.auth):
+            return self.auth_failed(job)
+
+        store = self.get_chunk_store(job.target_name)
+        return {
+            'success': True,
+            'missing': store.missing(job.chunk_hashes),
+            'job_uuid': job.uuid,
+        }
+
+    def get_chunks_from_client(self, job, stream):
+        '''Store new chunks and the manifest of a file.'''
+
+        # Authenticate client
+        if not self.authenticate_client(job.client_name, job.auth):
+            return self.auth_failed(job)
+        refused = self.refuse_upload(job)
+        if refused is not None:
+            return refused
+
+        # Chunks in the body are back to back in the order given,
+        # framed if they're compressed
+        store = self.get_chunk_store(job.target_name)
+        lengths = {digest: length for digest, _offset, length in job.chunks}
+        codec = getattr(job, 'codec', 'none')
+        nbytes = 0
+        try:
+            with store.batch():
+                for digest in job.missing:
+                    if codec == 'none':
+                        data = stream.read(lengths[digest])
+                        if len(data) != lengths[digest]:
+                            raise ValueError('Body ended early!')
+                        store.put(digest, data)
+                    else:
+                        data = read_frame(stream)
+                        if data is None:
+                            raise ValueError('Body ended early!')
+                        store.put_compressed(
+                            digest, data, codec, lengths[digest])
+                    nbytes += len(data)
+        except (KeyError, ValueError) as e:
             return {
                 'success': False,
-                'msg': 'Could not authenticate client!'
+                'msg': 'Bad chunk upload: %s' % e,
+                'job_uuid': job.uuid,
             }
 
-        # We can't do anything if the target is offline
-        if job.target_name not in self.targets:
+        # Don't accept a manifest we can't restore from
+        missing = store.missing(sorted({c[0] for c in job.chunks}))
+        if missing:
             return {
                 'success': False,
-                'msg': 'target is offline -- job cannot be queued.'
+                'msg': 'Chunks still missing!',
+                'missing': missing,
+                'job_uuid': job.uuid,
             }
 
-        raise NotImplementedError()
-
-        # # We can make job for the target
-        # self.targets[job.target_name]['jobs'][job.client_name].append(Job({
-        #     'job_type': 'send_tree',
-        #     'target_name': target_name,
-        #     'client_name': client_name,
-        # }))
-        #
-        # return {
-        #     'success': True,
-        #     'msg': '"get_tree" job queued.'
-        # }
-
-    def get_file_from_client(self, job):
-        '''Get file from client and store until target gets it.'''
+        # New chunk bytes count against the quota until the manifest
+        # is picked up
+        manifest = json.dumps([[c[0], c[2]] for c in job.chunks]).encode()
+        upload = self.spool.upload_path(
+            job.target_name, job.client_name, job.filename_hash, 'manifest',
+            job.uuid)
+        spool_stream(io.BytesIO(manifest), upload)
+        self.spool.commit(
+            job.target_name, job.client_name, job.filename_hash, 'manifest',
+            upload, nbytes + len(manifest), self.upload_meta(job))
+        logging.info('Stored %d new chunk bytes for %s', nbytes, upload)
+        self.record_upload(job)
+
+        # Any signatures we had are for an older version now
+        self.put_signatures(
+            job.target_name, job.client_name, job.filename_hash, None, None)
+
+        return {
+            'success': True,
+            'nbytes': nbytes,
+            'job_uuid': job.uuid,
+        }
+
+    def get_delta_from_client(self, job, stream):
+        '''Apply or spool a delta against the last copy of a file.
+
+        If the last copy is still spooled it's patched here; otherwise
+        the delta is spooled for the target to apply to its own copy.
+        '''
+
+        # Authenticate client
+        if not self.authenticate_client(job.client_name, job.auth):
+            return self.auth_failed(job)
+        refused = self.refuse_upload(job)
+        if refused is not None:
+            return refused
+
+        # The delta has to be against the copy we have signatures for
+        base = self.get_tree_signatures(
+            job.target_name, job.client_name, [job.filename_hash]).get(
+                job.filename_hash)
+        if base is None or base['block_size'] != job.block_size:
+            return {
+                'success': False,
+                'msg': 'No copy to apply delta to, send whole file.',
+                'send_full': True,
+                'job_uuid': job.uuid,
+            }
+
+        # The target may take the spooled copy while we look at it, in
+        # which case it has the base and gets the delta itself
+        spooled = self.spool.get(
+            job.target_name, job.client_name, job.filename_hash)
+        base_f = None
+        if spooled is not None:
+            try:
+                base_f = self.open_spooled(
+                    self.spool.path(
+                        job.target_name, job.client_name, job.filename_hash),
+                    spooled['meta'].get('codec', 'none'),
+                    spooled['meta'].get('chunk_size', CHUNK_SIZE))
+            except FileNotFoundError:
+                pass
+
+        meta = self.upload_meta(job, codec='none')
+        if base_f is not None:
+            kind = 'file'
+            upload = self.spool.upload_path(
+                job.target_name, job.client_name, job.filename_hash, kind,
+                job.uuid)
+            with base_f, open(str(upload), 'wb') as out:
+                nbytes = apply_delta(base_f, stream, job.block_size, out)
+            if nbytes != job.size:
+                os.remove(str(upload))
+                return {
+                    'success': False,
+                    'msg': 'Patched file is %d bytes, expected %d' % (
+                        nbytes, job.size),
+                    'job_uuid': job.uuid,
+                }
+        else:
+            kind = 'delta'
+            upload = self.spool.upload_path(
+                job.target_name, job.client_name, job.filename_hash, kind,
+                job.uuid)
+            nbytes = spool_stream(stream, upload)
+            meta.update({'block_size': job.block_size, 'size': job.size})
+
+        self.spool.commit(
+            job.target_name, job.client_name, job.filename_hash, kind,
+            upload, nbytes, meta)
+        logging.info('Spooled %d byte %s for %s', nbytes, kind, job.target_name)
 
-        print(base64.b64decode(job.data))
+        self.put_signatures(
+            job.target_name, job.client_name, job.filename_hash,
+            job.signature_block_size, job.signatures)
+        self.record_upload(job)
+
+        return {
+            'success': True,
+            'nbytes': nbytes,
+            'job_uuid': job.uuid,
+        }
+
+    def target_online(self, target_name):
+        '''Whether a target has been in touch recently.'''
+        return self.state.is_online(
+            'target', target_name, self.target_timeout)
+
+    def online_targets(self):
+        '''Targets that have been in touch recently.'''
+        return self.state.online('target', self.target_timeout)
+
+    def online_clients(self):
+        '''Clients that have checked in and not been forgotten.'''
+        return self.state.online('client', self.client_timeout)
+
+    def pull_for_target(self, job):
+        '''Give a target the next uploads waiting for it.
+
+        Long-polls for up to job.wait seconds if nothing is waiting.
+        '''
+
+        # Targets authenticate like clients, under their own name
+        if not self.authenticate_client(
+                target_key(job.target_name), job.auth):
+            return self.auth_failed(job)
+
+        self.state.touch('target', job.target_name)
+        items = self.spool.pending(
+            job.target_name, job.limit or 64,
+            min(job.wait or 0, self.max_pull_wait))
+        self.state.touch('target', job.target_name)
+
+        spool_bytes = self.spool.used(job.target_name)
+        SPOOL_BYTES.set(spool_bytes, target=job.target_name)
+        return {
+            'success': True,
+            'items': items,
+            'spool_bytes': spool_bytes,
+            'job_uuid': job.uuid,
+        }
+
+    def fetch_for_target(self, job):
+        '''Send a target a spooled upload, or chunks, as raw bytes.'''
+
+        if not self.authenticate_client(
+                target_key(job.target_name), job.auth):
+            return self.auth_failed(job)
+
+        # Chunks go back to back, decompressed, in the order asked for
+        if getattr(job, 'chunk_hashes', None) is not None:
+            store = self.get_chunk_store(job.target_name)
+            try:
+                return RawResponse(
+                    data=b''.join(store.get(d) for d in job.chunk_hashes))
+            except (KeyError, OSError):
+                return {
+                    'success': False,
+                    'msg': 'Chunk not found!',
+                    'job_uuid': job.uuid,
+                }
+
+        item = self.spool.item(job.target_name, job.seq)
+        if item is not None:
+            filename = self.spool.path(
+                job.target_name, item['client_name'], item['filename_hash'],
+                item['kind'])
+            try:
+                return RawResponse(f=open(str(filename), 'rb'))
+            except FileNotFoundError:
+                pass
+        return {
+            'success': False,
+            'msg': 'Nothing spooled as %s' % job.seq,
+            'gone': True,
+            'job_uuid': job.uuid,
+        }
+
+    def ack_from_target(self, job):
+        '''A target has stored uploads, so they can be cleaned up.'''
+
+        if not self.authenticate_client(
+                target_key(job.target_name), job.auth):
+            return self.auth_failed(job)
+
+        nacked = self.spool.ack(job.target_name, job.seqs)
+        logging.info('%s stored %d uploads', job.target_name, nacked)
+        return {
+            'success': True,
+            'nacked': nacked,
+            'spool_bytes': self.spool.used(job.target_name),
+            'job_uuid': job.uuid,
+        }
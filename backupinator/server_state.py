@@ -0,0 +1,205 @@
+'''Server state shared by every worker process.
+
+Clients, targets and sessions used to live in each worker's memory, so
+with more than one worker a checkin on one was invisible to the others.
+Here they're kept in SQLite in WAL mode next to the spool, where every
+worker sees the same thing.  When clients and targets were last seen
+is indexed, so finding who's online or evicting whoever's gone quiet
+is a range scan rather than a look at everyone.  Each registered key
+has a version, so workers know when a key they've cached was replaced.
+'''
+
+import os
+import json
+import uuid
+import pathlib
+import sqlite3
+import threading
+from time import time
+
+from backupinator.session import (
+    Session, SessionTable, SESSION_LIFETIME, MAX_CLOCK_SKEW)
+
+class ServerState:
+    '''When clients and targets were last seen, and live sessions.'''
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        pathlib.Path(self.filename).parents[0].mkdir(
+            parents=True, exist_ok=True)
+        self._local = threading.local()
+
+        with self.conn as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS peers ('
+                'kind TEXT NOT NULL, name TEXT NOT NULL, '
+                'last_seen REAL NOT NULL, info TEXT, '
+                'PRIMARY KEY (kind, name))')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS peers_by_last_seen '
+                'ON peers (kind, last_seen)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'session_id TEXT PRIMARY KEY, client TEXT NOT NULL, '
+                'key BLOB NOT NULL, expires REAL NOT NULL)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS sessions_by_expires '
+                'ON sessions (expires)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS sessions_by_client '
+                'ON sessions (client)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS nonces ('
+                'session_id TEXT NOT NULL, nonce TEXT NOT NULL, '
+                'seen REAL NOT NULL, PRIMARY KEY (session_id, nonce))')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS nonces_by_seen ON nonces (seen)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS key_versions ('
+                'name TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+
+    @property
+    def conn(self):
+        '''This thread's connection.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def touch(self, kind, name, info=None):
+        '''Mark a client or target as seen now.'''
+        with self.conn as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO peers (kind, name, last_seen, info) '
+                'VALUES (?, ?, ?, ?)',
+                (kind, name, time(),
+                 None if info is None else json.dumps(info)))
+
+    def last_seen(self, kind, name):
+        '''When a client or target was last seen, None if never.'''
+        row = self.conn.execute(
+            'SELECT last_seen FROM peers WHERE kind = ? AND name = ?',
+            (kind, name)).fetchone()
+        return None if row is None else row[0]
+
+    def info(self, kind, name):
+        '''What was saved with a client or target when it was seen.'''
+        row = self.conn.execute(
+            'SELECT info FROM peers WHERE kind = ? AND name = ?',
+            (kind, name)).fetchone()
+        return None if row is None or row[0] is None else json.loads(row[0])
+
+    def is_online(self, kind, name, timeout):
+        '''Whether a client or target was seen in the last timeout sec.'''
+        seen = self.last_seen(kind, name)
+        return seen is not None and time() - seen < timeout
+
+    def online(self, kind, timeout):
+        '''Names of those seen in the last timeout sec, latest first.'''
+        return [row[0] for row in self.conn.execute(
+            'SELECT name FROM peers WHERE kind = ? AND last_seen >= ? '
+            'ORDER BY last_seen DESC', (kind, time() - timeout))]
+
+    def evict(self, kind, timeout):
+        '''Forget those not seen in timeout sec; returns how many.'''
+        with self.conn as conn:
+            return conn.execute(
+                'DELETE FROM peers WHERE kind = ? AND last_seen < ?',
+                (kind, time() - timeout)).rowcount
+
+    def put_session(self, session):
+        '''Save a session, dropping any that have expired.'''
+        with self.conn as conn:
+            conn.execute(
+                'DELETE FROM sessions WHERE expires < ?', (time(),))
+            conn.execute(
+                'INSERT INTO sessions (session_id, client, key, expires) '
+                'VALUES (?, ?, ?, ?)',
+                (session.session_id, session.client_name, session.key,
+                 session.expires))
+
+    def get_session(self, session_id):
+        '''(client, key, expires) of a session, None if there isn't one.'''
+        row = self.conn.execute(
+            'SELECT client, key, expires FROM sessions '
+            'WHERE session_id = ?', (session_id,)).fetchone()
+        return None if row is None else (row[0], bytes(row[1]), row[2])
+
+    def drop_sessions(self, client_name):
+        '''End all of a client's sessions.'''
+        with self.conn as conn:
+            conn.execute(
+                'DELETE FROM sessions WHERE client = ?', (client_name,))
+
+    def key_version(self, name):
+        '''Times a key has been registered under name, 0 if never.'''
+        row = self.conn.execute(
+            'SELECT version FROM key_versions WHERE name = ?',
+            (name,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def bump_key_version(self, name):
+        '''Note that the key registered under name was replaced.'''
+        with self.conn as conn:
+            conn.execute(
+                'INSERT INTO key_versions (name, version) VALUES (?, 1) '
+                'ON CONFLICT (name) DO UPDATE SET version = version + 1',
+                (name,))
+
+    def use_nonce(self, session_id, nonce, timestamp, now):
+        '''Remember a nonce, False if any worker already saw it.'''
+        with self.conn as conn:
+            # Anything old enough to be rejected by the clock check
+            # doesn't need to be remembered anymore
+            conn.execute(
+                'DELETE FROM nonces WHERE seen < ?',
+                (now - 2*MAX_CLOCK_SKEW,))
+            cur = conn.execute(
+                'INSERT OR IGNORE INTO nonces (session_id, nonce, seen) '
+                'VALUES (?, ?, ?)', (session_id, nonce, timestamp))
+            return cur.rowcount == 1
+
+    def close(self):
+        '''Close this thread's connection.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+class SharedSession(Session):
+    '''A session whose used nonces are shared with other workers.'''
+
+    def __init__(self, state, session_id, key, expires, client_name=None):
+        super(SharedSession, self).__init__(
+            session_id, key, expires, client_name)
+        self.state = state
+
+    def use_nonce(self, nonce, timestamp, now):
+        return self.state.use_nonce(self.session_id, nonce, timestamp, now)
+
+class SharedSessionTable(SessionTable):
+    '''Sessions kept in a ServerState so any worker can check them.'''
+
+    def __init__(self, state, lifetime=SESSION_LIFETIME):
+        super(SharedSessionTable, self).__init__(lifetime)
+        self.state = state
+
+    def create(self, client_name):
+        session = SharedSession(
+            self.state, uuid.uuid4().hex, os.urandom(32),
+            time() + self.lifetime, client_name)
+        self.state.put_session(session)
+        return session
+
+    def get(self, session_id):
+        row = self.state.get_session(session_id)
+        if row is None:
+            return None
+        session = SharedSession(self.state, session_id, row[1], row[2], row[0])
+        return None if session.expired() else session
+
+    def drop_client(self, client_name):
+        self.state.drop_sessions(client_name)
@@ -0,0 +1,117 @@
+'''Short-lived HMAC sessions so RSA is only needed at setup.'''
+
+import os
+import hmac
+import uuid
+import hashlib
+import threading
+from time import time
+from collections import deque
+
+from backupinator.auth import Auth
+
+# How long a session lasts (in seconds)
+SESSION_LIFETIME = 3600
+
+# How far apart client and server clocks may be (in seconds)
+MAX_CLOCK_SKEW = 300
+
+def make_mac(key, message):
+    '''HMAC-SHA256 of a message.'''
+    return hmac.new(key, message.encode(), hashlib.sha256).hexdigest()
+
+class Session:
+    '''A shared key between a client and the server.'''
+
+    def __init__(self, session_id, key, expires, client_name=None):
+        self.session_id = session_id
+        self.key = key
+        self.expires = expires
+        self.client_name = client_name
+
+        # Nonces we've accepted, oldest first, for replay protection
+        self._seen = set()
+        self._seen_order = deque()
+        self._lock = threading.Lock()
+
+    def expired(self, margin=0):
+        '''Whether the session is over (or will be in margin sec).'''
+        return time() + margin >= self.expires
+
+    def sign(self):
+        '''Make an Auth for a single request.'''
+        message = '%f:%s' % (time(), uuid.uuid4().hex)
+        return Auth(message, make_mac(self.key, message), self.session_id)
+
+    def verify(self, auth):
+        '''Check a MAC and make sure the message is fresh and unused.'''
+
+        if self.expired():
+            return False
+        if not hmac.compare_digest(
+                make_mac(self.key, auth.message), auth.hex_signature):
+            return False
+
+        try:
+            timestamp, nonce = auth.message.split(':', 1)
+            timestamp = float(timestamp)
+        except ValueError:
+            return False
+
+        now = time()
+        if abs(now - timestamp) > MAX_CLOCK_SKEW:
+            return False
+        return self.use_nonce(nonce, timestamp, now)
+
+    def use_nonce(self, nonce, timestamp, now):
+        '''Remember a nonce, False if it was already used.'''
+
+        with self._lock:
+            # Anything old enough to be rejected by the clock check
+            # doesn't need to be remembered anymore
+            while self._seen_order and (
+                    self._seen_order[0][0] < now - 2*MAX_CLOCK_SKEW):
+                self._seen.discard(self._seen_order.popleft()[1])
+
+            if nonce in self._seen:
+                return False
+            self._seen.add(nonce)
+            self._seen_order.append((timestamp, nonce))
+        return True
+
+class SessionTable:
+    '''Sessions the server has handed out.'''
+
+    def __init__(self, lifetime=SESSION_LIFETIME):
+        self.lifetime = lifetime
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, client_name):
+        '''Start a new session for a client.'''
+
+        session = Session(
+            uuid.uuid4().hex, os.urandom(32), time() + self.lifetime,
+            client_name)
+        with self._lock:
+            # Good time to forget about old ones
+            for session_id in [
+                    k for k, v in self.sessions.items() if v.expired()]:
+                del self.sessions[session_id]
+            self.sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id):
+        '''Look up a live session.'''
+        session = self.sessions.get(session_id)
+        if session is None or session.expired():
+            return None
+        return session
+
+    def drop_client(self, client_name):
+        '''End all of a client's sessions.'''
+        with self._lock:
+            for session_id in [
+                    k for k, v in self.sessions.items()
+                    if v.client_name == client_name]:
+                del self.sessions[session_id]
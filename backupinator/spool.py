@@ -0,0 +1,218 @@
+'''Uploads held on the server until their targets pick them up.'''
+
+import os
+import re
+import json
+import pathlib
+import sqlite3
+import threading
+from time import time
+
+from backupinator.hashing import DIGEST_SIZES
+
+# What a spooled upload can be: a whole file, a delta against the
+# target's copy, or a chunk manifest
+KINDS = ('file', 'delta', 'manifest')
+
+# Client and target names become directory names, so they're held to
+# a single, ordinary path component
+_SAFE_NAME = re.compile(r'[A-Za-z0-9_@-][A-Za-z0-9_.@-]*')
+_HEX = re.compile(r'[0-9a-f]+')
+
+def check_name(name):
+    '''Raise ValueError unless a name is safe to use in a path.'''
+    if not isinstance(name, str) or not _SAFE_NAME.fullmatch(name) or (
+            '..' in name):
+        raise ValueError('Bad name %r' % (name,))
+    return name
+
+def check_digest(digest):
+    '''Raise ValueError unless digest is lowercase hex of a known length.'''
+    if not isinstance(digest, str) or not _HEX.fullmatch(digest) or (
+            len(digest)//2 not in DIGEST_SIZES or len(digest) % 2):
+        raise ValueError('Bad digest %r' % (digest,))
+    return digest
+
+class Spool:
+    '''Index of spooled uploads for each target, with a byte quota.
+
+    Files live under spool_dir/target/client/ and this index knows
+    which are waiting, in the order they came in, and how many bytes
+    each target has waiting.  Replacing an upload gives it a new seq,
+    so acking an older version never removes a newer one.
+    '''
+
+    def __init__(self, spool_dir, quota=0):
+        self.spool_dir = pathlib.Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.filename = str(self.spool_dir / 'spool.db')
+
+        # Bytes each target may have waiting (0 for no limit)
+        self.quota = quota
+
+        # Guards moving files in and out; waited on by long polls
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+        with self.conn as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS items ('
+                'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'target TEXT NOT NULL, client TEXT NOT NULL, '
+                'filename_hash TEXT NOT NULL, kind TEXT NOT NULL, '
+                'nbytes INTEGER NOT NULL, meta TEXT NOT NULL, '
+                'added REAL NOT NULL, '
+                'UNIQUE (target, client, filename_hash, kind))')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS items_by_target '
+                'ON items (target, seq)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS usage ('
+                'target TEXT PRIMARY KEY, nbytes INTEGER NOT NULL)')
+
+    @property
+    def conn(self):
+        '''This thread's connection.'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def path(self, target, client, filename_hash, kind='file'):
+        '''Where an upload of a kind sits in the spool.'''
+        filename = self.spool_dir / check_name(target) / check_name(
+            client) / check_digest(filename_hash)
+        if kind != 'file':
+            filename = filename.with_name(filename.name + '.' + kind)
+        return filename
+
+    def upload_path(self, target, client, filename_hash, kind, upload_id):
+        '''Where an upload is written before it's committed.'''
+        filename = self.path(target, client, filename_hash, kind)
+        return filename.with_name('%s.%s.upload' % (filename.name, upload_id))
+
+    @staticmethod
+    def _item(row):
+        seq, client, filename_hash, kind, nbytes, meta = row
+        return {
+            'seq': seq,
+            'client_name': client,
+            'filename_hash': filename_hash,
+            'kind': kind,
+            'nbytes': nbytes,
+            'meta': json.loads(meta),
+        }
+
+    def _use(self, conn, target, nbytes):
+        conn.execute(
+            'INSERT INTO usage (target, nbytes) VALUES (?, ?) '
+            'ON CONFLICT (target) DO UPDATE '
+            'SET nbytes = nbytes + excluded.nbytes', (target, nbytes))
+
+    def _remove(self, conn, target, seq):
+        '''Drop a row and its file, returning whether it was there.'''
+
+        row = conn.execute(
+            'SELECT client, filename_hash, kind, nbytes FROM items '
+            'WHERE target = ? AND seq = ?', (target, seq)).fetchone()
+        if row is None:
+            return False
+        client, filename_hash, kind, nbytes = row
+        conn.execute('DELETE FROM items WHERE seq = ?', (seq,))
+        self._use(conn, target, -nbytes)
+        try:
+            os.remove(str(self.path(target, client, filename_hash, kind)))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def commit(self, target, client, filename_hash, kind, upload, nbytes,
+               meta=None):
+        '''Move a finished upload into place and queue it for the target.'''
+
+        assert kind in KINDS, 'Unknown spool kind %s' % kind
+        with self._cond:
+            os.replace(
+                str(upload), str(self.path(
+                    target, client, filename_hash, kind)))
+            with self.conn as conn:
+                old = conn.execute(
+                    'SELECT nbytes FROM items WHERE target = ? AND '
+                    'client = ? AND filename_hash = ? AND kind = ?',
+                    (target, client, filename_hash, kind)).fetchone()
+                conn.execute(
+                    'INSERT OR REPLACE INTO items (target, client, '
+                    'filename_hash, kind, nbytes, meta, added) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (target, client, filename_hash, kind, nbytes,
+                     json.dumps(meta or {}), time()))
+                self._use(conn, target, nbytes - (old[0] if old else 0))
+            self._cond.notify_all()
+
+    def discard(self, target, client, filename_hash, kind):
+        '''Drop an upload that's been superseded.'''
+
+        item = self.get(target, client, filename_hash, kind)
+        if item is not None:
+            self.ack(target, [item['seq']])
+
+    def get(self, target, client, filename_hash, kind='file'):
+        '''The waiting upload of a kind for a file, or None.'''
+
+        row = self.conn.execute(
+            'SELECT seq, client, filename_hash, kind, nbytes, meta '
+            'FROM items WHERE target = ? AND client = ? AND '
+            'filename_hash = ? AND kind = ?',
+            (target, client, filename_hash, kind)).fetchone()
+        return None if row is None else self._item(row)
+
+    def item(self, target, seq):
+        '''A waiting upload by seq, or None if it's gone.'''
+
+        row = self.conn.execute(
+            'SELECT seq, client, filename_hash, kind, nbytes, meta '
+            'FROM items WHERE target = ? AND seq = ?',
+            (target, seq)).fetchone()
+        return None if row is None else self._item(row)
+
+    def pending(self, target, limit=64, wait=0.0):
+        '''Oldest uploads waiting for a target, waiting up to wait sec.
+
+        The database is checked at least every second so uploads
+        spooled by other processes are noticed too.
+        '''
+
+        deadline = time() + wait
+        while True:
+            rows = self.conn.execute(
+                'SELECT seq, client, filename_hash, kind, nbytes, meta '
+                'FROM items WHERE target = ? ORDER BY seq LIMIT ?',
+                (target, limit)).fetchall()
+            remaining = deadline - time()
+            if rows or remaining <= 0:
+                return [self._item(row) for row in rows]
+            with self._cond:
+                self._cond.wait(min(remaining, 1.0))
+
+    def ack(self, target, seqs):
+        '''Forget uploads the target has stored; returns how many.'''
+
+        nacked = 0
+        with self._cond:
+            with self.conn as conn:
+                for seq in seqs:
+                    nacked += self._remove(conn, target, seq)
+        return nacked
+
+    def used(self, target):
+        '''Bytes waiting for a target.'''
+        row = self.conn.execute(
+            'SELECT nbytes FROM usage WHERE target = ?', (target,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def full(self, target):
+        '''Whether a target is over its quota.'''
+        return bool(self.quota) and self.used(target) >= self.quota
@@ -1,11 +1,45 @@
 '''Target that clients send data to backed up at.'''
 
+import io
+import json
+import argparse
 import pathlib
 import logging
+import tempfile
+from time import sleep
 
-from backupinator import TargetDB
+from Cryptodome.Signature import pkcs1_15 # pylint: disable=E0401
+from Cryptodome.Hash import SHA256 # pylint: disable=E0401
+
+from backupinator import Auth, TargetDB
+from backupinator.chunking import chunk_hash, make_chunker
+from backupinator.chunk_store import ChunkStore
+from backupinator.compression import STATS, read_frame
+from backupinator.delta import apply_delta
+from backupinator.metrics import METRICS, SIZE_BUCKETS, enable_tracing, span
+from backupinator.pack import PACK_SIZE
+from backupinator.restore import Restorer
+from backupinator.scheduler import ChunkReader
+from backupinator.job import (
+    RegisterTargetJob, PullJob, FetchJob, AckJob, CHUNK_SIZE)
+from backupinator.transport import Transport
+from backupinator.wire import load_response
 from backupinator.utils import (
-    get_target_config_filename, get_generic_config_val)
+    get_target_config_filename, get_generic_config_val, random_string,
+    make_rsa_keys, target_rsa_key_filename, import_target_rsa_key)
+
+STORE_SECONDS = METRICS.histogram(
+    'backupinator_target_store_seconds', 'Time to fetch and store an upload.',
+    ('kind',))
+STORE_BYTES = METRICS.histogram(
+    'backupinator_target_store_bytes', 'Size of uploads fetched.',
+    ('kind',), SIZE_BUCKETS)
+PULLS = METRICS.counter(
+    'backupinator_target_pulls_total', 'Batches pulled from the server.',
+    ('result',))
+QUARANTINED = METRICS.counter(
+    'backupinator_target_quarantined_total',
+    'Uploads given up on after failing to store.')
 
 class Target:
     '''Runs at remote site and gets client data from server.'''
@@ -22,15 +56,245 @@ class Target:
         self.configfile = get_target_config_filename(target_name)
 
         # Create the backup data directory if it doesn't exist
-        self.backup_dir = self.get_config_val('backup_dir')
-        pathlib.Path(self.backup_dir).mkdir(parents=True, exist_ok=True)
+        self.backup_dir = pathlib.Path(self.get_config_val('backup_dir'))
+        self.backup_dir.mkdir(parents=True, exist_ok=True)
 
         # get a database
-        self.target_db = TargetDB(self.target_name, self.backup_dir)
+        backend = self.get_config_val('db_backend', fallback='dbm')
+        self.target_db = TargetDB(self.target_name, self.backup_dir, backend)
+
+        # File data is stored as deduplicated chunks shared by all
+        # clients, compressed when it's worth it
+        self.chunk_store = ChunkStore(
+            self.backup_dir / 'chunks', backend,
+            self.get_config_val('compression', fallback='none'),
+            self.get_config_val(
+                'pack_size', valtype='int', fallback=PACK_SIZE))
+
+        # Whole files sent to us are split up too; finding boundaries by
+        # content only pays off if it's fast
+        self.chunker = make_chunker(
+            self.get_config_val('chunking', fallback='auto'))
+
+        # Uploads are pulled from the server, long-polling for up to
+        # pull_wait seconds at a time
+        self.server_address = self.get_config_val('server_address')
+        self.pull_batch = self.get_config_val(
+            'pull_batch', valtype='int', fallback=64)
+        self.pull_wait = self.get_config_val(
+            'pull_wait', valtype='float', fallback=30.0)
+
+        # Uploads that failed to store, by seq, and how many tries each
+        # gets before it's set aside
+        self.failures = {}
+        self.max_attempts = self.get_config_val(
+            'max_attempts', valtype='int', fallback=3)
+        self.transport = Transport(read_timeout=self.pull_wait + 60)
+
+        # Metrics are saved next to the backups as we go
+        self.metrics_file = self.backup_dir / 'metrics.prom'
+        if self.get_config_val('trace', valtype='bool', fallback=False):
+            enable_tracing()
 
-    def get_config_val(self, key, valtype='str'):
+        # Generate an RSA key pair if none exists
+        make_rsa_keys(
+            target_rsa_key_filename(self.target_name, public=True),
+            target_rsa_key_filename(self.target_name, public=False),
+            key_size=2048)
+
+    def get_config_val(self, key, valtype='str', fallback=None):
         '''Lookup value in target config file.'''
-        return get_generic_config_val(self.configfile, key, valtype)
+        return get_generic_config_val(
+            self.configfile, key, valtype, fallback)
+
+    def sign_with_priv_key(self):
+        '''Sign a random message with private key.'''
+
+        message = random_string(64)
+        key = import_target_rsa_key(self.target_name, public=False)
+        signature = pkcs1_15.new(key).sign(SHA256.new(message.encode()))
+        return Auth(message, signature.hex())
+
+    def submit(self, job, stream=False):
+        '''Authenticate a job and send it to the server.'''
+        return self.transport.submit(
+            job, stream, sign=self.sign_with_priv_key)
+
+    def register(self):
+        '''Register our public key with the server.'''
+
+        filename = target_rsa_key_filename(self.target_name, public=True)
+        with open(str(filename), 'rb') as f:
+            pub_key = f.read().decode()
+        job = RegisterTargetJob(
+            self.server_address, self.target_name, pub_key, None)
+        return self.submit(job)
+
+    def fetch(self, **kwargs):
+        '''Download a spooled upload or chunks, None if it's gone.'''
+
+        job = FetchJob(self.server_address, self.target_name, None, **kwargs)
+        resp = self.submit(job, stream=True)
+        if not resp.headers.get('Content-Type', '').startswith(
+                'application/octet-stream'):
+            json_data = load_response(resp)
+            if json_data.get('gone'):
+                return None
+            raise ValueError(json_data['msg'])
+
+        # Large uploads go to disk rather than memory
+        out = tempfile.SpooledTemporaryFile(max_size=16*CHUNK_SIZE)
+        if hasattr(resp, 'iter_content'):
+            chunks = resp.iter_content(CHUNK_SIZE)
+        else:
+            chunks = resp.iter_bytes()
+        for chunk in chunks:
+            out.write(chunk)
+        out.seek(0)
+        return out
+
+    def fetch_chunks(self, chunks):
+        '''Download the chunks of a manifest that we don't have.'''
+
+        lengths = dict(chunks)
+        missing = self.missing_chunks(sorted(lengths))
+        for ii in range(0, len(missing), self.pull_batch):
+            batch = missing[ii:ii+self.pull_batch]
+            data = self.fetch(chunk_hashes=batch)
+            if data is None:
+                raise ValueError('Server lost chunks!')
+            with data:
+                for digest in batch:
+                    self.add_chunk(digest, data.read(lengths[digest]))
+
+    def store_item(self, item):
+        '''Fetch one spooled upload and commit it.'''
+
+        client_name = item['client_name']
+        filename_hash = item['filename_hash']
+        meta = item['meta']
+        info = {
+            'tree_value': meta.get('tree_value'),
+            'filename': meta.get('filename'),
+            'mtime': meta.get('mtime'),
+        }
+        if client_name not in self.target_db.client_db:
+            self.register_client(client_name)
+        if meta.get('hashes'):
+            self.target_db.set_client_hashes(client_name, meta['hashes'])
+
+        kind = item['kind']
+        with span('target.store', trace_id=meta.get('trace_id'), kind=kind,
+                  seq=item['seq']), STORE_SECONDS.time(kind=kind):
+            self._store_item(item, client_name, filename_hash, meta, info)
+
+    def _store_item(self, item, client_name, filename_hash, meta, info):
+        '''Body of store_item, timed as a whole.'''
+        data = self.fetch(seq=item['seq'])
+        if data is None:
+            logging.info('Upload %s went away', item['seq'])
+            return
+        with data:
+            STORE_BYTES.observe(
+                data.seek(0, io.SEEK_END), kind=item['kind'])
+            data.seek(0)
+            if item['kind'] == 'file':
+                self.update_file(
+                    client_name, filename_hash, data,
+                    meta.get('codec', 'none'),
+                    chunk_size=meta.get('chunk_size', CHUNK_SIZE), **info)
+            elif item['kind'] == 'delta':
+                self.patch_file(
+                    client_name, filename_hash, data,
+                    meta['block_size'], **info)
+            elif item['kind'] == 'manifest':
+                chunks = json.loads(data.read())
+                self.fetch_chunks(chunks)
+                self.update_manifest(
+                    client_name, filename_hash, chunks, **info)
+            else:
+                raise ValueError('Unknown upload kind %s' % item['kind'])
+
+    def pull(self, wait=0):
+        '''Store the next batch of uploads waiting on the server.
+
+        Uploads are acked once they're committed here so the server can
+        clean up its spool.  The whole batch is written with one fsync
+        per pack, and chunks are synced before the manifests that use
+        them.  An upload that can't be stored is left for next time,
+        and quarantined once it's failed max_attempts times; the ones
+        that were stored are acked either way.  Connection errors stop
+        the batch early.  Returns how many were stored.
+        '''
+
+        job = PullJob(
+            self.server_address, self.target_name, None, self.pull_batch,
+            wait)
+        json_data = load_response(self.submit(job))
+        if not json_data['success']:
+            logging.info('Could not pull: %s', json_data['msg'])
+            return 0
+
+        done = []
+        stored = 0
+        try:
+            with self.target_db.batch(), self.chunk_store.batch():
+                for item in json_data['items']:
+                    try:
+                        self.store_item(item)
+                    except OSError:
+                        raise
+                    except Exception as e: # pylint: disable=W0703
+                        if self.failed(item, e):
+                            done.append(item['seq'])
+                        continue
+                    self.failures.pop(item['seq'], None)
+                    done.append(item['seq'])
+                    stored += 1
+        finally:
+            if done:
+                self.submit(AckJob(
+                    self.server_address, self.target_name, done, None))
+        return stored
+
+    def failed(self, item, error):
+        '''Note an upload that couldn't be stored.
+
+        Returns True once it's been quarantined and can be acked.
+        '''
+
+        seq = item['seq']
+        self.failures[seq] = self.failures.get(seq, 0) + 1
+        logging.exception(
+            'Could not store upload %s (attempt %d)', seq, self.failures[seq])
+        if self.failures[seq] < self.max_attempts:
+            return False
+
+        # Keep what we know of it; the client sends the file again since
+        # our tree never got it
+        quarantine_dir = self.backup_dir / 'quarantine'
+        quarantine_dir.mkdir(parents=True, exist_ok=True)
+        with open(str(quarantine_dir / ('%s.json' % seq)), 'w') as f:
+            json.dump(dict(item, error=repr(error)), f)
+        del self.failures[seq]
+        QUARANTINED.inc()
+        return True
+
+    def run(self):
+        '''Pull and store uploads as they come in, until interrupted.'''
+
+        try:
+            while True:
+                try:
+                    self.pull(self.pull_wait)
+                    PULLS.inc(result='ok')
+                except Exception as e: # pylint: disable=W0703
+                    logging.info('Pull failed (%s), retrying', e)
+                    PULLS.inc(result='error')
+                    sleep(self.pull_wait)
+                METRICS.write(self.metrics_file)
+        except KeyboardInterrupt:
+            pass
 
     def get_client_directory(self, client_name):
         '''Return name of directory holding client data.'''
@@ -46,16 +310,105 @@ class Target:
         pathlib.Path(self.get_client_directory(client_name)).mkdir(
             parents=True, exist_ok=True)
 
-    def update_file(self, client_name, filename_hash, data):
-        '''Add or update a file stored on target.'''
+    def update_file(self, client_name, filename_hash, data, codec='none',
+                    tree_value=None, filename=None, mtime=None,
+                    chunk_size=CHUNK_SIZE):
+        '''Add or update a file stored on target.
+
+        data is a binary file object (or bytes), read as it's chunked.
+        If codec isn't 'none', it's a series of compressed frames as
+        sent by the client, each of up to chunk_size bytes.
+        '''
+
+        if isinstance(data, bytes):
+            data = io.BytesIO(data)
+        if codec != 'none':
+            frames = data
+            data = ChunkReader(
+                STATS.decompress(codec, f, chunk_size)
+                for f in iter(lambda: read_frame(frames), None))
+
+        # Store the data as chunks, only writing ones we haven't seen
+        chunks = []
+        algorithm = self.target_db.get_client_hashes(client_name)['content']
+        for chunk in self.chunker.iter_chunks(data):
+            digest = chunk_hash(chunk, algorithm)
+            self.chunk_store.put(digest, chunk)
+            chunks.append([digest, len(chunk)])
+
+        self.update_manifest(
+            client_name, filename_hash, chunks, tree_value, filename, mtime)
+        logging.info('Compression so far: %s', STATS.report())
+
+    def patch_file(self, client_name, filename_hash, delta, block_size,
+                   tree_value=None, filename=None, mtime=None):
+        '''Update a stored file with a delta against its current version.
+
+        delta is a binary file object (or bytes); the new version is
+        rebuilt on disk if it's large.
+        '''
+
+        if isinstance(delta, bytes):
+            delta = io.BytesIO(delta)
+        base = io.BytesIO(self.read_file(client_name, filename_hash))
+        with tempfile.SpooledTemporaryFile(max_size=16*CHUNK_SIZE) as out:
+            apply_delta(base, delta, block_size, out)
+            out.seek(0)
+            self.update_file(
+                client_name, filename_hash, out, tree_value=tree_value,
+                filename=filename, mtime=mtime)
+
+    def missing_chunks(self, chunk_hashes):
+        '''Which chunks we still need from clients.'''
+        return self.chunk_store.missing(chunk_hashes)
+
+    def add_chunk(self, digest, data, codec='none'):
+        '''Store a single chunk sent by a client.'''
+        if codec != 'none':
+            return self.chunk_store.put_compressed(digest, data, codec)
+        return self.chunk_store.put(digest, data)
+
+    def update_manifest(self, client_name, filename_hash, chunks,
+                        tree_value=None, filename=None, mtime=None):
+        '''Add or update a file given as a list of [chunk_hash, length].'''
+
+        # Every chunk needs to be here before the file can be restored
+        missing = self.missing_chunks([c[0] for c in chunks])
+        if missing:
+            raise ValueError('Missing %d chunks for %s' % (
+                len(missing), filename_hash))
 
         # Make sure client directory exists
         client_dir = self.get_client_directory(client_name)
         client_dir.mkdir(parents=True, exist_ok=True)
 
-        # Add data to backup_dir
-        with open(client_dir / filename_hash, 'wb') as f:
-            f.write(data)
-
         # Add filename to database
-        self.target_db.add_file(client_name, filename_hash)
+        self.target_db.add_manifest(client_name, filename_hash, chunks)
+        self.target_db.add_file(
+            client_name, filename_hash, tree_value, filename, mtime)
+
+    def restore(self, client_name, dest, prefix='', at=None, workers=None):
+        '''Write a client's files under prefix, as of time at, to dest.'''
+
+        if workers is None:
+            workers = self.get_config_val(
+                'restore_workers', valtype='int', fallback=8)
+        restorer = Restorer(self.target_db, self.chunk_store, workers)
+        return restorer.restore(client_name, dest, prefix, at)
+
+    def read_file(self, client_name, filename_hash):
+        '''Reassemble a stored file from its chunks.'''
+
+        chunks = self.target_db.get_manifest(client_name, filename_hash)
+        return b''.join(self.chunk_store.get(c[0]) for c in chunks)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Register a target and store what clients send it.')
+    parser.add_argument('target_name')
+    args = parser.parse_args()
+
+    target = Target(args.target_name)
+    target.register()
+    target.run()
@@ -1,41 +1,235 @@
 '''Abstraction for database for the target.'''
 
-import dbm
-import contextlib
+import json
 import pathlib
+import contextlib
 from time import time
 
+from backupinator.db import open_store
+from backupinator.hashing import DEFAULT_HASHES, check_hashes
+from backupinator.merkle import MerkleTree
+
+def version_key(filename_hash, index):
+    '''Key one version of a file is kept under.'''
+    return '%s:%d' % (filename_hash, index)
+
 class TargetDB:
     '''Database methods for the target.'''
 
-    def __init__(self, target_name, backup_dir):
+    def __init__(self, target_name, backup_dir, backend='dbm'):
 
         self.target_name = target_name
+        self.backend = backend
 
         # Client DB
         self.backup_dir = pathlib.Path(backup_dir)
         self.client_db_filename = self.backup_dir / 'target_clients'
         pathlib.Path(self.client_db_filename).parents[0].mkdir(
             parents=True, exist_ok=True)
+        self.client_db = open_store(self.client_db_filename, backend)
+
+        # Per-client stores, kept open once used
+        self._stores = {}
+        self._trees = {}
+
+        # Stores and trees used in the current batch
+        self._batch = None
+        self._batched = set()
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Keep each store used open, and each tree unhashed, to the end.
+
+        Stores are only pulled into the batch as they're used, so a
+        batch of many files for a client opens its stores once and
+        rehashes its tree once.
+        '''
+
+        if self._batch is not None:
+            yield self
+            return
+        with contextlib.ExitStack() as stack:
+            self._batch = stack
+            try:
+                yield self
+            finally:
+                self._batch = None
+                self._batched = set()
+
+    def _join_batch(self, key, thing):
+        '''Have a store or tree take part in the current batch.'''
+        if self._batch is not None and key not in self._batched:
+            self._batch.enter_context(thing.batch())
+            self._batched.add(key)
+        return thing
+
+    def get_store(self, filename):
+        '''Open a store once and keep it around.'''
+        if filename not in self._stores:
+            self._stores[filename] = open_store(filename, self.backend)
+        return self._join_batch(filename, self._stores[filename])
 
     def get_client_filenames_db_filename(self, client_name):
         '''Find where database is for storing filenames.'''
         return self.backup_dir / client_name / 'filenames'
 
+    def get_client_manifests_db_filename(self, client_name):
+        '''Find where database is for storing file manifests.'''
+        return self.backup_dir / client_name / 'manifests'
+
+    def get_client_versions_db_filename(self, client_name):
+        '''Find where database is for the history of each file.'''
+        return self.backup_dir / client_name / 'versions'
+
+    def get_client_tree_db_filename(self, client_name):
+        '''Find where database is for the Merkle summary of a client.'''
+        return self.backup_dir / client_name / 'merkle'
+
+    def get_tree(self, client_name):
+        '''Merkle summary of the client's tree as we have it.'''
+        store = self.get_store(self.get_client_tree_db_filename(client_name))
+        if client_name not in self._trees:
+            self._trees[client_name] = MerkleTree(store)
+        return self._join_batch(
+            ('tree', client_name), self._trees[client_name])
+
     def add_client(self, client_name):
         '''Add client.'''
 
-        with dbm.open(self.client_db_filename, 'c') as db:
-            db[client_name] = True
+        self.client_db[client_name] = True
 
         # Create a filenames database for this client
         filename = self.get_client_filenames_db_filename(client_name)
         pathlib.Path(filename).parents[0].mkdir(parents=True, exist_ok=True)
 
-    def add_file(self, client_name, filename_hash):
-        '''Add a backed-up file.'''
+    def set_client_hashes(self, client_name, hashes):
+        '''Record the hash algorithms a client uses.'''
+        hashes = json.dumps(check_hashes(hashes), sort_keys=True)
+        if self.client_db.get(client_name) != hashes.encode():
+            self.client_db[client_name] = hashes
+
+    def get_client_hashes(self, client_name):
+        '''Hash algorithms a client uses, the defaults if it never said.'''
+        try:
+            hashes = json.loads(self.client_db.get(client_name))
+        except (TypeError, ValueError):
+            hashes = None
+        if not isinstance(hashes, dict):
+            return dict(DEFAULT_HASHES)
+        return dict(DEFAULT_HASHES, **hashes)
+
+    def add_file(self, client_name, filename_hash, tree_value=None,
+                 filename=None, mtime=None):
+        '''Add a backed-up file once its manifest is in.
+
+        tree_value is what the client's tree had for the file when it
+        was sent, which keeps our Merkle summary comparable to its own.
+        filename and mtime are what the file is restored as.
+        '''
+
+        db = self.get_store(self.get_client_filenames_db_filename(client_name))
+        if filename is None:
+            filename = self.get_file_info(client_name, filename_hash).get(
+                'filename')
+
+        # Store with most recent time updated
+        now = time()
+        db[filename_hash] = json.dumps({
+            'time': now, 'filename': filename, 'mtime': mtime})
+
+        # Every version is kept so files can be restored as they were,
+        # each under its own key next to a count of them
+        versions = self.get_store(
+            self.get_client_versions_db_filename(client_name))
+        count = self._version_count(versions, filename_hash)
+        versions[version_key(filename_hash, count)] = json.dumps(
+            [now, mtime, self.get_manifest(client_name, filename_hash)])
+        versions[filename_hash] = count + 1
+
+        if tree_value is not None:
+            self.get_tree(client_name).update(filename_hash, tree_value)
+
+    def get_file_info(self, client_name, filename_hash):
+        '''{time, filename, mtime} of a file's latest version.'''
+
+        db = self.get_store(self.get_client_filenames_db_filename(client_name))
+        val = db.get(filename_hash)
+        if val is None:
+            return {}
+
+        # Files added before we kept names only have the time
+        info = json.loads(val)
+        if not isinstance(info, dict):
+            info = {'time': info, 'filename': None, 'mtime': None}
+        return info
+
+    def iter_files(self, client_name):
+        '''(filename_hash, info) of every file backed up for a client.'''
+
+        db = self.get_store(self.get_client_filenames_db_filename(client_name))
+        for key, _val in db.items():
+            filename_hash = key.decode() if isinstance(key, bytes) else key
+            yield filename_hash, self.get_file_info(client_name, filename_hash)
+
+    def get_version(self, client_name, filename_hash, at=None):
+        '''(time, mtime, chunks) of a file as of time at (default now).
+
+        None if the file hadn't been backed up yet at that time.
+        '''
+
+        versions = self.get_store(
+            self.get_client_versions_db_filename(client_name))
+        val = versions.get(filename_hash)
+
+        # Files added before we kept history only have their latest
+        if val is None:
+            info = self.get_file_info(client_name, filename_hash)
+            history = [[
+                info.get('time', 0), info.get('mtime'),
+                self.get_manifest(client_name, filename_hash)]]
+        else:
+            history = json.loads(val)
+
+        # Older histories are one list, newer ones a count of versions
+        if isinstance(history, list):
+            newest_first = reversed(history)
+        else:
+            newest_first = (
+                json.loads(versions[version_key(filename_hash, ii)])
+                for ii in range(history - 1, -1, -1))
+        for version in newest_first:
+            if at is None or version[0] <= at:
+                return tuple(version)
+        return None
+
+    @staticmethod
+    def _version_count(versions, filename_hash):
+        '''How many versions of a file are kept.
+
+        Histories from when they were one JSON list under the filename
+        hash are split into a key per version the first time a version
+        is added.
+        '''
+
+        val = versions.get(filename_hash)
+        if val is None:
+            return 0
+        history = json.loads(val)
+        if not isinstance(history, list):
+            return history
+        for ii, version in enumerate(history):
+            versions[version_key(filename_hash, ii)] = json.dumps(version)
+        versions[filename_hash] = len(history)
+        return len(history)
+
+    def add_manifest(self, client_name, filename_hash, chunks):
+        '''Record the chunks a backed-up file is made of.'''
+
+        db = self.get_store(self.get_client_manifests_db_filename(client_name))
+        db[filename_hash] = json.dumps(chunks)
+
+    def get_manifest(self, client_name, filename_hash):
+        '''List of [chunk_hash, length] making up a file.'''
 
-        db_filename = self.get_client_filenames_db_filename(client_name)
-        with dbm.open(db_filename, 'c') as db:
-            # Store with most recent time updated
-            db[filename_hash] = str(time())
+        db = self.get_store(self.get_client_manifests_db_filename(client_name))
+        return json.loads(db[filename_hash])
@@ -0,0 +1,138 @@
+'''Shared HTTP connections for submitting jobs.'''
+
+import logging
+from time import sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from backupinator import wire
+from backupinator.metrics import METRICS, TRACE_HEADER, current_trace, span
+
+try:
+    import httpx # pylint: disable=E0401
+except ImportError:
+    httpx = None
+
+# Responses worth trying again
+RETRY_STATUSES = (502, 503, 504)
+
+REQUESTS = METRICS.counter(
+    'backupinator_requests_total', 'Jobs sent to the server.', ('job',))
+REQUEST_SECONDS = METRICS.histogram(
+    'backupinator_request_seconds', 'Time for the server to answer a job.',
+    ('job',))
+RETRIES = METRICS.counter(
+    'backupinator_request_retries_total', 'Jobs sent again.', ('job',))
+
+class Transport:
+    '''Keep-alive connection pool with retries and timeouts.
+
+    One Transport is shared by all of a client's jobs so connections
+    (and TLS handshakes) are reused.  If http2 is asked for and httpx
+    is installed, requests are multiplexed over HTTP/2 instead.
+    '''
+
+    def __init__(self, pool_size=10, retries=3, backoff=0.5,
+                 connect_timeout=5.0, read_timeout=60.0, http2=False,
+                 binary=True):
+
+        # Only switch to the binary format once the server says it
+        # understands our version of it
+        self.allow_binary = binary
+        self.binary = False
+
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.http2 = http2 and httpx is not None
+        if http2 and not self.http2:
+            logging.info('httpx not installed, falling back to HTTP/1.1')
+
+        if self.http2:
+            self.session = httpx.Client(
+                http2=True,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size))
+        else:
+            # Retries are done here rather than by urllib3 so streamed
+            # bodies can be regenerated for each attempt
+            self.session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size,
+                max_retries=0)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+    def _post(self, url, post_opts, stream=False):
+        '''Send one POST.'''
+
+        if not self.http2:
+            return self.session.post(
+                url, timeout=self.timeout, stream=stream, **post_opts)
+
+        # httpx calls a streamed body 'content'
+        post_opts = dict(post_opts)
+        if 'data' in post_opts:
+            post_opts['content'] = post_opts.pop('data')
+        return self.session.post(url, **post_opts)
+
+    def post_opts(self, job):
+        '''Pick the wire format for a job, passing on any trace.'''
+
+        if self.binary and wire.has_schema(job):
+            opts = wire.post_opts(job)
+        else:
+            opts = job.post_opts()
+
+        trace_id = current_trace()
+        if trace_id is not None:
+            opts['headers'] = dict(
+                opts.get('headers') or {}, **{TRACE_HEADER: trace_id})
+        return opts
+
+    def submit(self, job, stream=False, sign=None):
+        '''POST a job, backing off and retrying on transient errors.
+
+        With stream, the response body is left to be read as it comes
+        in (over HTTP/2 it's read all at once).  sign, if given, is
+        called for a fresh job.auth before every attempt, since the
+        server turns away a session nonce it has already seen.
+        '''
+
+        errors = (requests.ConnectionError, requests.Timeout)
+        if self.http2:
+            errors = (httpx.TransportError,)
+
+        REQUESTS.inc(job=job.job_type)
+        with span('http.' + job.job_type), REQUEST_SECONDS.time(
+                job=job.job_type):
+            attempt = 0
+            while True:
+                if sign is not None:
+                    job.auth = sign()
+                try:
+                    resp = self._post(
+                        job.server_address, self.post_opts(job), stream)
+                    if self.allow_binary and wire.speaks(
+                            resp.headers.get(wire.WIRE_HEADER)):
+                        self.binary = True
+                    if (resp.status_code not in RETRY_STATUSES or
+                            attempt >= self.retries):
+                        return resp
+                    logging.info('Got %d, retrying', resp.status_code)
+                except errors as e:
+                    if attempt >= self.retries:
+                        raise
+                    logging.info('Request failed (%s), retrying', e)
+
+                RETRIES.inc(job=job.job_type)
+                sleep(self.backoff*2**attempt)
+                attempt += 1
+
+    def close(self):
+        '''Close all pooled connections.'''
+        self.session.close()
@@ -4,12 +4,16 @@ from random import choice
 import string
 import configparser
 import pathlib
+import os
 from time import time
-import hashlib
 import logging
 
 from Cryptodome.PublicKey import RSA # pylint: disable=E0401
 
+from backupinator.cache import FileCache
+from backupinator.hashing import DEFAULT_HASHES, get_hash
+from backupinator.walker import parallel_walk
+
 def random_string(nchar=10):
     '''Generate a random string of fixed length.'''
     return ''.join(choice(string.ascii_letters) for i in range(nchar))
@@ -32,11 +36,32 @@ def get_client_config_filename(client_name):
 
     return 'client_default.ini'
 
-def get_generic_config_val(filename, key, valtype='str'):
-    '''Read value from config file.'''
+def get_server_config_filename():
+    '''Conventionalize server config file name.'''
+
+    filename = 'server.ini'
+    if pathlib.Path(filename).exists():
+        return filename
+    return 'server_default.ini'
+
+def read_config(filename):
+    '''Parse a config file.'''
 
     config = configparser.ConfigParser()
     config.read(filename)
+    return config
+
+# Parsed config files, reread only when they change on disk
+_CONFIG_CACHE = FileCache(read_config)
+
+def get_generic_config_val(filename, key, valtype='str', fallback=None):
+    '''Read value from config file.'''
+
+    config = _CONFIG_CACHE.get(filename)
+
+    # Newer options may be missing from older config files
+    if fallback is not None and not config.has_option('DEFAULT', key):
+        return fallback
 
     if valtype == 'str':
         return config['DEFAULT'][key]
@@ -95,6 +120,16 @@ def client_rsa_key_filename(client_name, public=True):
         return dirpath / 'backupinator_rsa_public_key.pem'
     return dirpath / 'backupinator_rsa_private_key.pem'
 
+def target_rsa_key_filename(target_name, public=True):
+    '''Get the path of the public or private RSA key for target.'''
+
+    dirpath = pathlib.Path(
+        'target_data/%s/rsa_keys/' % target_name)
+
+    if public:
+        return dirpath / 'backupinator_rsa_public_key.pem'
+    return dirpath / 'backupinator_rsa_private_key.pem'
+
 def load_client_rsa_key(client_name, public=True):
     '''Get public or private RSA key from file.'''
 
@@ -107,6 +142,57 @@ def load_client_rsa_key(client_name, public=True):
 
     return key.decode()
 
+def tree_item(filename, mtime, hash_filenames=True, hash_times=True,
+              name_hash=DEFAULT_HASHES['name'],
+              change_hash=DEFAULT_HASHES['change']):
+    '''Key and value stored in the tree for a file.'''
+
+    key = str(filename)
+    if hash_filenames:
+        key = get_hash(name_hash).hexdigest(key.encode())
+
+    val = str(mtime)
+    if hash_times:
+        val = get_hash(change_hash).hexdigest(val.encode())
+
+    return key, val
+
+def get_mtime(filename):
+    '''Modification time of a file, None if it's gone.'''
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+def iter_tree(tracked_dirs, hash_filenames=True, hash_times=True,
+              workers=8, hashes=None):
+    '''Yield (key, val) tree items as directories are walked.'''
+
+    hashes = dict(DEFAULT_HASHES, **(hashes or {}))
+    for listing in parallel_walk(
+            [os.path.normpath(d) for d in tracked_dirs], workers=workers):
+        for name, st in listing.stats.items():
+            yield tree_item(
+                os.path.join(listing.dirpath, name), st.st_mtime,
+                hash_filenames, hash_times, hashes['name'], hashes['change'])
+
+def import_rsa_key(filename):
+    '''Read and import an RSA key from file.'''
+
+    with open(str(filename), 'rb') as file:
+        return RSA.import_key(file.read())
+
+# Imported keys, reimported only when the key files change
+_RSA_KEY_CACHE = FileCache(import_rsa_key)
+
+def import_client_rsa_key(client_name, public=True):
+    '''Get public or private RSA key object, imported once.'''
+    return _RSA_KEY_CACHE.get(client_rsa_key_filename(client_name, public))
+
+def import_target_rsa_key(target_name, public=True):
+    '''Get target's public or private RSA key object, imported once.'''
+    return _RSA_KEY_CACHE.get(target_rsa_key_filename(target_name, public))
+
 def make_tree(client_name, hash_filenames=True, hash_times=True):
     '''Create hashes of filenames.'''
 
@@ -114,24 +200,37 @@ def make_tree(client_name, hash_filenames=True, hash_times=True):
     configfile = get_client_config_filename(client_name)
     tracked_dirs = get_generic_config_val(
         configfile, 'tracked_dirs').split(',')
+    workers = get_generic_config_val(
+        configfile, 'scan_workers', 'int', fallback=8)
+    hashes = {
+        role: get_generic_config_val(
+            configfile, role + '_hash', fallback=default)
+        for role, default in DEFAULT_HASHES.items()}
 
-    tree = {}
     t0 = time()
-    for d in tracked_dirs:
-        for file in pathlib.Path(d).rglob('*'):
-            if file.is_file():
-
-                key = str(file)
-                if hash_filenames:
-                    key = hashlib.sha224(key.encode()).hexdigest()
-
-                val = str(file.stat().st_mtime)
-                if hash_times:
-                    val = hashlib.sha224(val.encode()).hexdigest()
-
-                # Update file tree (list really...)
-                tree[key] = val
-    # print(tree)
+    tree = dict(iter_tree(
+        tracked_dirs, hash_filenames, hash_times, workers, hashes))
     logging.info('Took %g sec to find all files', (time() - t0))
 
     return tree
+
+def spool_stream(stream, filename, chunk_size=1024*1024):
+    '''Copy a file-like stream to disk chunk by chunk.'''
+
+    # Write to a temporary file first so partial uploads are never
+    # mistaken for complete ones
+    filename = pathlib.Path(filename)
+    filename.parents[0].mkdir(parents=True, exist_ok=True)
+    partial = filename.with_name(filename.name + '.part')
+
+    nbytes = 0
+    with open(str(partial), 'wb') as f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+            nbytes += len(chunk)
+
+    os.replace(str(partial), str(filename))
+    return nbytes
@@ -0,0 +1,126 @@
+'''Parallel directory walking and file hashing.'''
+
+import os
+from collections import deque
+from concurrent.futures import (
+    ThreadPoolExecutor, wait, FIRST_COMPLETED)
+
+from backupinator.hashing import get_hash
+
+class DirListing:
+    '''What a worker found in a single directory.'''
+
+    def __init__(self, dirpath, cached=None):
+        self.dirpath = dirpath
+        self.cached = cached
+
+        # None if the directory is gone
+        self.mtime_ns = None
+
+        # name -> stat result for regular files
+        self.stats = {}
+
+        # names of subdirectories
+        self.dirs = []
+
+        # True if the cached listing was reused
+        self.skipped = False
+
+    @property
+    def subdirs(self):
+        '''Full paths of the subdirectories.'''
+        return [os.path.join(self.dirpath, d) for d in self.dirs]
+
+def list_dir(dirpath, cached=None):
+    '''List a directory with os.scandir.
+
+    If cached is (mtime_ns, files, dirs) and the directory mtime still
+    matches, the listing is reused and only the files are stat'ed.
+    '''
+
+    listing = DirListing(dirpath, cached)
+    try:
+        listing.mtime_ns = os.stat(dirpath).st_mtime_ns
+    except OSError:
+        return listing
+
+    if cached is not None and cached[0] == listing.mtime_ns:
+        listing.skipped = True
+        listing.dirs = list(cached[2])
+        for name in cached[1]:
+            try:
+                listing.stats[name] = os.stat(os.path.join(dirpath, name))
+            except OSError:
+                pass
+        return listing
+
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    listing.dirs.append(entry.name)
+                elif entry.is_file():
+                    listing.stats[entry.name] = entry.stat()
+            except OSError:
+                pass
+    return listing
+
+def parallel_walk(roots, lookup=None, workers=8):
+    '''Walk directory trees in a thread pool.
+
+    Yields a DirListing for each directory as soon as it is listed.
+    lookup(dirpath) is called from the calling thread to get the cached
+    listing handed to list_dir, so it may safely touch a database.
+    '''
+
+    pending = deque(roots)
+    max_inflight = 4*workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        inflight = set()
+        while pending or inflight:
+
+            # Keep the pool busy without queuing the whole tree
+            while pending and len(inflight) < max_inflight:
+                dirpath = pending.popleft()
+                cached = lookup(dirpath) if lookup is not None else None
+                inflight.add(pool.submit(list_dir, dirpath, cached))
+
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                listing = future.result()
+                pending.extend(listing.subdirs)
+                yield listing
+
+def hash_file(filename, algorithm='sha224', blocksize=1024*1024):
+    '''Hex digest of a file's contents.'''
+
+    h = get_hash(algorithm).new()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def hash_files(filenames, algorithm='sha224', workers=4):
+    '''Hash files in a thread pool, yielding (filename, digest) in order.
+
+    hashlib releases the GIL while hashing large buffers, so threads
+    give real parallelism here.  Files that can't be read give None.
+    '''
+
+    def _hash(filename):
+        try:
+            return filename, hash_file(filename, algorithm)
+        except OSError:
+            return filename, None
+
+    window = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for filename in filenames:
+            window.append(pool.submit(_hash, filename))
+            if len(window) >= 4*workers:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
@@ -0,0 +1,191 @@
+'''Watching tracked directories for changes as they happen.'''
+
+import os
+import abc
+import logging
+from time import time, sleep
+
+try:
+    import inotify_simple # pylint: disable=E0401
+except ImportError:
+    inotify_simple = None
+
+class Watcher(abc.ABC):
+    '''Reports paths that may have changed since the last poll.'''
+
+    def __init__(self, tracked_dirs):
+        self.tracked_dirs = [os.path.normpath(d) for d in tracked_dirs]
+
+    def start(self):
+        '''Begin watching.'''
+
+    @abc.abstractmethod
+    def poll(self, timeout):
+        '''Wait up to timeout seconds for changes.
+
+        Returns (paths, rescan): the paths that changed and whether
+        track of changes was lost so a full scan is needed.
+        '''
+
+    def close(self):
+        '''Stop watching.'''
+
+class PollingWatcher(Watcher):
+    '''Fallback that asks for an (incremental) scan every interval.'''
+
+    def __init__(self, tracked_dirs, interval=60.0):
+        super(PollingWatcher, self).__init__(tracked_dirs)
+        self.interval = interval
+        self._next = time() + interval
+
+    def poll(self, timeout):
+        wait = self._next - time()
+        if wait > timeout:
+            sleep(timeout)
+            return [], False
+        sleep(max(wait, 0))
+        self._next = time() + self.interval
+        return [], True
+
+class InotifyWatcher(Watcher):
+    '''Event-driven watching of every directory under tracked_dirs.'''
+
+    def __init__(self, tracked_dirs):
+        super(InotifyWatcher, self).__init__(tracked_dirs)
+        flags = inotify_simple.flags
+        self.flags = flags
+        self.mask = (
+            flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.ATTRIB |
+            flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO |
+            flags.DELETE_SELF)
+        self.inotify = None
+
+        # Watch descriptor -> directory
+        self.wds = {}
+
+    def start(self):
+        self.inotify = inotify_simple.INotify()
+        for dirpath in self.tracked_dirs:
+            self.add_tree(dirpath)
+
+    def add_tree(self, dirpath):
+        '''Watch a directory and those below it, returning its files.
+
+        Files are returned so anything made before the watch was added
+        isn't missed.
+        '''
+
+        files = []
+        for root, _dirs, names in os.walk(dirpath):
+            try:
+                wd = self.inotify.add_watch(root, self.mask)
+            except FileNotFoundError:
+                continue
+            self.wds[wd] = root
+            files += [os.path.join(root, name) for name in names]
+        return files
+
+    def drop_tree(self, dirpath):
+        '''Stop watching a directory that moved away.'''
+
+        prefix = dirpath + os.sep
+        for wd, root in list(self.wds.items()):
+            if root == dirpath or root.startswith(prefix):
+                del self.wds[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+
+    def poll(self, timeout):
+        flags = self.flags
+        paths = set()
+        rescan = False
+        for event in self.inotify.read(timeout=int(timeout*1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                rescan = True
+                continue
+            if event.mask & flags.IGNORED:
+                self.wds.pop(event.wd, None)
+                continue
+            dirpath = self.wds.get(event.wd)
+            if dirpath is None:
+                continue
+            path = os.path.join(dirpath, event.name) if event.name else dirpath
+            paths.add(path)
+
+            if not event.mask & flags.ISDIR:
+                continue
+            if event.mask & (flags.CREATE | flags.MOVED_TO):
+                try:
+                    paths.update(self.add_tree(path))
+                except OSError as e:
+                    # Most likely out of watches
+                    logging.info('Could not watch %s (%s)', path, e)
+                    rescan = True
+            elif event.mask & flags.MOVED_FROM:
+                self.drop_tree(path)
+
+        return sorted(paths), rescan
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+def make_watcher(tracked_dirs, kind='auto', interval=60.0):
+    '''Start the best watcher available ('auto', 'inotify' or 'poll').'''
+
+    if kind in ('auto', 'inotify'):
+        if inotify_simple is None:
+            logging.info('inotify_simple not installed, polling instead')
+        else:
+            watcher = InotifyWatcher(tracked_dirs)
+            try:
+                watcher.start()
+                return watcher
+            except OSError as e:
+                logging.info('Could not use inotify (%s), polling instead', e)
+                watcher.close()
+
+    watcher = PollingWatcher(tracked_dirs, interval)
+    watcher.start()
+    return watcher
+
+class ChangeQueue:
+    '''Changed paths waiting for things to settle down.
+
+    A path is ready once it's gone debounce seconds without another
+    event, or max_delay seconds after its first one so files that are
+    always being written to still get backed up.
+    '''
+
+    def __init__(self, debounce=2.0, max_delay=30.0):
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        # path -> (time of first event, time of last event)
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, paths, now=None):
+        '''Note events for paths.'''
+        if now is None:
+            now = time()
+        for path in paths:
+            first = self.pending.get(path, (now, now))[0]
+            self.pending[path] = (first, now)
+
+    def pop_ready(self, now=None):
+        '''Remove and return the paths that are ready.'''
+
+        if now is None:
+            now = time()
+        ready = [
+            path for path, (first, last) in self.pending.items()
+            if now - last >= self.debounce or now - first >= self.max_delay]
+        for path in ready:
+            del self.pending[path]
+        return ready
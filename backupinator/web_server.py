@@ -1,13 +1,17 @@
 '''Endpoints to interact with server.'''
 
+import os
+
 import falcon # pylint: disable=E0401
 import jsons # pylint: disable=E0401
 
-from backupinator import Server
+from backupinator import Server, wire
 from backupinator.job import * # allow all job types
+from backupinator.metrics import METRICS, TRACE_HEADER
+from backupinator.server import RawResponse
 
 # Make an instance of the server to pass to resource objects
-SERVER = Server()
+SERVER = Server.from_config()
 
 class ProcessJob:
     '''Generic handling of Job.'''
@@ -15,17 +19,44 @@ class ProcessJob:
     def on_post(self, req, resp):
         '''Ask the server to process a job.'''
 
-        # Get data from request
-        data = req.media
-
-        # Deserialize the job object
-        job = jsons.load(data, globals()[data['job_type']])
+        # Streamed uploads start with the job and carry raw data after
+        # it; everything else is a binary or JSON job
+        stream = None
+        content_type = req.content_type or ''
+        if content_type.startswith('application/octet-stream'):
+            stream = req.bounded_stream
+            job = wire.load_job(read_job_prefix(stream))
+        elif content_type.startswith(wire.CONTENT_TYPE):
+            job = wire.load_job(req.bounded_stream.read())
+        else:
+            data = req.media
+            job = jsons.load(data, globals()[data['job_type']])
 
         # Send to job handler and get response
-        msg = SERVER.job_handler(job)
-
-        # Send back response
-        resp.media = msg
+        msg = SERVER.job_handler(job, stream, req.get_header(TRACE_HEADER))
+
+        # Send back response in the format the client asked for
+        resp.set_header(wire.WIRE_HEADER, str(wire.VERSION))
+        if isinstance(msg, RawResponse):
+            resp.content_type = 'application/octet-stream'
+            if msg.f is not None:
+                resp.set_stream(msg.f, os.fstat(msg.f.fileno()).st_size)
+            else:
+                resp.data = msg.data
+        elif wire.CONTENT_TYPE in (req.accept or ''):
+            resp.content_type = wire.CONTENT_TYPE
+            resp.data = wire.dumps(msg)
+        else:
+            resp.media = msg
+
+class Metrics:
+    '''Server metrics for Prometheus to scrape.'''
+
+    def on_get(self, _req, resp):
+        '''Render the metrics.'''
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.data = METRICS.render().encode()
 
 API = falcon.API()
 API.add_route('/process_job', ProcessJob())
+API.add_route('/metrics', Metrics())
@@ -0,0 +1,296 @@
+'''Compact binary wire format for jobs and responses.
+
+A message is MAGIC, a version byte and one tagged, length-prefixed
+value.  Jobs are encoded as a list: the job type's id followed by its
+fields in the order given by its schema, so no field names are sent
+and hashes, signatures and uuids go over as raw bytes.
+'''
+
+import json
+import uuid
+import struct
+
+import jsons # pylint: disable=E0401
+
+from backupinator.auth import Auth
+from backupinator import job as _job
+
+MAGIC = b'BKUP'
+
+# Bump VERSION whenever a schema changes.  Schemas are only appended
+# to, so messages back to MIN_VERSION (e.g., jobs still queued from
+# before an upgrade) can be read, with any newer fields left as None.
+VERSION = 2
+MIN_VERSION = 1
+
+# Content type of binary messages
+CONTENT_TYPE = 'application/x-backupinator'
+
+# Header the server uses to say it speaks the binary format
+WIRE_HEADER = 'X-Backupinator-Wire'
+
+# Fields every job has
+_BASE_FIELDS = (('server_address', 'str'), ('uuid', 'uuid'))
+
+# Explicit schema for each job type: (field, kind) in wire order.
+# The position in this list is the job type's id, so only append!
+SCHEMAS = [
+    ('BatchJob', (
+        ('jobs', 'jobs'), ('client_name', 'str'), ('auth', 'auth'))),
+    ('RegisterClientJob', (
+        ('client_name', 'str'), ('rsa_pub_key', 'str'), ('auth', 'auth'))),
+    ('OpenSessionJob', (
+        ('client_name', 'str'), ('auth', 'auth'))),
+    ('CheckinClientJob', (
+        ('client_name', 'str'), ('target_list', 'list'), ('auth', 'auth'))),
+    ('GetTreeJob', (
+        ('client_name', 'str'), ('target_name', 'str'), ('auth', 'auth'),
+        ('filename_hashes', 'hexlist'), ('prefixes', 'list'))),
+    ('SendFileJob', (
+        ('client_name', 'str'), ('target_name', 'str'), ('filename', 'str'),
+        ('filename_hash', 'hex'), ('chunk_size', 'int'), ('auth', 'auth'),
+        ('codec', 'str'), ('tree_value', 'str'), ('mtime', 'float'),
+        ('hashes', 'map'))),
+    ('QueryChunksJob', (
+        ('client_name', 'str'), ('target_name', 'str'),
+        ('chunk_hashes', 'hexlist'), ('auth', 'auth'))),
+    ('SendChunksJob', (
+        ('client_name', 'str'), ('target_name', 'str'), ('filename', 'str'),
+        ('filename_hash', 'hex'), ('chunks', 'chunks'),
+        ('missing', 'hexlist'), ('auth', 'auth'), ('codec', 'str'),
+        ('tree_value', 'str'), ('mtime', 'float'), ('hashes', 'map'))),
+    ('SendDeltaJob', (
+        ('client_name', 'str'), ('target_name', 'str'), ('filename', 'str'),
+        ('filename_hash', 'hex'), ('block_size', 'int'), ('size', 'int'),
+        ('signature_block_size', 'int'), ('signatures', 'list'),
+        ('auth', 'auth'), ('tree_value', 'str'), ('mtime', 'float'),
+        ('hashes', 'map'))),
+    ('PullJob', (
+        ('target_name', 'str'), ('auth', 'auth'), ('limit', 'int'),
+        ('wait', 'float'))),
+    ('FetchJob', (
+        ('target_name', 'str'), ('auth', 'auth'), ('seq', 'int'),
+        ('chunk_hashes', 'hexlist'))),
+    ('AckJob', (
+        ('target_name', 'str'), ('seqs', 'list'), ('auth', 'auth'))),
+    ('RegisterTargetJob', (
+        ('target_name', 'str'), ('rsa_pub_key', 'str'), ('auth', 'auth'))),
+]
+_TYPE_IDS = {name: ii for ii, (name, _fields) in enumerate(SCHEMAS)}
+
+# Tags of the generic value encoding
+_U32 = struct.Struct('>I')
+_I64 = struct.Struct('>q')
+_F64 = struct.Struct('>d')
+
+def _pack(val, out):
+    '''Append the encoding of a plain value to out.'''
+
+    if val is None:
+        out.append(b'N')
+    elif val is True:
+        out.append(b'T')
+    elif val is False:
+        out.append(b'F')
+    elif isinstance(val, int):
+        out.append(b'i' + _I64.pack(val))
+    elif isinstance(val, float):
+        out.append(b'd' + _F64.pack(val))
+    elif isinstance(val, str):
+        val = val.encode()
+        out.append(b's' + _U32.pack(len(val)))
+        out.append(val)
+    elif isinstance(val, (bytes, bytearray, memoryview)):
+        out.append(b'b' + _U32.pack(len(val)))
+        out.append(bytes(val))
+    elif isinstance(val, (list, tuple)):
+        out.append(b'l' + _U32.pack(len(val)))
+        for item in val:
+            _pack(item, out)
+    elif isinstance(val, dict):
+        out.append(b'm' + _U32.pack(len(val)))
+        for key, item in val.items():
+            _pack(key, out)
+            _pack(item, out)
+    elif isinstance(val, uuid.UUID):
+        _pack(str(val), out)
+    else:
+        raise TypeError('Cannot encode %s' % type(val))
+
+def _unpack(buf, pos):
+    '''Decode the value at pos, returning it and the next position.'''
+
+    tag = buf[pos:pos+1]
+    pos += 1
+    if tag == b'N':
+        return None, pos
+    if tag == b'T':
+        return True, pos
+    if tag == b'F':
+        return False, pos
+    if tag == b'i':
+        return _I64.unpack_from(buf, pos)[0], pos + 8
+    if tag == b'd':
+        return _F64.unpack_from(buf, pos)[0], pos + 8
+    if tag in (b's', b'b'):
+        nbytes = _U32.unpack_from(buf, pos)[0]
+        pos += 4
+        val = _unpack_bytes(buf, pos, nbytes)
+        return (val.decode() if tag == b's' else val), pos + nbytes
+    if tag == b'l':
+        count = _U32.unpack_from(buf, pos)[0]
+        pos += 4
+        val = []
+        for _ii in range(count):
+            item, pos = _unpack(buf, pos)
+            val.append(item)
+        return val, pos
+    if tag == b'm':
+        count = _U32.unpack_from(buf, pos)[0]
+        pos += 4
+        val = {}
+        for _ii in range(count):
+            key, pos = _unpack(buf, pos)
+            val[key], pos = _unpack(buf, pos)
+        return val, pos
+    raise ValueError('Bad tag %r' % tag)
+
+def _unpack_bytes(buf, pos, nbytes):
+    '''nbytes raw bytes at pos, making sure they're all there.'''
+    val = bytes(buf[pos:pos+nbytes])
+    if len(val) != nbytes:
+        raise ValueError('Message ended early!')
+    return val
+
+def dumps(val):
+    '''Encode a plain value (e.g., a response) as a binary message.'''
+    out = [MAGIC, bytes([VERSION])]
+    _pack(val, out)
+    return b''.join(out)
+
+def loads(data):
+    '''Decode a binary message, raising ValueError if it's malformed.'''
+
+    if data[:len(MAGIC)] != MAGIC or len(data) <= len(MAGIC):
+        raise ValueError('Not a binary message!')
+    version = data[len(MAGIC)]
+    if not MIN_VERSION <= version <= VERSION:
+        raise ValueError('Unsupported wire version %d' % version)
+    try:
+        val, pos = _unpack(memoryview(data), len(MAGIC) + 1)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError('Malformed message: %s' % e)
+    if pos != len(data):
+        raise ValueError('Trailing data after message!')
+    return val
+
+def speaks(header):
+    '''Whether a server's WIRE_HEADER says it reads our messages.'''
+    try:
+        return int(header) >= VERSION
+    except (TypeError, ValueError):
+        return False
+
+def _to_wire(kind, val):
+    '''Convert a field to its plain wire value.'''
+
+    if val is None:
+        return None
+    if kind == 'uuid':
+        return uuid.UUID(str(val)).bytes
+    if kind == 'hex':
+        return bytes.fromhex(val)
+    if kind == 'hexlist':
+        return [bytes.fromhex(v) for v in val]
+    if kind == 'chunks':
+        return [[bytes.fromhex(d), o, n] for d, o, n in val]
+    if kind == 'auth':
+        if isinstance(val, dict):
+            val = jsons.load(val, Auth)
+        return [val.message, bytes.fromhex(val.hex_signature), val.session_id]
+    if kind == 'jobs':
+        return [encode_job(j) for j in val]
+    return val
+
+def _from_wire(kind, val):
+    '''Convert a plain wire value back to a field.'''
+
+    if val is None:
+        return None
+    if kind == 'uuid':
+        return str(uuid.UUID(bytes=val))
+    if kind == 'hex':
+        return val.hex()
+    if kind == 'hexlist':
+        return [v.hex() for v in val]
+    if kind == 'chunks':
+        return [[d.hex(), o, n] for d, o, n in val]
+    if kind == 'auth':
+        return Auth(val[0], val[1].hex(), val[2])
+    if kind == 'jobs':
+        return [decode_job(j) for j in val]
+    return val
+
+def has_schema(job):
+    '''Whether a job can be sent in the binary format.'''
+    return job.job_type in _TYPE_IDS and (
+        not isinstance(job, _job.BatchJob) or all(
+            has_schema(j) for j in job.jobs))
+
+def encode_job(job):
+    '''Job as a plain list following its schema.'''
+
+    type_id = _TYPE_IDS[job.job_type]
+    fields = _BASE_FIELDS + SCHEMAS[type_id][1]
+    return [type_id] + [
+        _to_wire(kind, getattr(job, name, None)) for name, kind in fields]
+
+def decode_job(val):
+    '''Rebuild a job from its plain list, without calling __init__.
+
+    Raises ValueError if val isn't a job we know.
+    '''
+
+    if not isinstance(val, list) or not val or (
+            not isinstance(val[0], int) or not 0 <= val[0] < len(SCHEMAS)):
+        raise ValueError('Unknown job type!')
+    name, fields = SCHEMAS[val[0]]
+    fields = _BASE_FIELDS + fields
+    items = val[1:] + [None]*(len(fields) + 1 - len(val))
+    job = object.__new__(getattr(_job, name))
+    try:
+        for (field, kind), item in zip(fields, items):
+            setattr(job, field, _from_wire(kind, item))
+    except (TypeError, AttributeError, IndexError) as e:
+        raise ValueError('Malformed %s: %s' % (name, e))
+    job.job_type = name
+    return job
+
+def dump_job(job):
+    '''Encode a job as a binary message.'''
+    return dumps(encode_job(job))
+
+def load_job(data):
+    '''Decode a job sent in either the binary or the JSON format.'''
+
+    if data[:len(MAGIC)] == MAGIC:
+        return decode_job(loads(data))
+    data = json.loads(data)
+    return jsons.load(data, getattr(_job, data['job_type']))
+
+def post_opts(job):
+    '''Keyword arguments to POST a job in the binary format.'''
+
+    headers = {'Accept': CONTENT_TYPE}
+    if isinstance(job, _job.StreamingJob):
+        headers['Content-Type'] = 'application/octet-stream'
+        return {'data': job.iter_body(dump_job(job)), 'headers': headers}
+    headers['Content-Type'] = CONTENT_TYPE
+    return {'data': dump_job(job), 'headers': headers}
+
+def load_response(resp):
+    '''Decode a server response in whichever format it came in.'''
+
+    if resp.headers.get('Content-Type', '').startswith(CONTENT_TYPE):
+        return loads(resp.content)
+    return json.loads(resp.text)
@@ -0,0 +1,442 @@
+'''End-to-end benchmark of clients, the server and targets on localhost.
+
+Everything runs in one process in a scratch directory: a threaded WSGI
+server hosting web_server.API, N clients backing up synthetic trees and
+M targets pulling what they send.  Results are saved as JSON and can be
+compared against an earlier run to catch regressions, e.g.:
+
+    python benchmarks/bench_e2e.py --files 2000 --clients 2 -o new.json
+    python benchmarks/bench_e2e.py --files 2000 --clients 2 --baseline new.json
+'''
+
+import io
+import os
+import sys
+import json
+import math
+import random
+import shutil
+import logging
+import pathlib
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+import configparser
+from time import perf_counter, process_time, sleep, time
+from collections import defaultdict
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Run from a checkout without installing
+REPO_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_DIR))
+
+# Metrics where bigger is better; everything else should go down
+HIGHER_IS_BETTER = ('files_per_sec', 'mb_per_sec')
+
+class Latencies:
+    '''Durations of operations, by kind.'''
+
+    def __init__(self):
+        self.times = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, kind, seconds):
+        '''Record one operation.'''
+        with self._lock:
+            self.times[kind].append(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, kind):
+        '''Record how long the block takes.'''
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(kind, perf_counter() - t0)
+
+    def wrap(self, kind, func):
+        '''func, recording each call.'''
+        def wrapped(*args, **kwargs):
+            with self.timed(kind):
+                return func(*args, **kwargs)
+        return wrapped
+
+    def summary(self):
+        '''{kind: {count, mean, p50, p99}} in milliseconds.'''
+        return {
+            kind: {
+                'count': len(times),
+                'mean_ms': 1e3*sum(times)/len(times),
+                'p50_ms': 1e3*percentile(times, 0.50),
+                'p99_ms': 1e3*percentile(times, 0.99),
+            } for kind, times in sorted(self.times.items())}
+
+def percentile(vals, q):
+    '''Nearest-rank percentile of a non-empty list.'''
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(round(q*(len(vals) - 1))))]
+
+class TimedTransport:
+    '''Transport that records how long each job takes, by job type.'''
+
+    def __init__(self, transport, latencies):
+        self.transport = transport
+        self.latencies = latencies
+
+    def submit(self, job, stream=False):
+        '''Send a job through the real transport, timing it.'''
+        with self.latencies.timed(job.job_type):
+            return self.transport.submit(job, stream)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+class QuietHandler(WSGIRequestHandler):
+    '''Don't log every request.'''
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    '''Handle each request on its own thread.'''
+    daemon_threads = True
+
+def draw_size(rng, dist, mean):
+    '''A file size from a distribution with roughly the given mean.'''
+
+    if dist == 'fixed':
+        return mean
+    if dist == 'uniform':
+        return rng.randint(0, 2*mean)
+    if dist == 'lognormal':
+        # Most files small, a few big: median is about mean/3
+        sigma = 1.5
+        return int(rng.lognormvariate(0, sigma)*mean/math.exp(sigma**2/2))
+    raise ValueError('Unknown size distribution %s' % dist)
+
+def make_files(root, nfiles, dist, mean_size, compressible, rng):
+    '''Write a synthetic tree, returning the number of bytes written.'''
+
+    words = b'lorem ipsum dolor sit amet consectetur adipiscing elit '
+    nbytes = 0
+    for ii in range(nfiles):
+        dirname = root / ('d%03d' % (ii // 64)) / ('e%02d' % (ii % 7))
+        dirname.mkdir(parents=True, exist_ok=True)
+        size = draw_size(rng, dist, mean_size)
+
+        # Some of each file compresses well, the rest not at all
+        text = int(size*compressible)
+        data = (words*(text // len(words) + 1))[:text]
+        data += rng.getrandbits(8*(size - text)).to_bytes(size - text, 'big')
+        with open(str(dirname / ('f%06d.dat' % ii)), 'wb') as f:
+            f.write(data)
+        nbytes += size
+    return nbytes
+
+def write_config(default, filename, overrides):
+    '''Copy a default config file with some values changed.'''
+
+    config = configparser.ConfigParser()
+    config.read(str(default))
+    for key, val in overrides.items():
+        config['DEFAULT'][key] = str(val)
+    filename.parents[0].mkdir(parents=True, exist_ok=True)
+    with open(str(filename), 'w') as f:
+        config.write(f)
+
+def start_server():
+    '''Serve web_server.API on a free port, returning (httpd, port).'''
+
+    # Imported here since it sets up its Server in the current directory
+    from backupinator.web_server import API
+
+    httpd = make_server(
+        '127.0.0.1', 0, API, ThreadingWSGIServer, QuietHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, httpd.server_port
+
+def run_target(target, stop, stored, lock):
+    '''Pull and store uploads until told to stop.'''
+
+    while not stop.is_set():
+        try:
+            nstored = target.pull(wait=1.0)
+        except (OSError, ValueError) as e:
+            logging.warning('%s pull failed: %s', target.target_name, e)
+            sleep(0.5)
+            continue
+        with lock:
+            stored[target.target_name] += nstored
+
+def wait_online(clients, timeout):
+    '''Check clients in until every target shows up as online.
+
+    Targets are only online once their first pull reaches the server;
+    jobs for any that aren't would be deferred and the upload would be
+    timed without them.
+    '''
+
+    deadline = time() + timeout
+    while True:
+        for client in clients:
+            client.checkin()
+        offline = set().union(*(c.offline_targets for c in clients))
+        if not offline:
+            return
+        if time() >= deadline:
+            raise RuntimeError(
+                'Targets never came online: %s' % ', '.join(sorted(offline)))
+        sleep(0.1)
+
+def rusage():
+    '''(cpu seconds, peak RSS in KiB) of this process.'''
+    if resource is None:
+        return process_time(), None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    rss = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return usage.ru_utime + usage.ru_stime, rss
+
+def git_commit():
+    '''Commit being benchmarked, if we're in a git checkout.'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=str(REPO_DIR),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench(args):
+    '''Run every phase, returning the results.'''
+
+    # Imported late so they pick up our scratch directory
+    from backupinator.client import Client
+    from backupinator.target import Target
+    from backupinator.utils import (
+        make_tree, make_rsa_keys, client_rsa_key_filename,
+        target_rsa_key_filename)
+
+    rng = random.Random(args.seed)
+    results = {'phases': {}}
+    latencies = Latencies()
+    overrides = dict(kv.split('=', 1) for kv in args.set)
+
+    # Synthetic trees and config files
+    clients = ['client%d' % ii for ii in range(args.clients)]
+    targets = ['target%d' % ii for ii in range(args.targets)]
+    t0 = perf_counter()
+    nbytes = 0
+    for name in clients:
+        nbytes += make_files(
+            pathlib.Path('data') / name, args.files, args.size_dist,
+            args.mean_size, args.compressible, rng)
+    results['phases']['generate'] = {
+        'seconds': perf_counter() - t0, 'nbytes': nbytes}
+
+    httpd, port = start_server()
+    server_address = 'http://127.0.0.1:%d/process_job' % port
+    for name in clients:
+        write_config(
+            REPO_DIR / 'client_default.ini',
+            pathlib.Path('client_data') / name / 'client.ini', dict({
+                'server_address': server_address,
+                'targets': ','.join(targets),
+                'tracked_dirs': str(pathlib.Path('data', name).resolve()),
+                'local_target': 'client_data/%s/local_backup' % name,
+            }, **overrides))
+        make_rsa_keys(
+            client_rsa_key_filename(name, public=True),
+            client_rsa_key_filename(name, public=False))
+    for name in targets:
+        write_config(
+            REPO_DIR / 'target_default.ini',
+            pathlib.Path('target_data') / name / 'target.ini', {
+                'server_address': server_address,
+                'backup_dir': 'target_data/%s/backup' % name,
+                'pull_wait': 1,
+            })
+        make_rsa_keys(
+            target_rsa_key_filename(name, public=True),
+            target_rsa_key_filename(name, public=False))
+
+    # Scanning: a full tree walk, then ClientDB.sync as run by Client
+    cpu0 = process_time()
+    t0 = perf_counter()
+    for name in clients:
+        with latencies.timed('make_tree'):
+            make_tree(name)
+    clients = [
+        latencies.wrap('client_init', Client)(name) for name in clients]
+    elapsed = perf_counter() - t0
+    results['phases']['scan'] = {
+        'seconds': elapsed,
+        'files_per_sec': args.files*len(clients)/elapsed,
+        'cpu_seconds': process_time() - cpu0,
+    }
+
+    # Targets register and start pulling so they show up as online
+    targets = [Target(name) for name in targets]
+    stop = threading.Event()
+    stored = defaultdict(int)
+    lock = threading.Lock()
+    threads = []
+    for target in targets:
+        target.transport = TimedTransport(target.transport, latencies)
+        target.update_file = latencies.wrap('update_file', target.update_file)
+        target.register()
+        threads.append(threading.Thread(
+            target=run_target, args=(target, stop, stored, lock), daemon=True))
+        threads[-1].start()
+
+    for client in clients:
+        client.transport = TimedTransport(client.transport, latencies)
+        client.register()
+    wait_online(clients, args.timeout)
+
+    # Upload: every client sends its queue at once, then we wait for
+    # the targets to have stored everything
+    cpu0 = process_time()
+    t0 = perf_counter()
+    senders = [
+        threading.Thread(target=client.send_queued_jobs) for client in clients]
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    sent = perf_counter() - t0
+
+    expected = args.files*len(clients)
+    deadline = time() + args.timeout
+    while time() < deadline:
+        with lock:
+            if all(stored[t.target_name] >= expected for t in targets):
+                break
+        sleep(0.1)
+    elapsed = perf_counter() - t0
+    stop.set()
+    for thread in threads:
+        thread.join()
+    httpd.shutdown()
+
+    nstored = sum(stored.values())
+    results['phases']['upload'] = {
+        'send_seconds': sent,
+        'seconds': elapsed,
+        'files_stored': nstored,
+        'files_expected': expected*len(targets),
+        'files_per_sec': nstored/elapsed,
+        'mb_per_sec': nbytes*len(targets)/elapsed/1e6,
+        'cpu_seconds': process_time() - cpu0,
+    }
+
+    cpu, rss = rusage()
+    results['latency'] = latencies.summary()
+    results['cpu_seconds'] = cpu
+    results['peak_rss_kib'] = rss
+    return results
+
+def compare(results, baseline, tolerance):
+    '''Print changes from a baseline run, returning the regressions.'''
+
+    regressions = []
+    for phase, metrics in sorted(results['phases'].items()):
+        for key, val in sorted(metrics.items()):
+            old = baseline.get('phases', {}).get(phase, {}).get(key)
+            if not old or not isinstance(val, (int, float)):
+                continue
+            change = (val - old)/old
+            worse = -change if key in HIGHER_IS_BETTER else change
+            flag = ''
+            if phase != 'generate' and worse > tolerance and (
+                    key in HIGHER_IS_BETTER + ('seconds',)):
+                flag = '  <-- regression'
+                regressions.append('%s.%s' % (phase, key))
+            print('%-10s %-16s %12.3f -> %12.3f  %+7.1f%%%s' % (
+                phase, key, old, val, 100*change, flag))
+    for kind, stats in sorted(results['latency'].items()):
+        old = baseline.get('latency', {}).get(kind, {}).get('p99_ms')
+        if old:
+            print('%-10s %-16s %12.3f -> %12.3f ms p99' % (
+                'latency', kind, old, stats['p99_ms']))
+    return regressions
+
+def main():
+    '''Parse arguments, run the benchmark and save the results.'''
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=500,
+                        help='files per client')
+    parser.add_argument('--size-dist', default='lognormal',
+                        choices=('fixed', 'uniform', 'lognormal'))
+    parser.add_argument('--mean-size', type=int, default=16*1024)
+    parser.add_argument('--compressible', type=float, default=0.5,
+                        help='fraction of each file that compresses')
+    parser.add_argument('--clients', type=int, default=1)
+    parser.add_argument('--targets', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds to wait for targets to catch up')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VAL', help='client config override')
+    parser.add_argument('--workdir',
+                        help='scratch directory to keep (default: a temp '
+                        'directory that is removed afterwards)')
+    parser.add_argument('-o', '--output', default='bench_e2e.json')
+    parser.add_argument('--baseline', help='earlier results to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed slowdown before flagging a regression')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    # Clients and targets log at DEBUG and print responses otherwise
+    logging.basicConfig(level=logging.WARNING)
+    # A scratch directory we made is removed afterwards; one that was
+    # asked for is left to look at
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_e2e_')
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = bench(args)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results['meta'] = {
+        'time': time(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+        'workdir': args.workdir,
+    }
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+'''Compare throughput of the hash algorithms that can be configured.'''
+
+import os
+from timeit import timeit
+
+from backupinator.hashing import PROVIDERS, DEFAULT_HASHES
+
+def bench(number=20, nbytes=16*1024*1024, nsmall=100000):
+    '''Hash a large buffer and many filename-sized strings with each.'''
+
+    big = os.urandom(nbytes)
+    small = [
+        ('/home/user/Documents/project/file%d.txt' % ii).encode()
+        for ii in range(nsmall)]
+
+    print('%-8s %6s %8s %10s %12s  %s' % (
+        'hash', 'crypto', 'digest B', 'MB/s', 'small/s', 'default for'))
+    for name, provider in sorted(PROVIDERS.items()):
+        big_sec = timeit(lambda: provider.hexdigest(big), number=number)
+        small_sec = timeit(
+            lambda: [provider.hexdigest(s) for s in small], number=1)
+        roles = [role for role, n in DEFAULT_HASHES.items() if n == name]
+        print('%-8s %6s %8d %10.0f %12.0f  %s' % (
+            name, 'yes' if provider.cryptographic else 'no',
+            provider.digest_size, number*nbytes/big_sec/1e6,
+            nsmall/small_sec, ', '.join(roles)))
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,61 @@
+'''Compare encode/decode cost of the JSON and binary wire formats.'''
+
+import json
+import hashlib
+from timeit import timeit
+
+import jsons # pylint: disable=E0401
+
+from backupinator import wire
+from backupinator.auth import Auth
+from backupinator.job import *
+
+def sample_jobs(server_address='http://127.0.0.1:8000/process_job'):
+    '''One of each job type with realistic field sizes.'''
+
+    auth = Auth('x'*64, 'ab'*256)
+    digests = [hashlib.sha256(str(ii).encode()).hexdigest() for ii in range(256)]
+    chunks = [[d, ii*65536, 65536] for ii, d in enumerate(digests)]
+
+    batch = BatchJob(server_address, 'client_tester', auth)
+    for _ii in range(100):
+        batch.addjob(CheckinClientJob(
+            server_address, 'client_tester', ['target_tester'], None))
+
+    return [
+        batch,
+        RegisterClientJob(server_address, 'client_tester', 'k'*450, auth),
+        OpenSessionJob(server_address, 'client_tester', auth),
+        CheckinClientJob(server_address, 'client_tester', ['target_tester'], auth),
+        GetTreeJob(server_address, 'client_tester', 'target_tester', auth),
+        SendFileJob(server_address, 'client_tester', 'target_tester',
+                    'test_dir1/text1.txt', auth),
+        QueryChunksJob(server_address, 'client_tester', 'target_tester',
+                       digests, auth),
+        SendChunksJob(server_address, 'client_tester', 'target_tester',
+                      'test_dir1/text1.txt', chunks, digests[:16], auth),
+    ]
+
+def bench(number=200):
+    '''Time encode and decode of each job in both formats.'''
+
+    print('%-18s %8s %8s %10s %10s %10s %10s' % (
+        'job', 'json B', 'bin B', 'json enc', 'bin enc', 'json dec',
+        'bin dec'))
+    for job in sample_jobs():
+        as_json = json.dumps(jsons.dump(job)).encode()
+        as_bin = wire.dump_job(job)
+
+        json_enc = timeit(lambda: json.dumps(jsons.dump(job)), number=number)
+        bin_enc = timeit(lambda: wire.dump_job(job), number=number)
+        json_dec = timeit(lambda: wire.load_job(as_json), number=number)
+        bin_dec = timeit(lambda: wire.load_job(as_bin), number=number)
+
+        # Report microseconds per operation
+        scale = 1e6/number
+        print('%-18s %8d %8d %10.1f %10.1f %10.1f %10.1f' % (
+            job.job_type, len(as_json), len(as_bin), json_enc*scale,
+            bin_enc*scale, json_dec*scale, bin_dec*scale))
+
+if __name__ == '__main__':
+    bench()
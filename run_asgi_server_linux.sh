@@ -0,0 +1 @@
+/venvs/backup/bin/uvicorn --reload backupinator.asgi_server:APP
@@ -0,0 +1,78 @@
+'''Tests for content-addressed chunk storage.'''
+
+import os
+import zlib
+
+import pytest
+
+from backupinator.chunk_store import ChunkStore
+from backupinator.chunking import chunk_hash
+
+@pytest.fixture
+def store(tmp_path):
+    return ChunkStore(tmp_path, 'sqlite', 'zlib', pack_size=1 << 20)
+
+def chunk(data):
+    return chunk_hash(data), data
+
+def test_put_and_get(store):
+    for data in (b'', b'a'*10000, os.urandom(5000)):
+        digest, data = chunk(data)
+        assert store.put(digest, data)
+        assert not store.put(digest, data)
+        assert store.get(digest) == data
+    assert store.get_codec(chunk(b'a'*10000)[0]) == 'zlib'
+    assert store.get_codec(chunk(b'')[0]) == 'none'
+
+def test_put_checks_hash(store):
+    with pytest.raises(ValueError):
+        store.put(chunk(b'a')[0], b'b')
+    with pytest.raises(ValueError):
+        store.put_compressed(chunk(b'a')[0], zlib.compress(b'b'), 'zlib', 1)
+
+def test_batch_indexes_at_the_end(store):
+    digest, data = chunk(b'data'*1000)
+    with store.batch():
+        assert store.put(digest, data)
+        assert store.missing([digest]) == []
+        assert store.get(digest) == data
+        assert store.index.get(digest) is None
+    assert store.index.get(digest) is not None
+    assert store.get(digest) == data
+
+def test_batch_nests_and_dedups(store):
+    digest, data = chunk(b'data'*1000)
+    with store.batch():
+        with store.batch():
+            assert store.put(digest, data)
+        assert store.index.get(digest) is None
+        assert not store.put(digest, data)
+    assert len(store.packs.packs()) == 1
+    assert store.missing([digest, chunk(b'other')[0]]) == [chunk(b'other')[0]]
+
+def test_failed_batch_keeps_what_was_written(store):
+    digest, data = chunk(b'data'*1000)
+    with pytest.raises(RuntimeError):
+        with store.batch():
+            store.put(digest, data)
+            raise RuntimeError
+    assert store.get(digest) == data
+
+def test_location_orders_by_pack(store):
+    first, second = chunk(os.urandom(100)), chunk(os.urandom(100))
+    store.put(*first)
+    store.put(*second)
+    assert store.location(first[0]) < store.location(second[0])
+
+@pytest.mark.parametrize('codec', [None, 'none', 'zlib'])
+def test_legacy_entries(store, codec):
+    digest, data = chunk(b'legacy'*1000)
+    filename = store.get_chunk_filename(digest)
+    filename.parent.mkdir(parents=True)
+    filename.write_bytes(zlib.compress(data) if codec == 'zlib' else data)
+    store.index[digest] = str(len(data)) + (':' + codec if codec else '')
+    assert store.get(digest) == data
+    assert store.get_codec(digest) == (codec or 'none')
+    assert store.location(digest) == (0, 0)
+    assert store.missing([digest]) == []
+    assert not store.put(digest, data)
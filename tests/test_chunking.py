@@ -0,0 +1,42 @@
+'''Tests for splitting data into chunks.'''
+
+import io
+import os
+
+import pytest
+
+from backupinator import chunking
+from backupinator.chunking import Chunker, FixedChunker, make_chunker
+
+def chunks_of(chunker, data):
+    return list(chunker.iter_chunks(io.BytesIO(data)))
+
+@pytest.mark.parametrize('chunker', [
+    Chunker(), Chunker(1024, 4096, 16384), Chunker(64, 64, 64)])
+@pytest.mark.parametrize('make_data', [
+    lambda: b'', lambda: b'x'*100, lambda: os.urandom(70000),
+    lambda: os.urandom(1000000), lambda: b'\0'*300000 + b'ab'*100000])
+def test_numpy_matches_python(chunker, make_data, monkeypatch):
+    pytest.importorskip('numpy')
+    data = make_data()
+    fast = chunks_of(chunker, data)
+    monkeypatch.setattr(chunking, 'np', None)
+    assert chunks_of(chunker, data) == fast
+    assert b''.join(fast) == data
+
+def test_chunk_sizes():
+    chunker = Chunker()
+    sizes = [len(c) for c in chunks_of(chunker, os.urandom(2000000))]
+    assert all(chunker.min_size <= n <= chunker.max_size for n in sizes[:-1])
+
+def test_fixed_chunks():
+    data = os.urandom(150000)
+    chunks = chunks_of(FixedChunker(avg_size=65536), data)
+    assert [len(c) for c in chunks] == [65536, 65536, 150000 - 2*65536]
+    assert b''.join(chunks) == data
+
+def test_make_chunker():
+    assert type(make_chunker('fixed')) is FixedChunker
+    assert type(make_chunker('cdc')) is Chunker
+    with pytest.raises(ValueError):
+        make_chunker('gear')
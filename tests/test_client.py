@@ -0,0 +1,111 @@
+'''Tests for the client's uploads.'''
+
+import configparser
+import pathlib
+
+import pytest
+
+from backupinator import client as client_module
+from backupinator import scheduler as scheduler_module
+from backupinator.client import Client
+from backupinator.job import GetTreeJob, SendDeltaJob, SendFileJob
+from backupinator.utils import client_rsa_key_filename
+
+DEFAULTS = pathlib.Path(__file__).parents[1] / 'client_default.ini'
+
+@pytest.fixture
+def tracked(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tracked = tmp_path / 'tracked'
+    tracked.mkdir()
+    (tracked / 'a').write_bytes(b'a'*10000)
+    return tracked
+
+@pytest.fixture
+def client(tmp_path, tracked, monkeypatch):
+    config = configparser.ConfigParser()
+    config.read(str(DEFAULTS))
+    config['DEFAULT'].update({
+        'server_address': 'http://x', 'targets': 't1,t2',
+        'local_target': str(tmp_path / 'local'),
+        'tracked_dirs': str(tracked), 'delta': '1', 'compression': 'none',
+    })
+    filename = tmp_path / 'client_data' / 'c' / 'client.ini'
+    filename.parent.mkdir(parents=True)
+    with open(str(filename), 'w') as f:
+        config.write(f)
+    for public in (True, False):
+        filename = client_rsa_key_filename('c', public)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        filename.write_text('')
+    for module in (client_module, scheduler_module):
+        monkeypatch.setattr(module, 'load_response', lambda resp: resp)
+    return Client('c')
+
+@pytest.fixture
+def server(client, monkeypatch):
+    '''Fake server: the signatures it has, and the jobs sent to it.'''
+
+    state = {'signatures': {}, 'sent': []}
+    def submit(job, stream=False):
+        state['sent'].append(job)
+        if isinstance(job, GetTreeJob):
+            return {'success': True, 'signatures': state['signatures']}
+        if isinstance(job, (SendFileJob, SendDeltaJob)):
+            for _chunk in job.iter_chunks():
+                pass
+        return {'success': True}
+    monkeypatch.setattr(client, 'submit', submit)
+    return state
+
+def queued(client, target='t1'):
+    return [job for _seq, job in client.jobs.peek(target, 10)]
+
+def test_no_signatures_without_a_base(client, server, monkeypatch):
+    def file_signatures(filename):
+        raise AssertionError('signatures made for a new file')
+    monkeypatch.setattr(client, 'file_signatures', file_signatures)
+    job, = queued(client)
+    assert client.scheduler.upload('t1', job)['success']
+    assert isinstance(server['sent'][-1], SendFileJob)
+
+def test_signatures_once_a_base_exists(client, server, tracked):
+    job, = queued(client)
+    filename_hash = client.client_db.filename_hash(job.filename)
+    server['signatures'] = {filename_hash: {
+        'block_size': 1024, 'signatures': []}}
+    assert client.scheduler.upload('t1', job)['success']
+    assert isinstance(server['sent'][-1], SendDeltaJob)
+
+def test_files_read_once_for_all_targets(client, server, tracked,
+                                         monkeypatch):
+    opened = []
+    def counting_open(filename, *args, **kwargs):
+        opened.append(filename)
+        return open(filename, *args, **kwargs)
+    monkeypatch.setattr(scheduler_module, 'open', counting_open, raising=False)
+    assert client.scheduler.run() == {'t1': 1, 't2': 1}
+    assert opened == [str(tracked / 'a')]
+    assert not queued(client, 't1') and not queued(client, 't2')
+
+def test_failing_target_does_not_stop_others(client, server, tracked,
+                                             monkeypatch):
+    (tracked / 'b').write_bytes(b'b')
+    client.client_db.sync(client.queue_changes)
+    submit = client.submit
+    def failing_submit(job, stream=False):
+        if getattr(job, 'target_name', None) == 't2':
+            return {'success': False, 'msg': 'nope'}
+        return submit(job, stream)
+    monkeypatch.setattr(client, 'submit', failing_submit)
+    counts = client.scheduler.run()
+    assert counts == {'t1': 2, 't2': 0}
+    assert len(queued(client, 't2')) == 2
+
+def test_bases_asked_for_once_a_round(client, server, tracked):
+    (tracked / 'b').write_bytes(b'b'*5000)
+    client.client_db.sync(client.queue_changes)
+    assert client.scheduler.run() == {'t1': 2, 't2': 2}
+    asked = [job for job in server['sent'] if isinstance(job, GetTreeJob)]
+    assert sorted(job.target_name for job in asked) == ['t1', 't2']
+    assert all(len(job.filename_hashes) == 2 for job in asked)
@@ -0,0 +1,50 @@
+'''Tests for the client's database of tracked files.'''
+
+import pytest
+
+from backupinator import walker
+from backupinator.client_db import ClientDB
+
+@pytest.fixture
+def tracked(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tracked = tmp_path / 'tracked'
+    tracked.mkdir()
+    for name in ('a', 'b'):
+        (tracked / name).write_text(name)
+    return tracked
+
+@pytest.fixture
+def client_db(tracked):
+    config = {
+        'tracked_dirs': str(tracked), 'db_backend': 'sqlite',
+        'hash_filenames': True, 'hash_times': True, 'hash_contents': True,
+        'hash_workers': 2, 'scan_workers': 2,
+    }
+    def get_config_val(key, valtype='str', fallback=None):
+        return config.get(key, fallback)
+    return ClientDB('c', get_config_val)
+
+def unreadable(monkeypatch, path):
+    '''Have hashing fail for path.'''
+    hash_file = walker.hash_file
+    def fail(filename, *args, **kwargs):
+        if str(filename) == str(path):
+            raise PermissionError(filename)
+        return hash_file(filename, *args, **kwargs)
+    monkeypatch.setattr(walker, 'hash_file', fail)
+
+def test_unreadable_file_retried_by_sync(client_db, tracked, monkeypatch):
+    with monkeypatch.context() as m:
+        unreadable(m, tracked / 'b')
+        assert client_db.sync().added == [str(tracked / 'a')]
+    assert client_db.sync().added == [str(tracked / 'b')]
+
+def test_unreadable_file_retried_by_events(client_db, tracked, monkeypatch):
+    client_db.sync()
+    (tracked / 'b').write_text('changed')
+    with monkeypatch.context() as m:
+        unreadable(m, tracked / 'b')
+        m.setattr('backupinator.client_db.hash_file', walker.hash_file)
+        assert not client_db.apply_events([str(tracked / 'b')]).modified
+    assert client_db.sync().added == [str(tracked / 'b')]
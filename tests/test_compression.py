@@ -0,0 +1,47 @@
+'''Tests for compressing file data.'''
+
+import io
+import threading
+import zlib
+
+import pytest
+
+from backupinator.compression import (
+    CompressionStats, available_codecs, compress, decompress, frame,
+    read_frame)
+
+@pytest.mark.parametrize('codec', available_codecs())
+def test_round_trip(codec):
+    data = b'backup'*1000
+    assert decompress(codec, compress(codec, data), len(data)) == data
+
+@pytest.mark.parametrize('codec', available_codecs())
+def test_decompress_bounded(codec):
+    bomb = compress(codec, b'\0'*10000000)
+    with pytest.raises(ValueError):
+        decompress(codec, bomb, 1024*1024)
+
+def test_read_frame():
+    stream = io.BytesIO(frame(b'abc') + frame(b''))
+    assert read_frame(stream) == b'abc'
+    assert read_frame(stream) == b''
+    assert read_frame(stream) is None
+
+@pytest.mark.parametrize('data', [
+    b'\0\0\4\1' + b'x'*2000, b'\0\0', frame(b'abc')[:-1]])
+def test_read_frame_bad(data):
+    with pytest.raises(ValueError):
+        read_frame(io.BytesIO(data), max_size=1024)
+
+def test_stats_threads():
+    stats = CompressionStats()
+    data = zlib.compress(b'x'*100)
+    def work():
+        for _ii in range(500):
+            stats.decompress('zlib', data, 100)
+    threads = [threading.Thread(target=work) for _ii in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stats.report()['raw_bytes'] == 8*500*100
@@ -0,0 +1,46 @@
+'''Tests for the key/val stores.'''
+
+import dbm
+
+import pytest
+
+from backupinator.db import BACKENDS, migrate_dbm, open_store
+
+def make_dbm(filename, items):
+    with dbm.open(str(filename), 'c') as db:
+        for key, val in items.items():
+            db[key] = val
+
+@pytest.mark.parametrize('backend', ['dbm', 'sqlite'])
+def test_batch(tmp_path, backend):
+    store = open_store(tmp_path / 'db', backend)
+    with store.batch() as db:
+        db['a'] = 1
+        db['b'] = 'two'
+    assert store.get('a') == b'1'
+    assert store['b'] == b'two'
+    del store['a']
+    assert 'a' not in store and len(store) == 1
+
+def test_batch_rolls_back(tmp_path):
+    store = open_store(tmp_path / 'db', 'sqlite')
+    with pytest.raises(RuntimeError):
+        with store.batch() as db:
+            db['a'] = 1
+            raise RuntimeError
+    assert store.get('a') is None
+
+def test_dbm_imported_once(tmp_path):
+    filename = tmp_path / 'db'
+    make_dbm(filename, {'a': '1'})
+    store = open_store(filename, 'sqlite')
+    assert store.get('a') == b'1'
+    del store['a']
+    assert open_store(filename, 'sqlite').get('a') is None
+
+def test_migrate_dbm(tmp_path):
+    filename = tmp_path / 'db'
+    make_dbm(filename, {'a': '1', 'b': '2'})
+    assert migrate_dbm(filename, 'sqlite') == 2
+    assert sorted(BACKENDS['sqlite'](filename).items()) == [
+        (b'a', b'1'), (b'b', b'2')]
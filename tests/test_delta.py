@@ -0,0 +1,66 @@
+'''Tests for rsync-style deltas.'''
+
+import io
+import os
+import random
+
+import pytest
+
+from backupinator import delta
+from backupinator.delta import (
+    apply_delta, encode_delta, iter_delta, signatures, weak_checksum)
+
+def make_delta(old, new, block_size):
+    sigs = signatures(io.BytesIO(old), block_size)
+    return list(iter_delta(io.BytesIO(new), sigs, block_size))
+
+def patched(old, ops, block_size):
+    out = io.BytesIO()
+    apply_delta(io.BytesIO(old), io.BytesIO(b''.join(encode_delta(ops))),
+                block_size, out)
+    return out.getvalue()
+
+OLD = os.urandom(300000)
+CASES = {
+    'same': (OLD, OLD),
+    'edited': (OLD, OLD[:1000] + b'new' + OLD[1000:200000] +
+               os.urandom(70000) + OLD[250000:]),
+    'unrelated': (OLD, os.urandom(100000)),
+    'new': (b'', OLD[:5000]),
+    'emptied': (OLD, b''),
+    'repetitive': (b'a'*10000, b'a'*20000 + b'b'),
+}
+
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_round_trip(case):
+    old, new = CASES[case]
+    assert patched(old, make_delta(old, new, 2048), 2048) == new
+
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_numpy_matches_python(case, monkeypatch):
+    pytest.importorskip('numpy')
+    old, new = CASES[case]
+    fast = make_delta(old, new, 2048)
+    monkeypatch.setattr(delta, 'np', None)
+    assert make_delta(old, new, 2048) == fast
+
+def test_numpy_matches_python_low_entropy(monkeypatch):
+    pytest.importorskip('numpy')
+    rand = random.Random(1)
+    for _ii in range(20):
+        old, new = (bytes(rand.choice(b'ab') for _jj in range(
+            rand.randint(0, 5000))) for _kk in range(2))
+        block_size = rand.choice([7, 1024])
+        fast = make_delta(old, new, block_size)
+        with monkeypatch.context() as m:
+            m.setattr(delta, 'np', None)
+            assert make_delta(old, new, block_size) == fast
+        assert patched(old, fast, block_size) == new
+
+def test_weak_checksums():
+    pytest.importorskip('numpy')
+    data = os.urandom(5000)
+    expected = [
+        a | b << 16 for a, b in (
+            weak_checksum(data[ii:ii + 100]) for ii in range(4901))]
+    assert delta.weak_checksums(data, 100).tolist() == expected
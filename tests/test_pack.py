@@ -0,0 +1,44 @@
+'''Tests for append-only pack files.'''
+
+import pytest
+
+from backupinator.pack import PackStore
+
+def test_append_and_read(tmp_path):
+    packs = PackStore(tmp_path)
+    where = [packs.append(data) for data in (b'abc', b'', b'defgh')]
+    assert where == [(1, 0), (1, 3), (1, 3)]
+    assert packs.read(1, 0, 3) == b'abc'
+    assert packs.read(1, 3, 0) == b''
+    assert packs.read(1, 3, 5) == b'defgh'
+
+def test_reads_see_appends_after_mapping(tmp_path):
+    packs = PackStore(tmp_path)
+    with packs.batch():
+        packs.append(b'abc')
+        assert packs.read(1, 0, 3) == b'abc'
+        packs.append(b'def')
+        assert packs.read(1, 3, 3) == b'def'
+
+def test_rollover(tmp_path):
+    packs = PackStore(tmp_path, pack_size=10)
+    where = [packs.append(data) for data in (b'x'*6, b'y'*4, b'z'*2, b'w'*20)]
+    assert where == [(1, 0), (1, 6), (2, 0), (3, 0)]
+    assert packs.packs() == [1, 2, 3]
+    assert packs.read(1, 6, 4) == b'y'*4
+    assert packs.read(3, 0, 20) == b'w'*20
+
+def test_reopen_appends_to_last_pack(tmp_path):
+    packs = PackStore(tmp_path, pack_size=10)
+    packs.append(b'x'*8)
+    packs.append(b'y'*4)
+    packs.close()
+    packs = PackStore(tmp_path, pack_size=10)
+    assert packs.append(b'z'*2) == (2, 4)
+    assert packs.read(1, 0, 8) == b'x'*8
+
+def test_short_pack(tmp_path):
+    packs = PackStore(tmp_path)
+    packs.append(b'abc')
+    with pytest.raises(ValueError):
+        packs.read(1, 2, 5)
@@ -0,0 +1,92 @@
+'''Tests for the server's handling of jobs.'''
+
+import io
+import threading
+
+import pytest
+
+from backupinator.job import (
+    BatchJob, CheckinClientJob, GetTreeJob, RegisterClientJob, SendFileJob)
+from backupinator.server import Server
+
+DIGEST = 'ab'*28
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = Server(db_backend='sqlite', spool_dir=tmp_path / 'spool')
+    monkeypatch.setattr(
+        server, 'authenticate_client', lambda *args, **kwargs: True)
+    server.job_handler(CheckinClientJob('x', 'c', ['t'], None))
+    return server
+
+def send(server, target='t', client='c', filename_hash=DIGEST):
+    job = SendFileJob(
+        'x', client, target, 'f', None, filename_hash=filename_hash)
+    return server.job_handler(job, io.BytesIO(b'data'))
+
+def test_upload(server):
+    assert send(server)['success']
+    assert server.spool.get('t', 'c', DIGEST)['nbytes'] == 4
+
+@pytest.mark.parametrize('kwargs', [
+    {'filename_hash': '../../../../tmp/x'},
+    {'filename_hash': DIGEST.upper()},
+    {'filename_hash': 'ab'*5},
+    {'target': '../t'},
+    {'target': 't/../../x'},
+    {'client': '..'},
+])
+def test_bad_names_rejected(server, tmp_path, kwargs):
+    res = send(server, **kwargs)
+    assert not res['success']
+    assert not list(tmp_path.glob('**/*.upload'))
+    assert not (tmp_path.parent / 'x').exists()
+
+def test_target_not_checked_in(server):
+    res = send(server, target='other')
+    assert not res['success']
+    assert 'checked in' in res['msg']
+
+def test_target_names_refused(server):
+    res = server.job_handler(RegisterClientJob('x', 'target:t', 'key', None))
+    assert not res['success']
+
+def batch(*jobs):
+    job = BatchJob('x')
+    for sub_job in jobs:
+        job.addjob(sub_job)
+    return job
+
+def test_batch_runs_one_clients_jobs_together(server, monkeypatch):
+    # Both trees have to be asked for before either is answered
+    barrier = threading.Barrier(2, timeout=5)
+    def get_tree(job):
+        barrier.wait()
+        return {'success': True, 'job_uuid': job.uuid}
+    monkeypatch.setattr(server, 'get_tree', get_tree)
+    res = server.job_handler(batch(
+        GetTreeJob('x', 'c', 't', None), GetTreeJob('x', 'c', 't', None)))
+    assert [r['success'] for r in res] == [True, True]
+
+def test_batch_orders_around_checkins(server, monkeypatch):
+    seen = []
+    def get_tree(job):
+        seen.append(server.state.info('client', 'c').get('targets'))
+        return {'success': True, 'job_uuid': job.uuid}
+    monkeypatch.setattr(server, 'get_tree', get_tree)
+    server.job_handler(batch(
+        CheckinClientJob('x', 'c', ['u'], None),
+        GetTreeJob('x', 'c', 'u', None), GetTreeJob('x', 'c', 'u', None)))
+    assert seen == [['u'], ['u']]
+
+def test_batch_failure_stays_in_its_slot(server, monkeypatch):
+    def get_tree(job):
+        if job.target_name == 'bad':
+            raise KeyError(job.target_name)
+        return {'success': True, 'job_uuid': job.uuid}
+    monkeypatch.setattr(server, 'get_tree', get_tree)
+    jobs = [GetTreeJob('x', 'c', name, None) for name in ('t', 'bad', 't')]
+    res = server.job_handler(batch(*jobs))
+    assert [r['success'] for r in res] == [True, False, True]
+    assert res[1]['job_uuid'] == jobs[1].uuid
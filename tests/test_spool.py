@@ -0,0 +1,49 @@
+'''Tests for the upload spool.'''
+
+import pytest
+
+from backupinator.spool import Spool, check_digest, check_name
+
+DIGEST = 'ab'*28
+
+@pytest.mark.parametrize('name', [
+    '..', '../x', 'a/b', 'a\\b', 'x..y', '.hidden', '', 'a b', None])
+def test_bad_names(name):
+    with pytest.raises(ValueError):
+        check_name(name)
+
+@pytest.mark.parametrize('name', ['target_tester', 'client-1', 'a.b@c'])
+def test_good_names(name):
+    assert check_name(name) == name
+
+@pytest.mark.parametrize('digest', [
+    '../../../../tmp/x', 'AB'*28, 'ab'*27 + 'zz', 'ab'*10, 'abc', ''])
+def test_bad_digests(digest):
+    with pytest.raises(ValueError):
+        check_digest(digest)
+
+@pytest.mark.parametrize('nbytes', [8, 16, 28, 32, 48, 64])
+def test_good_digests(nbytes):
+    assert check_digest('0f'*nbytes)
+
+def test_path_rejects_traversal(tmp_path):
+    spool = Spool(tmp_path / 'spool')
+    with pytest.raises(ValueError):
+        spool.path('t', 'c', '../../../../tmp/x')
+    with pytest.raises(ValueError):
+        spool.upload_path('..', 'c', DIGEST, 'file', 'u')
+    with pytest.raises(ValueError):
+        spool.path('t', '../c', DIGEST)
+
+def test_commit_and_ack(tmp_path):
+    spool = Spool(tmp_path / 'spool')
+    upload = spool.upload_path('t', 'c', DIGEST, 'file', 'u')
+    upload.parent.mkdir(parents=True)
+    upload.write_bytes(b'data')
+    spool.commit('t', 'c', DIGEST, 'file', upload, 4)
+    item = spool.get('t', 'c', DIGEST)
+    assert spool.used('t') == 4
+    assert spool.path('t', 'c', DIGEST).read_bytes() == b'data'
+    assert spool.ack('t', [item['seq']]) == 1
+    assert spool.used('t') == 0
+    assert not spool.path('t', 'c', DIGEST).exists()
@@ -0,0 +1,110 @@
+'''Tests for the target storing what it pulls from the server.'''
+
+import io
+import os
+import struct
+
+import pytest
+
+from backupinator import target as target_module
+from backupinator.compression import compress, frame
+from backupinator.delta import encode_delta, iter_delta, signatures
+from backupinator.job import AckJob
+from backupinator.target import Target
+from backupinator.utils import target_rsa_key_filename
+
+@pytest.fixture
+def target(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = tmp_path / 'target_data' / 't' / 'target.ini'
+    config.parent.mkdir(parents=True)
+    config.write_text(
+        '[DEFAULT]\nserver_address=http://x\nbackup_dir=%s\n'
+        'db_backend=sqlite\nmax_attempts=2\n' % (tmp_path / 'backup'))
+    for public in (True, False):
+        filename = target_rsa_key_filename('t', public)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        filename.write_text('')
+    return Target('t')
+
+def item(seq, data=b'data'):
+    return {
+        'seq': seq, 'client_name': 'c', 'filename_hash': 'ab'*28,
+        'kind': 'file', 'meta': {'filename': 'f%d' % seq}, 'data': data,
+    }
+
+@pytest.fixture
+def server(target, monkeypatch):
+    '''Fake server: items to hand out, and the seqs acked.'''
+
+    state = {'items': [], 'acked': []}
+    def submit(job, stream=False):
+        if isinstance(job, AckJob):
+            state['acked'] += job.seqs
+            return {'success': True}
+        return {'success': True, 'items': state['items']}
+    def fetch(seq=None, chunk_hashes=None):
+        data = state['items'][seq - 1]['data']
+        if data is None:
+            raise struct.error('unpack requires a buffer of 4 bytes')
+        return io.BytesIO(data)
+    monkeypatch.setattr(target, 'submit', submit)
+    monkeypatch.setattr(target, 'fetch', fetch)
+    monkeypatch.setattr(target_module, 'load_response', lambda resp: resp)
+    return state
+
+def test_pull_acks_stored_items(target, server):
+    server['items'] = [item(1), item(2, None), item(3)]
+    assert target.pull() == 2
+    assert server['acked'] == [1, 3]
+    assert not (target.backup_dir / 'quarantine').exists()
+
+def test_pull_quarantines_after_max_attempts(target, server):
+    server['items'] = [item(1, None)]
+    target.pull()
+    assert server['acked'] == []
+    target.pull()
+    assert server['acked'] == [1]
+    assert (target.backup_dir / 'quarantine' / '1.json').exists()
+
+def test_pull_stops_on_connection_errors(target, server, monkeypatch):
+    def fetch(seq=None, chunk_hashes=None):
+        if seq == 2:
+            raise ConnectionError('server went away')
+        return io.BytesIO(b'data')
+    monkeypatch.setattr(target, 'fetch', fetch)
+    server['items'] = [item(1), item(2), item(3)]
+    with pytest.raises(ConnectionError):
+        target.pull()
+    assert server['acked'] == [1]
+
+class Upload(io.BytesIO):
+    '''An upload that must not be read all at once.'''
+
+    def read(self, size=-1):
+        assert size is not None and size >= 0, 'whole upload read'
+        return super(Upload, self).read(size)
+
+def test_compressed_upload_is_streamed(target, server, monkeypatch):
+    data = os.urandom(300000) + b'x'*300000
+    frames = b''.join(
+        frame(compress('zlib', data[ii:ii+65536]))
+        for ii in range(0, len(data), 65536))
+    monkeypatch.setattr(target, 'fetch', lambda seq: Upload(frames))
+    server['items'] = [dict(item(1), meta={
+        'filename': 'f1', 'codec': 'zlib', 'chunk_size': 65536})]
+    assert target.pull() == 1
+    assert target.read_file('c', 'ab'*28) == data
+
+def test_delta_upload_is_streamed(target, server, monkeypatch):
+    old = os.urandom(200000)
+    new = old[:50000] + b'new' + old[50000:]
+    target.register_client('c')
+    target.update_file('c', 'ab'*28, old)
+    sigs = signatures(io.BytesIO(old), 2048)
+    delta = b''.join(encode_delta(iter_delta(io.BytesIO(new), sigs, 2048)))
+    monkeypatch.setattr(target, 'fetch', lambda seq: Upload(delta))
+    server['items'] = [dict(
+        item(1), kind='delta', meta={'filename': 'f1', 'block_size': 2048})]
+    assert target.pull() == 1
+    assert target.read_file('c', 'ab'*28) == new
@@ -0,0 +1,43 @@
+'''Tests for the target's database of backed-up files.'''
+
+import json
+
+import pytest
+
+from backupinator import target_db as target_db_module
+from backupinator.target_db import TargetDB, version_key
+
+FILE = 'ab'*28
+
+@pytest.fixture
+def db(tmp_path):
+    db = TargetDB('t', tmp_path, 'sqlite')
+    db.add_client('c')
+    return db
+
+def add(db, monkeypatch, now, chunks):
+    monkeypatch.setattr(target_db_module, 'time', lambda: now)
+    db.add_manifest('c', FILE, chunks)
+    db.add_file('c', FILE, filename='f', mtime=now)
+
+def test_versions(db, monkeypatch):
+    for now in (10, 20, 30):
+        add(db, monkeypatch, now, [['c%d' % now, 1]])
+    assert db.get_version('c', FILE)[0] == 30
+    assert db.get_version('c', FILE, at=25)[2] == [['c20', 1]]
+    assert db.get_version('c', FILE, at=5) is None
+
+def test_versions_are_separate_keys(db, monkeypatch):
+    for now in (10, 20):
+        add(db, monkeypatch, now, [['c', 1]])
+    versions = db.get_store(db.get_client_versions_db_filename('c'))
+    assert versions.get(FILE) == b'2'
+    assert json.loads(versions.get(version_key(FILE, 1)))[0] == 20
+
+def test_old_histories(db, monkeypatch):
+    versions = db.get_store(db.get_client_versions_db_filename('c'))
+    versions[FILE] = json.dumps([[10, 10, [['c10', 1]]]])
+    assert db.get_version('c', FILE)[0] == 10
+    add(db, monkeypatch, 20, [['c20', 1]])
+    assert db.get_version('c', FILE, at=15)[2] == [['c10', 1]]
+    assert db.get_version('c', FILE)[2] == [['c20', 1]]
@@ -0,0 +1,37 @@
+'''Tests for submitting jobs with retries.'''
+
+from time import time
+
+from backupinator.job import CheckinClientJob
+from backupinator.session import Session
+from backupinator.transport import Transport
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+def test_retries_are_signed_again():
+    transport = Transport(retries=2, backoff=0)
+    server = Session('s', b'k'*32, time() + 60)
+    statuses = [503, 503, 200]
+    accepted = []
+    def post(url, post_opts, stream=False):
+        accepted.append(server.verify(job.auth))
+        return Response(statuses.pop(0))
+    transport._post = post
+    job = CheckinClientJob('http://x', 'c', [], None)
+    assert transport.submit(job, sign=server.sign).status_code == 200
+    assert accepted == [True, True, True]
+
+def test_without_sign_auth_is_kept():
+    transport = Transport(retries=1, backoff=0)
+    server = Session('s', b'k'*32, time() + 60)
+    job = CheckinClientJob('http://x', 'c', [], server.sign())
+    accepted = []
+    def post(url, post_opts, stream=False):
+        accepted.append(server.verify(job.auth))
+        return Response(503)
+    transport._post = post
+    assert transport.submit(job).status_code == 503
+    assert accepted == [True, False]
@@ -0,0 +1,94 @@
+'''Tests for the binary wire format.'''
+
+import pytest
+
+from backupinator import wire
+from backupinator.auth import Auth
+from backupinator.job import (
+    AckJob, BatchJob, GetTreeJob, SendChunksJob, SendFileJob)
+
+def ack_job():
+    return AckJob('http://x', 't', [1, 2, 3], Auth('m', 'ab'*16, 's'))
+
+def fields(job):
+    '''Comparable public attributes of a job.'''
+    val = {k: v for k, v in vars(job).items() if not k.startswith('_')}
+    val['uuid'] = str(val['uuid'])
+    if val['auth'] is not None:
+        val['auth'] = vars(val['auth'])
+    return val
+
+def make_jobs():
+    auth = Auth('msg', 'ab'*16, 'sid')
+    batch = BatchJob('http://x', 'c', auth)
+    batch.addjob(AckJob('http://x', 't', [4], None))
+    batch.addjob(GetTreeJob(
+        'http://x', 'c', 't', auth, filename_hashes=['cd'*28],
+        prefixes=['a/b']))
+    return [
+        ack_job(),
+        SendFileJob(
+            'http://x', 'c', 't', 'dir/f.txt', auth, 65536, 'zlib', 'v',
+            12.5, hashes={'name': 'sha224'}),
+        SendChunksJob(
+            'http://x', 'c', 't', 'dir/f.txt', [['ef'*32, 0, 10]],
+            ['ef'*32], auth),
+        batch,
+    ]
+
+@pytest.mark.parametrize('job', make_jobs(), ids=lambda job: job.job_type)
+def test_job_round_trip(job):
+    decoded = wire.load_job(wire.dump_job(job))
+    assert type(decoded) is type(job)
+    expected = fields(job)
+    if isinstance(job, BatchJob):
+        assert [fields(j) for j in decoded.jobs] == [
+            fields(j) for j in expected.pop('jobs')]
+        del decoded.jobs
+    assert fields(decoded) == expected
+
+@pytest.mark.parametrize('val', [
+    None, True, False, 0, -2**63, 1.5, '', 'h\xe9', b'\x00\xff', [],
+    [1, [2, 'x']], {'a': {'b': [None]}, 1: 2.0}])
+def test_value_round_trip(val):
+    assert wire.loads(wire.dumps(val)) == val
+
+def test_truncated_messages_are_rejected():
+    data = wire.dump_job(ack_job())
+    for end in range(len(data)):
+        with pytest.raises(ValueError):
+            wire.load_job(data[:end])
+
+def test_trailing_data_is_rejected():
+    with pytest.raises(ValueError):
+        wire.loads(wire.dumps([1, 2]) + b'N')
+
+@pytest.mark.parametrize('val', [[], [len(wire.SCHEMAS)], [-1], ['AckJob'], 7])
+def test_unknown_job_types_are_rejected(val):
+    with pytest.raises(ValueError):
+        wire.load_job(wire.dumps(val))
+
+def test_malformed_fields_are_rejected():
+    val = wire.encode_job(ack_job())
+    val[-1] = ['m', 'not bytes', 's']
+    with pytest.raises(ValueError):
+        wire.decode_job(val)
+
+def test_unknown_versions_are_rejected():
+    data = bytearray(wire.dumps(None))
+    data[len(wire.MAGIC)] = wire.VERSION + 1
+    with pytest.raises(ValueError):
+        wire.loads(bytes(data))
+
+def test_older_messages_leave_newer_fields_unset():
+    val = wire.encode_job(ack_job())[:-1]
+    data = bytearray(wire.dumps(val))
+    data[len(wire.MAGIC)] = wire.MIN_VERSION
+    job = wire.load_job(bytes(data))
+    assert job.seqs == [1, 2, 3] and job.auth is None
+
+@pytest.mark.parametrize('header, binary', [
+    (str(wire.VERSION), True), (str(wire.VERSION - 1), False),
+    (None, False), ('junk', False)])
+def test_speaks(header, binary):
+    assert wire.speaks(header) is binary